@@ -98,6 +98,7 @@ class Network:  # LoraModule
         self.modules = {}
         self.bundle_embeddings = {}
         self.mtime = None
+        self.size = 0
 
         self.mentioned_name = None
         """the text that was used to add the network to prompt - can be either name or an alias"""
@@ -109,6 +110,9 @@ class ModuleType:
 
 
 class NetworkModule:
+    updown_depends_on_weight = False
+    """if True, calc_updown result depends on the current weight of the layer rather than just its shape"""
+
     def __init__(self, net: Network, weights: NetworkWeights):
         self.network = net
         self.network_key = weights.network_key
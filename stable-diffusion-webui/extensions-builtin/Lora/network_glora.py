@@ -10,6 +10,8 @@ class ModuleTypeGLora(network.ModuleType):
 
 # adapted from https://github.com/KohakuBlueleaf/LyCORIS
 class NetworkModuleGLora(network.NetworkModule):
+    updown_depends_on_weight = True
+
     def __init__(self,  net: network.Network, weights: network.NetworkWeights):
         super().__init__(net, weights)
 
@@ -10,6 +10,8 @@ class ModuleTypeIa3(network.ModuleType):
 
 
 class NetworkModuleIa3(network.NetworkModule):
+    updown_depends_on_weight = True
+
     def __init__(self,  net: network.Network, weights: network.NetworkWeights):
         super().__init__(net, weights)
 
@@ -13,6 +13,8 @@ class ModuleTypeOFT(network.ModuleType):
 # Supports both kohya-ss' implementation of COFT  https://github.com/kohya-ss/sd-scripts/blob/main/networks/oft.py
 # and KohakuBlueleaf's implementation of OFT/COFT https://github.com/KohakuBlueleaf/LyCORIS/blob/dev/lycoris/modules/diag_oft.py
 class NetworkModuleOFT(network.NetworkModule):
+    updown_depends_on_weight = True
+
     def __init__(self,  net: network.Network, weights: network.NetworkWeights):
 
         super().__init__(net, weights)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import gradio as gr
+import hashlib
 import logging
 import os
 import re
@@ -18,7 +19,7 @@ import network_oft
 import torch
 from typing import Union
 
-from modules import shared, devices, sd_models, errors, scripts, sd_hijack
+from modules import shared, devices, sd_models, errors, scripts, sd_hijack, cache, hashes, model_index
 import modules.textual_inversion.textual_inversion as textual_inversion
 import modules.models.sd3.mmdit
 
@@ -145,6 +146,8 @@ def assign_network_names_to_compvis_modules(sd_model):
         module.network_layer_name = network_name
 
     sd_model.network_layer_mapping = network_layer_mapping
+    network_deltas.clear()
+    sd_model.network_layer_mapping_hash = hashlib.sha256("\n".join(sorted(network_layer_mapping)).encode()).hexdigest()[0:16]
 
 
 class BundledTIHash(str):
@@ -155,6 +158,91 @@ class BundledTIHash(str):
         return self.hash if shared.opts.lora_bundled_ti_to_infotext else ''
 
 
+def match_network_key(key_network_without_network_parts, is_sd2, diffusers_weight_map):
+    """
+    Finds which layer of the currently loaded model a network key (without the trailing lora_up.weight-like part) applies to.
+    Returns a tuple of (key, name of the layer in sd_model.network_layer_mapping); the name is None if no layer matches.
+    """
+
+    layer_mapping = shared.sd_model.network_layer_mapping
+
+    if diffusers_weight_map:
+        key = diffusers_weight_map.get(key_network_without_network_parts, key_network_without_network_parts)
+    else:
+        key = convert_diffusers_name_to_compvis(key_network_without_network_parts, is_sd2)
+
+    if key in layer_mapping:
+        return key, key
+
+    m = re_x_proj.match(key)
+    if m and m.group(1) in layer_mapping:
+        return key, m.group(1)
+
+    # SDXL loras seem to already have correct compvis keys, so only need to replace "lora_unet" with "diffusion_model"
+    if "lora_unet" in key_network_without_network_parts:
+        key = key_network_without_network_parts.replace("lora_unet", "diffusion_model")
+        if key in layer_mapping:
+            return key, key
+    elif "lora_te1_text_model" in key_network_without_network_parts:
+        key = key_network_without_network_parts.replace("lora_te1_text_model", "0_transformer_text_model")
+        if key in layer_mapping:
+            return key, key
+
+        # some SD1 Loras also have correct compvis keys
+        key = key_network_without_network_parts.replace("lora_te1_text_model", "transformer_text_model")
+        if key in layer_mapping:
+            return key, key
+
+    # kohya_ss OFT module
+    elif "oft_unet" in key_network_without_network_parts:
+        key = key_network_without_network_parts.replace("oft_unet", "diffusion_model")
+        if key in layer_mapping:
+            return key, key
+
+    # KohakuBlueLeaf OFT module
+    if "oft_diag" in key:
+        key = key_network_without_network_parts.replace("lora_unet", "diffusion_model")
+        key = key_network_without_network_parts.replace("lora_te1_text_model", "0_transformer_text_model")
+        if key in layer_mapping:
+            return key, key
+
+    return key, None
+
+
+def get_network_key_mapping(sd_model):
+    """
+    Returns a dict of network keys to results of match_network_key for the architecture of sd_model.
+    The dict is shared by all networks, and is persisted in cache so that matching is only done once for each key.
+    """
+
+    architecture = getattr(sd_model, 'network_layer_mapping_hash', None)
+    if architecture is None:
+        return {}
+
+    key_mapping = network_key_mappings.get(architecture)
+    if key_mapping is None:
+        try:
+            key_mapping = {k: tuple(v) for k, v in cache.cache("lora-key-mapping").get(architecture, {}).items()}
+        except Exception as e:
+            errors.display(e, "reading lora key mapping from cache")
+            key_mapping = {}
+
+        network_key_mappings[architecture] = key_mapping
+
+    return key_mapping
+
+
+def store_network_key_mapping(sd_model, key_mapping):
+    architecture = getattr(sd_model, 'network_layer_mapping_hash', None)
+    if architecture is None:
+        return
+
+    try:
+        cache.cache("lora-key-mapping")[architecture] = key_mapping
+    except Exception as e:
+        errors.display(e, "writing lora key mapping to cache")
+
+
 def load_network(name, network_on_disk):
     net = network.Network(name, network_on_disk)
     net.mtime = os.path.getmtime(network_on_disk.filename)
@@ -180,6 +268,9 @@ def load_network(name, network_on_disk):
     matched_networks = {}
     bundle_embeddings = {}
 
+    key_mapping = get_network_key_mapping(shared.sd_model)
+    key_mapping_changed = False
+
     for key_network, weight in sd.items():
 
         if diffusers_weight_map:
@@ -198,41 +289,14 @@ def load_network(name, network_on_disk):
                 emb_dict[vec_name] = weight
             bundle_embeddings[emb_name] = emb_dict
 
-        if diffusers_weight_map:
-            key = diffusers_weight_map.get(key_network_without_network_parts, key_network_without_network_parts)
-        else:
-            key = convert_diffusers_name_to_compvis(key_network_without_network_parts, is_sd2)
-
-        sd_module = shared.sd_model.network_layer_mapping.get(key, None)
+        resolved = key_mapping.get(key_network_without_network_parts)
+        if resolved is None:
+            resolved = match_network_key(key_network_without_network_parts, is_sd2, diffusers_weight_map)
+            key_mapping[key_network_without_network_parts] = resolved
+            key_mapping_changed = True
 
-        if sd_module is None:
-            m = re_x_proj.match(key)
-            if m:
-                sd_module = shared.sd_model.network_layer_mapping.get(m.group(1), None)
-
-        # SDXL loras seem to already have correct compvis keys, so only need to replace "lora_unet" with "diffusion_model"
-        if sd_module is None and "lora_unet" in key_network_without_network_parts:
-            key = key_network_without_network_parts.replace("lora_unet", "diffusion_model")
-            sd_module = shared.sd_model.network_layer_mapping.get(key, None)
-        elif sd_module is None and "lora_te1_text_model" in key_network_without_network_parts:
-            key = key_network_without_network_parts.replace("lora_te1_text_model", "0_transformer_text_model")
-            sd_module = shared.sd_model.network_layer_mapping.get(key, None)
-
-            # some SD1 Loras also have correct compvis keys
-            if sd_module is None:
-                key = key_network_without_network_parts.replace("lora_te1_text_model", "transformer_text_model")
-                sd_module = shared.sd_model.network_layer_mapping.get(key, None)
-
-        # kohya_ss OFT module
-        elif sd_module is None and "oft_unet" in key_network_without_network_parts:
-            key = key_network_without_network_parts.replace("oft_unet", "diffusion_model")
-            sd_module = shared.sd_model.network_layer_mapping.get(key, None)
-
-        # KohakuBlueLeaf OFT module
-        if sd_module is None and "oft_diag" in key:
-            key = key_network_without_network_parts.replace("lora_unet", "diffusion_model")
-            key = key_network_without_network_parts.replace("lora_te1_text_model", "0_transformer_text_model")
-            sd_module = shared.sd_model.network_layer_mapping.get(key, None)
+        key, sd_module_name = resolved
+        sd_module = shared.sd_model.network_layer_mapping.get(sd_module_name) if sd_module_name is not None else None
 
         if sd_module is None:
             keys_failed_to_match[key_network] = key
@@ -263,6 +327,10 @@ def load_network(name, network_on_disk):
         embeddings[emb_name] = embedding
 
     net.bundle_embeddings = embeddings
+    net.size = sum(x.nbytes for x in sd.values() if isinstance(x, torch.Tensor))
+
+    if key_mapping_changed:
+        store_network_key_mapping(shared.sd_model, key_mapping)
 
     if keys_failed_to_match:
         logging.debug(f"Network {network_on_disk.filename} didn't match keys: {keys_failed_to_match}")
@@ -271,7 +339,17 @@ def load_network(name, network_on_disk):
 
 
 def purge_networks_from_memory():
-    while len(networks_in_memory) > shared.opts.lora_in_memory_limit and len(networks_in_memory) > 0:
+    size_limit = shared.opts.lora_in_memory_limit_mb * 1024 * 1024
+    count_limit = shared.opts.lora_in_memory_limit
+
+    def over_limit():
+        # with only the size limit set, the number of networks is not limited
+        if (count_limit > 0 or size_limit == 0) and len(networks_in_memory) > count_limit:
+            return True
+
+        return size_limit > 0 and sum(x.size for x in networks_in_memory.values()) > size_limit
+
+    while len(networks_in_memory) > 0 and over_limit():
         name = next(iter(networks_in_memory))
         networks_in_memory.pop(name, None)
 
@@ -316,16 +394,17 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
             if net is None:
                 net = networks_in_memory.get(name)
 
-            if net is None or os.path.getmtime(network_on_disk.filename) > net.mtime:
+            if net is None or net.network_on_disk.filename != network_on_disk.filename or os.path.getmtime(network_on_disk.filename) > net.mtime:
                 try:
                     net = load_network(name, network_on_disk)
-
-                    networks_in_memory.pop(name, None)
-                    networks_in_memory[name] = net
                 except Exception as e:
                     errors.display(e, f"loading network {network_on_disk.filename}")
                     continue
 
+            # move to the end, so that least recently used networks are purged first
+            networks_in_memory.pop(name, None)
+            networks_in_memory[name] = net
+
             net.mentioned_name = name
 
             network_on_disk.read_hash()
@@ -451,11 +530,23 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
         self.network_bias_backup = bias_backup
 
     if current_names != wanted_names:
+        if shared.opts.lora_incremental_apply and network_apply_weights_incremental(self, network_layer_name):
+            self.network_current_names = wanted_names
+            return
+
         network_restore_weights_from_backup(self)
 
+        applied_modules = {}
+        can_apply_incrementally = True
+
         for net in loaded_networks:
             module = net.modules.get(network_layer_name, None)
             if module is not None and hasattr(self, 'weight') and not isinstance(module, modules.models.sd3.mmdit.QkvLinear):
+                if network_module_is_additive(module) and network_delta_key(net) not in applied_modules:
+                    applied_modules[network_delta_key(net)] = module
+                else:
+                    can_apply_incrementally = False
+
                 try:
                     with torch.no_grad():
                         if getattr(self, 'fp16_weight', None) is None:
@@ -479,6 +570,7 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
                             else:
                                 self.bias.copy_((bias + ex_bias).to(dtype=self.bias.dtype))
                 except RuntimeError as e:
+                    can_apply_incrementally = False
                     logging.debug(f"Network {net.name} layer {network_layer_name}: {e}")
                     extra_network_lora.errors[net.name] = extra_network_lora.errors.get(net.name, 0) + 1
 
@@ -490,6 +582,8 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
             module_out = net.modules.get(network_layer_name + "_out_proj", None)
 
             if isinstance(self, torch.nn.MultiheadAttention) and module_q and module_k and module_v and module_out:
+                can_apply_incrementally = False
+
                 try:
                     with torch.no_grad():
                         # Send "real" orig_weight into MHA's lora module
@@ -516,6 +610,8 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
                 continue
 
             if isinstance(self, modules.models.sd3.mmdit.QkvLinear) and module_q and module_k and module_v:
+                can_apply_incrementally = False
+
                 try:
                     with torch.no_grad():
                         # Send "real" orig_weight into MHA's lora module
@@ -540,6 +636,207 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
             extra_network_lora.errors[net.name] = extra_network_lora.errors.get(net.name, 0) + 1
 
         self.network_current_names = wanted_names
+        self.network_current_modules = applied_modules if can_apply_incrementally else None
+        self.network_incremental_updates = 0
+
+
+def network_module_is_additive(module):
+    """Returns True if the change the module makes to layer's weight can be added or subtracted independently of other networks."""
+
+    return not module.updown_depends_on_weight and module.dora_scale is None
+
+
+def network_delta_key(net):
+    return net.name, net.mtime, net.te_multiplier, net.unet_multiplier, net.dyn_dim
+
+
+def network_cond_cache_key():
+    """Describes loaded networks that change the output of the text encoder, either by their weights or by bundled embeddings."""
+
+    return tuple((net.name, net.mtime, net.te_multiplier, net.dyn_dim) for net in loaded_networks if net.te_multiplier or net.bundle_embeddings)
+
+
+def network_calc_delta(self, module):
+    updown, ex_bias = module.calc_updown(self.weight)
+
+    if len(self.weight.shape) == 4 and self.weight.shape[1] == 9:
+        # inpainting model. zero pad updown to make channel[1]  4 to 9
+        updown = torch.nn.functional.pad(updown, (0, 0, 0, 0, 0, 5))
+
+    return updown, ex_bias
+
+
+def network_get_delta(self, network_layer_name, key, module):
+    cache_key = (network_layer_name, *key)
+
+    delta = network_deltas.get(cache_key)
+    if delta is not None:
+        return delta
+
+    # the key may describe multipliers the network had before they were changed, so use those for the calculation
+    net = module.network
+    multipliers = net.te_multiplier, net.unet_multiplier, net.dyn_dim
+    _, _, net.te_multiplier, net.unet_multiplier, net.dyn_dim = key
+    try:
+        delta = network_calc_delta(self, module)
+    finally:
+        net.te_multiplier, net.unet_multiplier, net.dyn_dim = multipliers
+
+    network_deltas.put(cache_key, delta, shared.opts.lora_delta_cache_mb * 1024 * 1024)
+
+    return delta
+
+
+def network_apply_weights_incremental(self, network_layer_name):
+    """
+    Changes weights of layer self from the previously applied set of networks to loaded_networks by subtracting changes made
+    by networks that are no longer wanted and adding changes of new ones, instead of restoring weights from backup and
+    recalculating every network. Only possible when every network involved only adds to weights (as regular Lora does).
+    Returns False without altering weights if the full path must be used instead.
+    """
+
+    if isinstance(self, (torch.nn.MultiheadAttention, modules.models.sd3.mmdit.QkvLinear)) or getattr(self, 'weight', None) is None:
+        return False
+
+    if getattr(self, 'fp16_weight', None) is not None or getattr(self, "network_weights_backup", None) is None:
+        return False
+
+    # adding and subtracting in weight's dtype accumulates rounding errors, so go through the full path from time to time
+    if getattr(self, 'network_incremental_updates', 0) >= incremental_updates_before_full_apply:
+        return False
+
+    current = getattr(self, 'network_current_modules', None)
+    if current is None:
+        if getattr(self, 'network_current_names', ()) != ():
+            return False
+
+        current = {}
+
+    wanted = {}
+    for net in loaded_networks:
+        module = net.modules.get(network_layer_name, None)
+        if module is None:
+            continue
+
+        key = network_delta_key(net)
+        if not network_module_is_additive(module) or key in wanted:
+            return False
+
+        wanted[key] = module
+
+    # with no networks left, restoring from backup is exact, while subtracting would leave rounding errors in weights
+    if not wanted:
+        return False
+
+    changes = [(key, current[key], -1) for key in current if key not in wanted] + [(key, wanted[key], 1) for key in wanted if key not in current]
+
+    try:
+        with torch.no_grad():
+            updown_total = None
+            ex_bias_total = None
+
+            for key, module, sign in changes:
+                updown, ex_bias = network_get_delta(self, network_layer_name, key, module)
+
+                updown_total = updown * sign if updown_total is None else updown_total + updown * sign
+                if ex_bias is not None:
+                    ex_bias_total = ex_bias * sign if ex_bias_total is None else ex_bias_total + ex_bias * sign
+
+            if ex_bias_total is not None and getattr(self, 'bias', None) is None:
+                return False
+
+            if updown_total is not None:
+                self.weight.copy_((self.weight.to(dtype=updown_total.dtype) + updown_total.to(self.weight.device)).to(dtype=self.weight.dtype))
+
+            if ex_bias_total is not None:
+                self.bias.copy_((self.bias.to(dtype=ex_bias_total.dtype) + ex_bias_total.to(self.bias.device)).to(dtype=self.bias.dtype))
+
+            if shared.opts.lora_incremental_check:
+                network_check_incremental(self, network_layer_name, wanted)
+
+    except RuntimeError as e:
+        logging.debug(f"Networks layer {network_layer_name}: incremental application failed: {e}")
+
+        # weights might have been partially changed, so force the full path to restore them from backup
+        self.network_current_modules = None
+        return False
+
+    self.network_current_modules = wanted
+    self.network_incremental_updates = getattr(self, 'network_incremental_updates', 0) + 1
+
+    return True
+
+
+def network_check_incremental(self, network_layer_name, wanted):
+    """Compares weights of layer self after incremental application to what the full path produces, and uses the latter if they differ."""
+
+    weight = self.network_weights_backup.to(self.weight.device, copy=True)
+    bias_backup = getattr(self, "network_bias_backup", None)
+    bias = bias_backup.to(self.bias.device, copy=True) if bias_backup is not None else None
+
+    eps = torch.finfo(self.weight.dtype).eps
+    for module in wanted.values():
+        updown, ex_bias = network_calc_delta(self, module)
+        weight = (weight.to(dtype=updown.dtype) + updown).to(dtype=self.weight.dtype)
+        if ex_bias is not None and bias is not None:
+            bias = (bias + ex_bias).to(dtype=self.bias.dtype)
+
+        eps = max(eps, torch.finfo(updown.dtype).eps)
+
+    # each incremental update can be off by a rounding error in the least precise dtype involved
+    updates = getattr(self, 'network_incremental_updates', 0) + 1
+    tolerance = eps * (updates + 1) * weight.abs().max().item()
+    weight_error = (weight.float() - self.weight.float()).abs().max().item()
+    bias_error = (bias.float() - self.bias.float()).abs().max().item() if bias is not None else 0.0
+
+    if weight_error > tolerance or bias_error > tolerance:
+        logging.warning(f"Networks layer {network_layer_name}: incremental application differs from full by {max(weight_error, bias_error)}; using full")
+
+        self.weight.copy_(weight)
+        if bias is not None:
+            self.bias.copy_(bias)
+
+
+class NetworkDeltaCache:
+    """Least recently used cache of changes to layer weights calculated by networks, limited by total size in bytes."""
+
+    def __init__(self):
+        self.entries = {}
+        self.size = 0
+
+    def get(self, key):
+        delta = self.entries.pop(key, None)
+        if delta is not None:
+            self.entries[key] = delta
+
+        return delta
+
+    def put(self, key, delta, size_limit):
+        if size_limit <= 0:
+            return
+
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= self.delta_size(previous)
+
+        self.entries[key] = delta
+        self.size += self.delta_size(delta)
+
+        self.purge(size_limit)
+
+    def purge(self, size_limit):
+        while self.entries and self.size > size_limit:
+            key = next(iter(self.entries))
+            self.size -= self.delta_size(self.entries.pop(key))
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    @staticmethod
+    def delta_size(delta):
+        updown, ex_bias = delta
+        return updown.nbytes + (ex_bias.nbytes if ex_bias is not None else 0)
 
 
 def network_forward(org_module, input, original_forward):
@@ -571,6 +868,7 @@ def network_forward(org_module, input, original_forward):
 
 def network_reset_cached_weight(self: Union[torch.nn.Conv2d, torch.nn.Linear]):
     self.network_current_names = ()
+    self.network_current_modules = None
     self.network_weights_backup = None
     self.network_bias_backup = None
 
@@ -648,21 +946,46 @@ def network_MultiheadAttention_load_state_dict(self, *args, **kwargs):
 
 
 def process_network_files(names: list[str] | None = None):
-    candidates = list(shared.walk_files(shared.cmd_opts.lora_dir, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
-    candidates += list(shared.walk_files(shared.cmd_opts.lyco_dir_backcompat, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
+    candidates = list(model_index.walk_files(shared.cmd_opts.lora_dir, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
+    candidates += list(model_index.walk_files(shared.cmd_opts.lyco_dir_backcompat, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
+
+    files = []
     for filename in candidates:
-        if os.path.isdir(filename):
-            continue
         name = os.path.splitext(os.path.basename(filename))[0]
         # if names is provided, only load networks with names in the list
         if names and name not in names:
             continue
+
+        files.append((name, filename, model_index.file_stat(filename)))
+
+    def create_entry(item):
+        name, filename, _ = item
         try:
-            entry = network.NetworkOnDisk(name, filename)
+            return network.NetworkOnDisk(name, filename)
         except OSError:  # should catch FileNotFoundError and PermissionError etc.
             errors.report(f"Failed to load network {name} from {filename}", exc_info=True)
+            return None
+
+    # NetworkOnDisk objects for files that did not change are reused; others are created in parallel
+    changed = [item for item in files if networks_on_disk_by_filename.get(item[1], (None, None))[0] != item[2]]
+    for (_, filename, stat), entry in zip(changed, model_index.map_parallel(create_entry, changed)):
+        if entry is None:
+            networks_on_disk_by_filename.pop(filename, None)
+        else:
+            networks_on_disk_by_filename[filename] = (stat, entry)
+
+    if not names:
+        for filename in set(networks_on_disk_by_filename).difference(candidates):
+            del networks_on_disk_by_filename[filename]
+
+    for name, filename, _ in files:
+        _, entry = networks_on_disk_by_filename.get(filename, (None, None))
+        if entry is None:
             continue
 
+        if entry.shorthash:
+            available_network_hash_lookup[entry.shorthash] = entry
+
         available_networks[name] = entry
 
         if entry.alias in available_network_aliases:
@@ -676,6 +999,13 @@ def update_available_networks_by_names(names: list[str]):
     process_network_files(names)
 
 
+def refresh_available_networks():
+    """Lists networks again, also re-reading files that were changed in place; for explicit refreshes."""
+
+    model_index.invalidate([shared.cmd_opts.lora_dir, shared.cmd_opts.lyco_dir_backcompat])
+    list_available_networks()
+
+
 def list_available_networks():
     available_networks.clear()
     available_network_aliases.clear()
@@ -687,6 +1017,8 @@ def list_available_networks():
 
     process_network_files()
 
+    hashes.prehash((entry.filename, "lora/" + entry.name, entry.is_safetensors, entry.set_hash) for entry in available_networks.values() if not entry.hash)
+
 
 re_network_name = re.compile(r"(.*)\s*\([0-9a-fA-F]+\)")
 
@@ -731,7 +1063,11 @@ available_network_aliases = {}
 loaded_networks = []
 loaded_bundle_embeddings = {}
 networks_in_memory = {}
+network_key_mappings = {}
+network_deltas = NetworkDeltaCache()
+incremental_updates_before_full_apply = 16
 available_network_hash_lookup = {}
+networks_on_disk_by_filename = {}
 forbidden_network_aliases = {}
 
 list_available_networks()
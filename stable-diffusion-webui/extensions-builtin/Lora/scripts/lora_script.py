@@ -9,12 +9,17 @@ import lora  # noqa:F401
 import lora_patches
 import extra_networks_lora
 import ui_extra_networks_lora
-from modules import script_callbacks, ui_extra_networks, extra_networks, shared
+from modules import script_callbacks, ui_extra_networks, extra_networks, shared, cond_cache, model_index
 
 
 def unload():
     networks.originals.undo()
 
+    if networks.network_cond_cache_key in cond_cache.key_callbacks:
+        cond_cache.key_callbacks.remove(networks.network_cond_cache_key)
+
+    model_index.remove_watch_callback(networks.list_available_networks)
+
 
 def before_ui():
     ui_extra_networks.register_page(ui_extra_networks_lora.ExtraNetworksPageLora())
@@ -25,6 +30,8 @@ def before_ui():
 
 
 networks.originals = lora_patches.LoraPatches()
+cond_cache.key_callbacks.append(networks.network_cond_cache_key)
+model_index.add_watch_callback([shared.cmd_opts.lora_dir, shared.cmd_opts.lyco_dir_backcompat], networks.list_available_networks)
 
 script_callbacks.on_model_loaded(networks.assign_network_names_to_compvis_modules)
 script_callbacks.on_script_unloaded(unload)
@@ -39,7 +46,11 @@ shared.options_templates.update(shared.options_section(('extra_networks', "Extra
     "lora_bundled_ti_to_infotext": shared.OptionInfo(True, "Add Lora name as TI hashes for bundled Textual Inversion").info('"Add Textual Inversion hashes to infotext" needs to be enabled'),
     "lora_show_all": shared.OptionInfo(False, "Always show all networks on the Lora page").info("otherwise, those detected as for incompatible version of Stable Diffusion will be hidden"),
     "lora_hide_unknown_for_versions": shared.OptionInfo([], "Hide networks of unknown versions for model versions", gr.CheckboxGroup, {"choices": ["SD1", "SD2", "SDXL"]}),
-    "lora_in_memory_limit": shared.OptionInfo(0, "Number of Lora networks to keep cached in memory", gr.Number, {"precision": 0}),
+    "lora_in_memory_limit": shared.OptionInfo(0, "Number of Lora networks to keep cached in memory", gr.Number, {"precision": 0}).info("0 = no limit if size limit below is set, otherwise nothing is cached"),
+    "lora_in_memory_limit_mb": shared.OptionInfo(0, "Maximum size of Lora networks cached in memory", gr.Number, {"precision": 0}).info("in MB; 0 = no limit; least recently used networks are removed first"),
+    "lora_incremental_apply": shared.OptionInfo(False, "Apply changes to the set of Lora networks incrementally").info("when networks or their weights change, only recalculate the ones that changed instead of restoring the model and applying all of them again; only for networks that add to model weights, like regular Lora"),
+    "lora_delta_cache_mb": shared.OptionInfo(0, "Size of cache for Lora weight changes, for the above option", gr.Number, {"precision": 0}).info("in MB; kept in the same memory as model weights (usually VRAM); 0 = disable"),
+    "lora_incremental_check": shared.OptionInfo(False, "Check incremental Lora application against full application").info("for debugging; slow"),
     "lora_not_found_warning_console": shared.OptionInfo(False, "Lora not found warning in console"),
     "lora_not_found_gradio_warning": shared.OptionInfo(False, "Lora not found warning popup in webui"),
 }))
@@ -66,7 +77,7 @@ def api_networks(_: gr.Blocks, app: FastAPI):
 
     @app.post("/sdapi/v1/refresh-loras")
     async def refresh_loras():
-        return networks.list_available_networks()
+        return networks.refresh_available_networks()
 
 
 script_callbacks.on_app_started(api_networks)
@@ -100,3 +111,5 @@ def infotext_pasted(infotext, d):
 script_callbacks.on_infotext_pasted(infotext_pasted)
 
 shared.opts.onchange("lora_in_memory_limit", networks.purge_networks_from_memory)
+shared.opts.onchange("lora_in_memory_limit_mb", networks.purge_networks_from_memory)
+shared.opts.onchange("lora_delta_cache_mb", lambda: networks.network_deltas.purge(shared.opts.lora_delta_cache_mb * 1024 * 1024))
@@ -13,7 +13,7 @@ class ExtraNetworksPageLora(ui_extra_networks.ExtraNetworksPage):
         super().__init__('Lora')
 
     def refresh(self):
-        networks.list_available_networks()
+        networks.refresh_available_networks()
 
     def create_item(self, name, index=None, enable_filter=True):
         lora_on_disk = networks.available_networks.get(name)
@@ -75,9 +75,19 @@ class ExtraNetworksPageLora(ui_extra_networks.ExtraNetworksPage):
 
         return item
 
-    def list_items(self):
+    def list_item_names(self):
         # instantiate a list to protect against concurrent modification
-        names = list(networks.available_networks)
+        return list(networks.available_networks)
+
+    def item_filename(self, name):
+        lora_on_disk = networks.available_networks.get(name)
+        return lora_on_disk.filename if lora_on_disk is not None else None
+
+    def items_state_key(self):
+        return super().items_state_key(), shared.opts.lora_show_all, shared.opts.lora_preferred_name, tuple(shared.opts.lora_hide_unknown_for_versions)
+
+    def list_items(self):
+        names = self.list_item_names()
         for index, name in enumerate(names):
             item = self.create_item(name, index)
             if item is not None:
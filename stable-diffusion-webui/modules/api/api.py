@@ -1,6 +1,9 @@
 import base64
+import functools
 import io
 import os
+import queue
+import threading
 import time
 import datetime
 import uvicorn
@@ -12,12 +15,12 @@ from io import BytesIO
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from secrets import compare_digest
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, sd_schedulers
+from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, sd_schedulers, extra_networks, fifo_lock, cond_cache, hashes, interrogate_batch
 from modules.api import models
 from modules.shared import opts
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
@@ -99,6 +102,19 @@ def decode_base64_to_image(encoding):
         raise HTTPException(status_code=500, detail="Invalid encoded image") from e
 
 
+def queue_key(req):
+    """Returns what models a generation request needs loaded: checkpoint, VAE and the set of LoRAs from the prompt."""
+
+    override_settings = req.override_settings or {}
+    checkpoint = override_settings.get("sd_model_checkpoint", opts.sd_model_checkpoint)
+    vae = override_settings.get("sd_vae", opts.sd_vae)
+
+    _, extra_network_data = extra_networks.parse_prompt(f"{req.prompt or ''} {req.negative_prompt or ''}")
+    loras = frozenset(params.items[0] for params in extra_network_data.get("lora", []) if params.items)
+
+    return checkpoint, vae, loras
+
+
 def encode_pil_to_base64(image):
     with io.BytesIO() as output_bytes:
         if isinstance(image, str):
@@ -215,6 +231,7 @@ class Api:
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
         self.add_api_route("/sdapi/v1/progress", self.progressapi, methods=["GET"], response_model=models.ProgressResponse)
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
+        self.add_api_route("/sdapi/v1/interrogate-batch", self.interrogate_batch_api, methods=["POST"], response_class=StreamingResponse)
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
         self.add_api_route("/sdapi/v1/options", self.get_config, methods=["GET"], response_model=models.OptionsModel)
@@ -239,6 +256,9 @@ class Api:
         self.add_api_route("/sdapi/v1/train/embedding", self.train_embedding, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/train/hypernetwork", self.train_hypernetwork, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=models.MemoryResponse)
+        self.add_api_route("/sdapi/v1/queue-stats", self.get_queue_stats, methods=["GET"], response_model=models.QueueStatsResponse)
+        self.add_api_route("/sdapi/v1/cond-cache-stats", self.get_cond_cache_stats, methods=["GET"], response_model=models.CondCacheStatsResponse)
+        self.add_api_route("/sdapi/v1/hashing-progress", self.get_hashing_progress, methods=["GET"], response_model=models.HashingProgressResponse)
         self.add_api_route("/sdapi/v1/unload-checkpoint", self.unloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
@@ -283,6 +303,13 @@ class Api:
 
         raise HTTPException(status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"})
 
+    def scheduled_queue_lock(self, key):
+        if not isinstance(self.queue_lock, fifo_lock.FIFOLock):
+            return self.queue_lock
+
+        self.queue_lock.max_delay = opts.api_queue_max_delay if opts.api_queue_group_by_model else None
+        return self.queue_lock.scheduled(key)
+
     def get_selectable_script(self, script_name, script_runner):
         if script_name is None or script_name == "":
             return None, None
@@ -464,7 +491,7 @@ class Api:
 
         add_task_to_queue(task_id)
 
-        with self.queue_lock:
+        with self.scheduled_queue_lock(queue_key(txt2imgreq)):
             with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
                 p.is_api = True
                 p.scripts = script_runner
@@ -534,7 +561,7 @@ class Api:
 
         add_task_to_queue(task_id)
 
-        with self.queue_lock:
+        with self.scheduled_queue_lock(queue_key(img2imgreq)):
             with closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
                 p.init_images = [decode_base64_to_image(x) for x in init_images]
                 p.is_api = True
@@ -646,6 +673,57 @@ class Api:
 
         return models.InterrogateResponse(caption=processed)
 
+    def interrogate_batch_api(self, req: models.InterrogateBatchRequest):
+        """Interrogates many images with models kept loaded for the whole job.
+
+        Streams back results as they are ready: one JSON object (see models.InterrogateBatchItem) per line, in the same
+        order as images.
+        """
+
+        if req.model not in interrogate_batch.interrogators:
+            raise HTTPException(status_code=404, detail="Model not found")
+
+        sources = [(str(i), functools.partial(decode_base64_to_image, image)) for i, image in enumerate(req.images)]
+
+        if req.directory:
+            if not shared.cmd_opts.api_interrogate_directories:
+                raise HTTPException(status_code=403, detail="Reading directories on the server is disabled; enable with --api-interrogate-directories")
+
+            if not os.path.isdir(req.directory):
+                raise HTTPException(status_code=404, detail="Directory not found")
+
+            sources += [(filename, functools.partial(images.read, filename)) for filename in interrogate_batch.list_directory(req.directory)]
+
+        results = queue.Queue()
+        cancelled = threading.Event()
+
+        def run():
+            try:
+                with self.queue_lock:
+                    shared.state.begin(job="interrogate")
+                    shared.state.job_count = len(sources)
+                    try:
+                        for index, (name, caption, error) in enumerate(interrogate_batch.interrogate_images(sources, req.model, req.batch_size, cancelled)):
+                            results.put(models.InterrogateBatchItem(index=index, name=name, caption=caption, error=error))
+                    finally:
+                        shared.state.end()
+            except Exception as e:
+                errors.report("Error interrogating images", exc_info=True)
+                results.put(models.InterrogateBatchItem(index=-1, name="", error=interrogate_batch.error_text(e)))
+            finally:
+                results.put(None)
+
+        def stream():
+            try:
+                while (item := results.get()) is not None:
+                    yield item.json() + "\n"
+            finally:
+                cancelled.set()
+
+        threading.Thread(target=run, daemon=True, name="interrogate-batch").start()
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
     def interruptapi(self):
         shared.state.interrupt()
 
@@ -848,6 +926,18 @@ class Api:
         finally:
             shared.state.end()
 
+    def get_queue_stats(self):
+        if not isinstance(self.queue_lock, fifo_lock.FIFOLock):
+            return models.QueueStatsResponse()
+
+        return models.QueueStatsResponse(**self.queue_lock.stats())
+
+    def get_cond_cache_stats(self):
+        return models.CondCacheStatsResponse(**cond_cache.cache.stats())
+
+    def get_hashing_progress(self):
+        return models.HashingProgressResponse(**hashes.hashing.progress())
+
     def get_memory(self):
         try:
             import os
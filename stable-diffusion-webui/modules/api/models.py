@@ -200,6 +200,18 @@ class InterrogateRequest(BaseModel):
 class InterrogateResponse(BaseModel):
     caption: str = Field(default=None, title="Caption", description="The generated caption for the image.")
 
+class InterrogateBatchRequest(BaseModel):
+    images: list[str] = Field(default=[], title="Images", description="Images to work on, as Base64 strings containing the images' data.")
+    directory: str = Field(default="", title="Directory", description="Directory on the server with images to work on, in addition to images; requires --api-interrogate-directories.")
+    model: str = Field(default="clip", title="Model", description="The interrogate model used.")
+    batch_size: int = Field(default=8, title="Batch size", description="Number of images that go through the model together.")
+
+class InterrogateBatchItem(BaseModel):
+    index: int = Field(title="Index", description="Position of the image: images from the request come first, then images from the directory.")
+    name: str = Field(title="Name", description="Index of the image in the request, or path to the image file.")
+    caption: Optional[str] = Field(default=None, title="Caption", description="The generated caption for the image.")
+    error: Optional[str] = Field(default=None, title="Error", description="Why there is no caption for the image, if there isn't.")
+
 class TrainResponse(BaseModel):
     info: str = Field(title="Train info", description="Response string from train embedding or hypernetwork task.")
 
@@ -299,6 +311,38 @@ class MemoryResponse(BaseModel):
     cuda: dict = Field(title="CUDA", description="nVidia CUDA memory stats")
 
 
+class QueueStatsResponse(BaseModel):
+    pending: int = Field(default=0, title="Pending", description="Number of requests waiting in the queue")
+    grouping: bool = Field(default=False, title="Grouping", description="Whether requests are reordered to reduce model switching")
+    max_delay: Optional[float] = Field(default=None, title="Max delay", description="Maximum time in seconds the head of the queue can be delayed by reordering")
+    swaps: int = Field(default=0, title="Swaps", description="Number of times consecutive requests needed a different checkpoint, VAE or LoRA set")
+    swaps_saved: int = Field(default=0, title="Swaps saved", description="Number of swaps avoided by reordering the queue")
+
+
+class HashingFileProgress(BaseModel):
+    title: str = Field(title="Title", description="Name under which the hash is stored in cache")
+    filename: str = Field(title="Filename", description="Path to the file being hashed")
+    running: bool = Field(title="Running", description="Whether the file is being hashed right now, as opposed to waiting in queue")
+    bytes_total: int = Field(title="Bytes total", description="Size of the file; 0 if hashing has not started yet")
+    bytes_done: int = Field(title="Bytes done", description="How much of the file has been hashed")
+
+
+class HashingProgressResponse(BaseModel):
+    queued: int = Field(title="Queued", description="Number of files waiting to be hashed")
+    running: int = Field(title="Running", description="Number of files being hashed right now")
+    done: int = Field(title="Done", description="Number of files hashed since startup")
+    failed: int = Field(title="Failed", description="Number of files that could not be hashed since startup")
+    files: list[HashingFileProgress] = Field(title="Files", description="Files that are queued or being hashed")
+
+
+class CondCacheStatsResponse(BaseModel):
+    entries: int = Field(title="Entries", description="Number of cached text conditionings")
+    size_mb: float = Field(title="Size", description="Memory used by cached conditionings, in megabytes")
+    limit_mb: float = Field(title="Limit", description="Maximum memory for cached conditionings, in megabytes")
+    hits: int = Field(title="Hits", description="Number of times the text encoder did not have to run because of the cache")
+    misses: int = Field(title="Misses", description="Number of times the text encoder had to run")
+
+
 class ScriptsList(BaseModel):
     txt2img: list = Field(default=None, title="Txt2img", description="Titles of scripts (txt2img)")
     img2img: list = Field(default=None, title="Img2img", description="Titles of scripts (img2img)")
@@ -0,0 +1,304 @@
+"""Picking the fastest attention implementation and chunk sizes for each shape of inputs.
+
+Which way of computing attention is fastest depends on the number of tokens, batch size, device and how much memory
+is free: computing all attention scores at once is fastest when they fit, splitting queries into slices uses less
+memory, sub-quadratic attention uses even less, and scaled dot product attention is fastest on some devices and not on
+others. The first time attention is computed for a shape, every candidate that fits into the memory budget is timed on
+the actual inputs; results are saved into webui's cache, keyed by device, dtype and shape, so that it only happens once
+per shape. Later calls with the same shape use the fastest candidate whose memory use fits into the budget at the time.
+Candidates that did not fit are saved too, with infinite time, and are timed once the budget grows enough for them.
+
+All candidates take q, k and v as (batch * heads, tokens, channels per head) and scale scores by
+channels ** -0.5, like CrossAttention does.
+
+Run as `python -m modules.attention_autotune` to benchmark candidates for shapes of SD1 attention layers; it works
+without a GPU.
+"""
+
+import math
+import platform
+import threading
+import time
+from collections import namedtuple
+
+import torch
+
+from modules import sub_quadratic_attention
+
+subsection = "attention-autotune"
+
+Candidate = namedtuple("Candidate", ["name", "run", "memory"])
+"""name identifies the candidate in saved results; run is a function of q, k, v; memory is a function of q, k, v that
+returns an estimate of how many bytes the candidate allocates on top of its inputs and output."""
+
+Result = namedtuple("Result", ["name", "seconds", "memory"])
+"""seconds is infinite for candidates that were not timed because they did not fit into the memory budget; memory is
+then the least amount of memory they are known to need."""
+
+
+def scores_bytes(batch, q_tokens, k_tokens, element_size):
+    return batch * q_tokens * k_tokens * element_size
+
+
+def attention(q, k, v):
+    s = torch.baddbmm(torch.empty(1, 1, 1, device=q.device, dtype=q.dtype), q, k.transpose(1, 2), beta=0, alpha=q.shape[-1] ** -0.5)
+    s = s.softmax(dim=-1)
+    return torch.bmm(s, v)
+
+
+def split_queries(q, k, v, slice_size):
+    r = torch.empty(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    for i in range(0, q.shape[1], slice_size):
+        r[:, i:i + slice_size] = attention(q[:, i:i + slice_size], k, v)
+    return r
+
+
+def split_batch(q, k, v, slice_size):
+    r = torch.empty(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    for i in range(0, q.shape[0], slice_size):
+        r[i:i + slice_size] = attention(q[i:i + slice_size], k[i:i + slice_size], v[i:i + slice_size])
+    return r
+
+
+def sub_quadratic(q, k, v, q_chunk_size, kv_chunk_size):
+    return sub_quadratic_attention.efficient_dot_product_attention(q, k, v, query_chunk_size=q_chunk_size, kv_chunk_size=kv_chunk_size, use_checkpoint=q.requires_grad)
+
+
+def scaled_dot_product(q, k, v):
+    return torch.nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=0.0, is_causal=False)
+
+
+def candidates_for(q, k, v):
+    """Returns candidates for inputs of this shape; chunked variants whose chunks would not split anything are left
+    out, as they are the same as computing everything at once."""
+
+    batch, q_tokens, _ = q.shape
+    k_tokens = k.shape[1]
+    element_size = q.element_size()
+
+    def full_memory(q, k, v):
+        return 2 * scores_bytes(batch, q_tokens, k_tokens, element_size)
+
+    res = [Candidate("full", attention, full_memory)]
+
+    for slice_size in (4096, 1024, 256):
+        if slice_size < q_tokens:
+            res.append(Candidate(f"split-queries-{slice_size}", lambda q, k, v, s=slice_size: split_queries(q, k, v, s), lambda q, k, v, s=slice_size: 2 * scores_bytes(batch, s, k_tokens, element_size)))
+
+    for slice_size in (1, 4, 16):
+        if slice_size < batch:
+            res.append(Candidate(f"split-batch-{slice_size}", lambda q, k, v, s=slice_size: split_batch(q, k, v, s), lambda q, k, v, s=slice_size: 2 * scores_bytes(s, q_tokens, k_tokens, element_size)))
+
+    for q_chunk_size in (512, 2048):
+        for kv_chunk_size in (512, 2048):
+            if q_chunk_size < q_tokens or kv_chunk_size < k_tokens:
+                res.append(Candidate(f"sub-quadratic-{q_chunk_size}-{kv_chunk_size}", lambda q, k, v, qc=q_chunk_size, kvc=kv_chunk_size: sub_quadratic(q, k, v, qc, kvc), lambda q, k, v, qc=q_chunk_size, kvc=kv_chunk_size: 3 * scores_bytes(batch, min(qc, q_tokens), min(kvc, k_tokens), element_size)))
+
+    if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        res.append(Candidate("sdp", scaled_dot_product, full_memory))
+
+    return res
+
+
+def is_out_of_memory(e):
+    """Returns True if exception e was raised because a device ran out of memory; on devices other than CUDA that is a
+    plain RuntimeError, recognized by its message."""
+
+    out_of_memory_error = getattr(torch.cuda, "OutOfMemoryError", None)
+    if out_of_memory_error is not None and isinstance(e, out_of_memory_error):
+        return True
+
+    return isinstance(e, RuntimeError) and "out of memory" in str(e).lower()
+
+
+def device_name(device):
+    if device.type == "cuda":
+        return torch.cuda.get_device_name(device)
+
+    return f"{device.type} {platform.processor() or platform.machine()}"
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+class AttentionAutotuner:
+    def __init__(self, budget, storage=None, repeats=3):
+        """budget is a function without arguments that returns how many bytes attention may use. storage is a
+        dict-like object for saved results; by default, a subsection of webui's cache is used."""
+
+        self.budget = budget
+        self.storage = storage
+        self.repeats = repeats
+        self.results = {}
+        self.candidates = {}
+        self.lock = threading.Lock()
+
+    def get_storage(self):
+        if self.storage is None:
+            from modules import cache
+
+            self.storage = cache.cache(subsection)
+
+        return self.storage
+
+    def key(self, q, k, v):
+        return f"{device_name(q.device)} torch {torch.__version__} {q.dtype} {q.shape[0]}x{q.shape[1]}x{k.shape[1]}x{q.shape[2]}"
+
+    def __call__(self, q, k, v):
+        candidate = self.select(q, k, v)
+        return candidate.run(q, k, v)
+
+    def select(self, q, k, v):
+        """Returns the candidate to compute attention for these inputs with; benchmarks candidates if this shape has
+        not been seen before, or if candidates that did not fit before fit into the current budget."""
+
+        key = self.key(q, k, v)
+        budget = self.budget()
+
+        results = self.results.get(key)
+        if results is None or any(math.isinf(result.seconds) and result.memory <= budget for result in results):
+            with self.lock:
+                results = self.results.get(key) or self.get_storage().get(key)
+                results = [Result(*x) for x in results] if results is not None else None
+
+                untimed = None if results is None else {result.name for result in results if math.isinf(result.seconds) and result.memory <= budget}
+                if results is None or untimed:
+                    measured = self.benchmark(q, k, v, untimed)
+                    measured_names = {result.name for result in measured}
+                    results = sorted([result for result in results or [] if result.name not in measured_names] + measured, key=lambda x: x.seconds)
+                    self.get_storage()[key] = [tuple(x) for x in results]
+
+                self.candidates[key] = {candidate.name: candidate for candidate in candidates_for(q, k, v)}
+                self.results[key] = results
+
+        candidates = self.candidates[key]
+
+        for result in results:
+            candidate = candidates.get(result.name)
+            if candidate is not None and result.memory <= budget:
+                return candidate
+
+        least_memory = min((result for result in results if result.name in candidates), key=lambda result: result.memory, default=None)
+        if least_memory is not None:
+            return candidates[least_memory.name]
+
+        return candidates["full"]
+
+    def benchmark(self, q, k, v, names=None):
+        """Times candidates (all of them, or only those in names) that fit into the memory budget on these inputs;
+        returns a list of Result for every candidate, fastest first. Candidates that don't fit get infinite time."""
+
+        budget = self.budget()
+        results = []
+
+        with torch.no_grad():
+            q, k, v = q.detach(), k.detach(), v.detach()
+
+            for candidate in candidates_for(q, k, v):
+                if names is not None and candidate.name not in names:
+                    continue
+
+                estimate = candidate.memory(q, k, v)
+                if estimate > budget:
+                    results.append(Result(candidate.name, math.inf, estimate))
+                    continue
+
+                try:
+                    seconds, measured = self.time_candidate(candidate, q, k, v)
+                except RuntimeError as e:
+                    if not is_out_of_memory(e):
+                        raise
+
+                    # it needs more than the budget, so it's tried again if the budget grows
+                    if q.device.type == "cuda":
+                        torch.cuda.empty_cache()
+
+                    results.append(Result(candidate.name, math.inf, max(estimate, budget + 1)))
+                    continue
+
+                results.append(Result(candidate.name, seconds, max(estimate, measured)))
+
+        return sorted(results, key=lambda x: x.seconds)
+
+    def time_candidate(self, candidate, q, k, v):
+        """Returns the best of self.repeats runs in seconds, and memory allocated while running on CUDA in bytes (0 on
+        other devices)."""
+
+        device = q.device
+        measured = 0
+
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+            allocated = torch.cuda.memory_allocated(device)
+
+        out = candidate.run(q, k, v)
+        synchronize(device)
+
+        if device.type == "cuda":
+            measured = torch.cuda.max_memory_allocated(device) - allocated - out.numel() * out.element_size()
+
+        del out
+
+        best = math.inf
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            candidate.run(q, k, v)
+            synchronize(device)
+            best = min(best, time.perf_counter() - start)
+
+        return best, measured
+
+
+def sd_attention_shapes(width=512, height=512, batch_size=1):
+    """Returns (batch * heads, q tokens, k tokens, channels) of self-attention and cross-attention layers of SD1's UNet,
+    with cond and uncond in one batch."""
+
+    batch = batch_size * 2 * 8
+    res = []
+    for level, channels in enumerate((40, 80, 160)):
+        tokens = (width // 8 >> level) * (height // 8 >> level)
+        res.append((batch, tokens, tokens, channels))
+        res.append((batch, tokens, 77, channels))
+
+    return res
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark attention implementations for shapes of SD1 attention layers.")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--budget-mb", type=int, default=4096, help="memory budget for attention, in MB")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    tuner = AttentionAutotuner(lambda: args.budget_mb * 1024 * 1024, storage={}, repeats=args.repeats)
+
+    for shape in sd_attention_shapes(args.width, args.height, args.batch_size):
+        batch, q_tokens, k_tokens, channels = shape
+        q = torch.randn(batch, q_tokens, channels, device=device, dtype=dtype)
+        k = torch.randn(batch, k_tokens, channels, device=device, dtype=dtype)
+        v = torch.randn(batch, k_tokens, channels, device=device, dtype=dtype)
+
+        selected = tuner.select(q, k, v)
+        results = tuner.results[tuner.key(q, k, v)]
+        baseline = next((x for x in results if x.name == "full"), None)
+
+        print(f"{'x'.join(map(str, shape))}: {selected.name}")
+        for result in results:
+            speedup = f" ({baseline.seconds / result.seconds:.2f}x)" if baseline and math.isfinite(baseline.seconds + result.seconds) else ""
+            print(f"  {result.name:24} {result.seconds * 1000:9.2f} ms{speedup} {result.memory / 1024 / 1024:9.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""Merging checkpoints one tensor at a time.
+
+Inputs in .safetensors format are memory-mapped and read tensor by tensor, in the order they are stored in the file.
+Each tensor is merged and written to the output right away, so memory use stays around the size of the largest tensor,
+rather than of several whole checkpoints. A .safetensors output starts with a header that lists dtypes and shapes of
+all tensors; to write it before any tensor is merged, the merge is first run on meta tensors, which have dtype and
+shape but no data.
+
+Several recipes, for example the same models merged with different multipliers, can be made in one pass over inputs.
+"""
+
+import json
+import os
+import re
+
+import safetensors
+import torch
+
+checkpoint_dict_skip_on_merge = ["cond_stage_model.transformer.text_model.embeddings.position_ids"]
+
+dtypes = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+for name, attr in (("F8_E4M3", "float8_e4m3fn"), ("F8_E5M2", "float8_e5m2")):
+    if hasattr(torch, attr):
+        dtypes[name] = getattr(torch, attr)
+
+dtype_names = {dtype: name for name, dtype in dtypes.items()}
+
+
+def to_half(tensor, enable):
+    if enable and tensor.dtype == torch.float:
+        return tensor.half()
+
+    return tensor
+
+
+def weighted_sum(theta0, theta1, alpha):
+    return ((1 - alpha) * theta0) + (alpha * theta1)
+
+
+def add_difference(theta0, theta1_2_diff, alpha):
+    return theta0 + (alpha * theta1_2_diff)
+
+
+class MergeRecipe:
+    def __init__(self, interp_method, multiplier, save_as_half=False, discard_weights="", vae_dict=None):
+        self.interp_method = interp_method
+        self.multiplier = multiplier
+        self.save_as_half = save_as_half
+        self.discard_weights = re.compile(discard_weights) if discard_weights else None
+        self.vae_dict = vae_dict
+
+        self.uses_secondary = interp_method in ("Weighted sum", "Add difference")
+        self.uses_tertiary = interp_method == "Add difference"
+        self.interp = add_difference if self.uses_tertiary else weighted_sum
+
+        self.is_inpainting = False
+        self.is_instruct_pix2pix = False
+
+        self.plan = None
+        """List of (key, meta tensor) pairs for tensors of the result, filled by plan()."""
+
+        self.output = None
+        """Where the result is written; set by the caller after plan() and before merge()."""
+
+    def merge_tensor(self, key, a, b=None, c=None):
+        """Returns the tensor for key in the result, or None if it's discarded. a, b and c are tensors for key from
+        models A, B and C; b and c are None if the model does not have the key."""
+
+        if self.discard_weights and re.search(self.discard_weights, key):
+            return None
+
+        if self.vae_dict is not None and key.startswith("first_stage_model."):
+            vae_tensor = self.vae_dict.get(key[len("first_stage_model."):])
+            if vae_tensor is not None:
+                return to_half(vae_tensor, self.save_as_half)
+
+        if not self.uses_secondary:
+            return to_half(a, self.save_as_half)
+
+        if b is None or 'model' not in key or key in checkpoint_dict_skip_on_merge:
+            return a
+
+        if self.uses_tertiary:
+            b = b - c if c is not None else torch.zeros_like(b)
+
+        # this enables merging an inpainting model (A) with another one (B);
+        # where normal model would have 4 channels, for latenst space, inpainting model would
+        # have another 4 channels for unmasked picture's latent space, plus one channel for mask, for a total of 9
+        if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
+            if a.shape[1] == 4 and b.shape[1] == 9:
+                raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
+            if a.shape[1] == 4 and b.shape[1] == 8:
+                raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
+
+            merged = a.clone()
+            if a.shape[1] == 8 and b.shape[1] == 4:  # If we have an Instruct-Pix2Pix model...
+                merged[:, 0:4, :, :] = self.interp(a[:, 0:4, :, :], b, self.multiplier)  # Merge only the vectors the models have in common.  Otherwise we get an error due to dimension mismatch.
+                self.is_instruct_pix2pix = True
+            else:
+                assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
+                merged[:, 0:4, :, :] = self.interp(a[:, 0:4, :, :], b, self.multiplier)
+                self.is_inpainting = True
+        else:
+            merged = self.interp(a, b, self.multiplier)
+
+        return to_half(merged, self.save_as_half)
+
+
+class SafetensorsInput:
+    """A memory-mapped .safetensors checkpoint, read one tensor at a time.
+
+    transform is a function that takes a state dict and returns it with keys renamed, like
+    sd_models.get_state_dict_from_checkpoint; it's called with meta tensors.
+    """
+
+    def __init__(self, filename, transform=None):
+        with open(filename, "rb") as file:
+            header_length = int.from_bytes(file.read(8), "little")
+            header = json.loads(file.read(header_length))
+
+        header.pop("__metadata__", None)
+
+        meta = {}
+        for key, info in sorted(header.items(), key=lambda x: x[1]["data_offsets"][0]):
+            meta[key] = torch.empty(info["shape"], dtype=dtypes[info["dtype"]], device="meta")
+
+        original_keys = {id(tensor): key for key, tensor in meta.items()}
+        if transform is not None:
+            meta = transform(meta)
+
+        self.meta = meta
+        self.original_keys = {key: original_keys[id(tensor)] for key, tensor in meta.items()}
+        self.file = safetensors.safe_open(filename, framework="pt", device="cpu")
+
+    def __contains__(self, key):
+        return key in self.meta
+
+    def get(self, key):
+        return self.file.get_tensor(self.original_keys[key])
+
+
+class StateDictInput:
+    """A checkpoint that is already loaded into memory."""
+
+    def __init__(self, state_dict):
+        self.state_dict = state_dict
+        self.meta = {key: tensor.to("meta") for key, tensor in state_dict.items()}
+
+    def __contains__(self, key):
+        return key in self.state_dict
+
+    def get(self, key):
+        return self.state_dict[key]
+
+
+class SafetensorsOutput:
+    """A .safetensors file written one tensor at a time, in the order of tensors in plan.
+
+    The file is written under a temporary name and renamed when finished.
+    """
+
+    def __init__(self, filename, plan, metadata=None):
+        header = {}
+        offset = 0
+        for key, tensor in plan:
+            size = tensor.numel() * tensor.element_size()
+            header[key] = {"dtype": dtype_names[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + size]}
+            offset += size
+
+        if metadata:
+            header["__metadata__"] = {k: v if isinstance(v, str) else json.dumps(v) for k, v in metadata.items()}
+
+        data = json.dumps(header, separators=(",", ":")).encode("utf8")
+        data += b" " * (-len(data) % 8)
+
+        self.filename = filename
+        self.temporary_filename = f"{filename}.tmp"
+        self.expected = iter(plan)
+
+        self.file = open(self.temporary_filename, "wb")
+        self.file.write(len(data).to_bytes(8, "little"))
+        self.file.write(data)
+
+    def write(self, key, tensor):
+        expected_key, expected = next(self.expected)
+        assert key == expected_key and tensor.dtype == expected.dtype and tensor.shape == expected.shape, f"Unexpected tensor for {key}: {tensor.dtype} {tuple(tensor.shape)}"
+
+        self.file.write(tensor.detach().contiguous().reshape(-1).view(torch.uint8).numpy())
+
+    def finish(self):
+        self.file.close()
+        os.replace(self.temporary_filename, self.filename)
+
+    def abort(self):
+        self.file.close()
+
+        if os.path.exists(self.temporary_filename):
+            os.remove(self.temporary_filename)
+
+
+class StateDictOutput:
+    """A checkpoint in pickle format: tensors are collected in memory and saved with torch.save when finished."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.state_dict = {}
+
+    def write(self, key, tensor):
+        self.state_dict[key] = tensor
+
+    def finish(self):
+        torch.save(self.state_dict, self.filename)
+        self.state_dict = {}
+
+    def abort(self):
+        self.state_dict = {}
+
+
+def tensors_for_key(key, primary, secondary, tertiary, get):
+    a = get(primary, key)
+
+    b = c = None
+    if 'model' in key and key not in checkpoint_dict_skip_on_merge:
+        if secondary is not None and key in secondary:
+            b = get(secondary, key)
+
+            if tertiary is not None and key in tertiary:
+                c = get(tertiary, key)
+
+    return a, b, c
+
+
+def plan(recipe, primary, secondary=None, tertiary=None):
+    """Works out which tensors the result of recipe has, and sets recipe.plan, recipe.is_inpainting and
+    recipe.is_instruct_pix2pix, without reading any tensor data. Raises an error if models can't be merged."""
+
+    recipe.plan = []
+
+    for key in primary.meta:
+        a, b, c = tensors_for_key(key, primary, secondary, tertiary, lambda model, k: model.meta[k])
+
+        tensor = recipe.merge_tensor(key, a, b, c)
+        if tensor is not None:
+            recipe.plan.append((key, tensor.to("meta")))
+
+    return recipe.plan
+
+
+def merge(recipes, primary, secondary=None, tertiary=None, progress=None):
+    """Merges models for all recipes in one pass over keys of primary model, and writes results to recipe.output of
+    each recipe. Tensors are read from inputs only once, however many recipes there are.
+
+    progress is called without arguments after each key."""
+
+    needs_secondary = any(recipe.uses_secondary for recipe in recipes)
+    needs_tertiary = any(recipe.uses_tertiary for recipe in recipes)
+
+    try:
+        for key in primary.meta:
+            a, b, c = tensors_for_key(key, primary, secondary if needs_secondary else None, tertiary if needs_tertiary else None, lambda model, k: model.get(k))
+
+            for recipe in recipes:
+                tensor = recipe.merge_tensor(key, a, b, c)
+                if tensor is not None:
+                    recipe.output.write(key, tensor)
+
+            del a, b, c
+
+            if progress is not None:
+                progress()
+
+        for recipe in recipes:
+            recipe.output.finish()
+    except BaseException:
+        for recipe in recipes:
+            recipe.output.abort()
+
+        raise
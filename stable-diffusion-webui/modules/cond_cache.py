@@ -0,0 +1,176 @@
+"""Process-wide cache of text conditioning produced by the text encoder.
+
+Conditioning is cached per group of texts passed to the model's get_learned_conditioning - in webui that's the
+prompt editing schedule of one prompt (or of one AND-separated part of it), which for most prompts is just one text.
+Keys include everything besides the texts that changes the result: the checkpoint, values of all options in
+encoder_options and whatever callbacks in key_callbacks return (Lora uses this to add networks that modify the text
+encoder).
+"""
+
+import collections
+import threading
+
+import torch
+
+from modules import devices, shared
+
+key_callbacks = []
+"""Functions without arguments that return a hashable value describing extra state that affects text encoder output."""
+
+encoder_options = [
+    "CLIP_stop_at_last_layers",
+    "emphasis",
+    "use_old_emphasis_implementation",
+    "comma_padding_backtrack",
+    "sdxl_clip_l_skip",
+    "sd3_enable_t5",
+    "textual_inversion_add_hashes_to_infotext",
+    "sdxl_crop_left",
+    "sdxl_crop_top",
+    "sdxl_refiner_low_aesthetic_score",
+    "sdxl_refiner_high_aesthetic_score",
+    "fp8_storage",
+    "cache_fp16_weight",
+]
+"""Names of options that sd_hijack and text encoders read when making conditioning."""
+
+
+def tensors_size(value):
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    if isinstance(value, dict):
+        return sum(tensors_size(x) for x in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensors_size(x) for x in value)
+
+    return 0
+
+
+class ConditioningCache:
+    """An LRU cache of conditioning, limited by total size of tensors in it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, limit):
+        size = tensors_size(value)
+        if size > limit:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+            self.purge_locked(limit)
+
+    def purge(self, limit):
+        with self.lock:
+            self.purge_locked(limit)
+
+    def purge_locked(self, limit):
+        while self.entries and self.size > limit:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size_mb": self.size / 1024 / 1024,
+                "limit_mb": shared.opts.cond_cache_mb,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+cache = ConditioningCache()
+
+
+def clear(*args):
+    """Removes everything from the cache. Accepts and ignores arguments so that it can be used as a callback."""
+
+    cache.clear()
+
+
+def state_key(model):
+    checkpoint_info = getattr(model, 'sd_checkpoint_info', None)
+
+    return (
+        getattr(checkpoint_info, 'filename', None),
+        getattr(model, 'sd_model_hash', None),
+        str(devices.dtype),
+        tuple(getattr(shared.opts, name, None) for name in encoder_options),
+        tuple(callback() for callback in key_callbacks),
+    )
+
+
+def merge_generation_params(params, added):
+    for key, value in added.items():
+        if key == "TI hashes" and params.get(key):
+            value = f"{value}, {params[key]}"
+
+        params[key] = value
+
+
+def get_learned_conditioning(model, texts):
+    """Returns model.get_learned_conditioning(texts), taking it from cache if the same texts were encoded before in the same state.
+
+    Infotext parameters that the text encoder adds to model_hijack.extra_generation_params (such as TI hashes) are stored
+    along with the conditioning and added again when the conditioning is taken from cache.
+    """
+
+    from modules.sd_hijack import model_hijack
+
+    limit = int(shared.opts.cond_cache_mb * 1024 * 1024)
+    if limit <= 0:
+        return model.get_learned_conditioning(texts)
+
+    key = (
+        state_key(model),
+        tuple(texts),
+        getattr(texts, 'is_negative_prompt', False),
+        getattr(texts, 'width', None),
+        getattr(texts, 'height', None),
+    )
+
+    cached = cache.get(key)
+    if cached is not None:
+        conds, added_params = cached
+        merge_generation_params(model_hijack.extra_generation_params, added_params)
+        return conds
+
+    params = model_hijack.extra_generation_params
+    model_hijack.extra_generation_params = {}
+    try:
+        conds = model.get_learned_conditioning(texts)
+        added_params = model_hijack.extra_generation_params
+    finally:
+        model_hijack.extra_generation_params = params
+
+    merge_generation_params(params, added_params)
+    cache.put(key, (conds, added_params), limit)
+
+    return conds
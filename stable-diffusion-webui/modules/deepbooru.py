@@ -46,20 +46,34 @@ class DeepDanbooru:
 
         return res
 
+    def preprocess(self, pil_image):
+        """Prepares an image for the model; returns a 512x512x3 float32 array."""
+
+        pic = images.resize_image(2, pil_image.convert("RGB"), 512, 512)
+        return np.array(pic, dtype=np.float32) / 255
+
     def tag_multi(self, pil_image, force_disable_ranks=False):
+        return self.tag_batch([self.preprocess(pil_image)], force_disable_ranks)[0]
+
+    def tag_batch(self, arrays, force_disable_ranks=False):
+        """Tags a batch of images prepared with preprocess in one forward pass; returns a list of prompts.
+
+        The model must be on the device (see start()).
+        """
+
+        with torch.no_grad(), devices.autocast():
+            x = torch.from_numpy(np.stack(arrays)).to(devices.device, devices.dtype)
+            y = self.model(x).detach().cpu().numpy()
+
+        return [self.format_tags(probabilities, force_disable_ranks) for probabilities in y]
+
+    def format_tags(self, y, force_disable_ranks=False):
         threshold = shared.opts.interrogate_deepbooru_score_threshold
         use_spaces = shared.opts.deepbooru_use_spaces
         use_escape = shared.opts.deepbooru_escape
         alpha_sort = shared.opts.deepbooru_sort_alpha
         include_ranks = shared.opts.interrogate_return_ranks and not force_disable_ranks
 
-        pic = images.resize_image(2, pil_image.convert("RGB"), 512, 512)
-        a = np.expand_dims(np.array(pic, dtype=np.float32), 0) / 255
-
-        with torch.no_grad(), devices.autocast():
-            x = torch.from_numpy(a).to(devices.device, devices.dtype)
-            y = self.model(x)[0].detach().cpu().numpy()
-
         probability_dict = {}
 
         for tag, probability in zip(self.model.tags, y):
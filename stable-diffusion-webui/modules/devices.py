@@ -92,6 +92,18 @@ def torch_gc():
         npu_specific.torch_npu_gc()
 
 
+def batch_size_for_free_memory(device, item_memory, max_batch_size):
+    """Returns how many items that need item_memory bytes each fit into 80% of free memory of a CUDA device.
+
+    Memory that torch has reserved but not allocated counts as free. The result is between 1 and max_batch_size.
+    """
+
+    free, _ = torch.cuda.mem_get_info(device)
+    free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+    return int(max(1, min(max_batch_size, free * 0.8 // max(item_memory, 1))))
+
+
 def torch_npu_set_device():
     # Work around due to bug in torch_npu, revert me after fixed, @see https://gitee.com/ascend/pytorch/issues/I8KECW?from=project-issue
     if npu_specific.has_npu:
@@ -265,6 +277,17 @@ def test_for_nans(x, where):
     raise NansException(message)
 
 
+def has_nans(x, where):
+    """Same as test_for_nans, but returns True instead of raising an exception."""
+
+    try:
+        test_for_nans(x, where)
+    except NansException:
+        return True
+
+    return False
+
+
 @lru_cache
 def first_time_calculation():
     """
@@ -1,3 +1,4 @@
+import functools
 import json
 import os
 import re
@@ -175,19 +176,27 @@ def deactivate(p, extra_network_data):
 re_extra_net = re.compile(r"<(\w+):([^>]+)>")
 
 
-def parse_prompt(prompt):
-    res = defaultdict(list)
+@functools.lru_cache(maxsize=4096)
+def parse_prompt_cached(prompt):
+    found_networks = []
 
     def found(m):
-        name = m.group(1)
-        args = m.group(2)
-
-        res[name].append(ExtraNetworkParams(items=args.split(":")))
+        found_networks.append((m.group(1), tuple(m.group(2).split(":"))))
 
         return ""
 
     prompt = re.sub(re_extra_net, found, prompt)
 
+    return prompt, tuple(found_networks)
+
+
+def parse_prompt(prompt):
+    res = defaultdict(list)
+
+    prompt, found_networks = parse_prompt_cached(prompt)
+    for name, items in found_networks:
+        res[name].append(ExtraNetworkParams(items=list(items)))
+
     return prompt, res
 
 
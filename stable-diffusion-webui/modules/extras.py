@@ -1,16 +1,14 @@
 import os
-import re
 import shutil
 import json
 
 
-import torch
 import tqdm
 
-from modules import shared, images, sd_models, sd_vae, sd_models_config, errors
+from modules import shared, images, sd_models, sd_vae, sd_models_config, errors, checkpoint_merger
+from modules.checkpoint_merger import checkpoint_dict_skip_on_merge, to_half  # noqa: F401
 from modules.ui_common import plaintext_to_html
 import gradio as gr
-import safetensors.torch
 
 
 def run_pnginfo(image):
@@ -62,16 +60,6 @@ def create_config(ckpt_result, config_source, a, b, c):
     shutil.copyfile(cfg, checkpoint_filename)
 
 
-checkpoint_dict_skip_on_merge = ["cond_stage_model.transformer.text_model.embeddings.position_ids"]
-
-
-def to_half(tensor, enable):
-    if enable and tensor.dtype == torch.float:
-        return tensor.half()
-
-    return tensor
-
-
 def read_metadata(primary_model_name, secondary_model_name, tertiary_model_name):
     metadata = {}
 
@@ -85,7 +73,15 @@ def read_metadata(primary_model_name, secondary_model_name, tertiary_model_name)
     return json.dumps(metadata, indent=4, ensure_ascii=False)
 
 
-def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_model_name, interp_method, multiplier, save_as_half, custom_name, checkpoint_format, config_source, bake_in_vae, discard_weights, save_metadata, add_merge_recipe, copy_metadata_fields, metadata_json):
+def open_checkpoint(checkpoint_info):
+    _, extension = os.path.splitext(checkpoint_info.filename)
+    if extension.lower() == ".safetensors":
+        return checkpoint_merger.SafetensorsInput(checkpoint_info.filename, transform=sd_models.get_state_dict_from_checkpoint)
+
+    return checkpoint_merger.StateDictInput(sd_models.read_state_dict(checkpoint_info.filename, map_location='cpu'))
+
+
+def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_model_name, interp_method, multiplier, save_as_half, custom_name, checkpoint_format, config_source, bake_in_vae, discard_weights, save_metadata, add_merge_recipe, copy_metadata_fields, metadata_json, extra_multipliers=""):
     shared.state.begin(job="model-merge")
 
     def fail(message):
@@ -93,16 +89,7 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         shared.state.end()
         return [*[gr.update() for _ in range(4)], message]
 
-    def weighted_sum(theta0, theta1, alpha):
-        return ((1 - alpha) * theta0) + (alpha * theta1)
-
-    def get_difference(theta1, theta2):
-        return theta1 - theta2
-
-    def add_difference(theta0, theta1_2_diff, alpha):
-        return theta0 + (alpha * theta1_2_diff)
-
-    def filename_weighted_sum():
+    def filename_weighted_sum(multiplier):
         a = primary_model_info.model_name
         b = secondary_model_info.model_name
         Ma = round(1 - multiplier, 2)
@@ -110,7 +97,7 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
 
         return f"{Ma}({a}) + {Mb}({b})"
 
-    def filename_add_difference():
+    def filename_add_difference(multiplier):
         a = primary_model_info.model_name
         b = secondary_model_info.model_name
         c = tertiary_model_info.model_name
@@ -118,141 +105,69 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
 
         return f"{a} + {M}({b} - {c})"
 
-    def filename_nothing():
+    def filename_nothing(multiplier):
         return primary_model_info.model_name
 
-    theta_funcs = {
-        "Weighted sum": (filename_weighted_sum, None, weighted_sum),
-        "Add difference": (filename_add_difference, get_difference, add_difference),
-        "No interpolation": (filename_nothing, None, None),
+    filename_generators = {
+        "Weighted sum": filename_weighted_sum,
+        "Add difference": filename_add_difference,
+        "No interpolation": filename_nothing,
     }
-    filename_generator, theta_func1, theta_func2 = theta_funcs[interp_method]
-    shared.state.job_count = (1 if theta_func1 else 0) + (1 if theta_func2 else 0)
+    filename_generator = filename_generators[interp_method]
+    method = checkpoint_merger.MergeRecipe(interp_method, multiplier)
+    shared.state.job_count = 1
 
     if not primary_model_name:
         return fail("Failed: Merging requires a primary model.")
 
     primary_model_info = sd_models.checkpoints_list[primary_model_name]
 
-    if theta_func2 and not secondary_model_name:
+    if method.uses_secondary and not secondary_model_name:
         return fail("Failed: Merging requires a secondary model.")
 
-    secondary_model_info = sd_models.checkpoints_list[secondary_model_name] if theta_func2 else None
+    secondary_model_info = sd_models.checkpoints_list[secondary_model_name] if method.uses_secondary else None
 
-    if theta_func1 and not tertiary_model_name:
+    if method.uses_tertiary and not tertiary_model_name:
         return fail(f"Failed: Interpolation method ({interp_method}) requires a tertiary model.")
 
-    tertiary_model_info = sd_models.checkpoints_list[tertiary_model_name] if theta_func1 else None
-
-    result_is_inpainting_model = False
-    result_is_instruct_pix2pix_model = False
-
-    if theta_func2:
-        shared.state.textinfo = "Loading B"
-        print(f"Loading {secondary_model_info.filename}...")
-        theta_1 = sd_models.read_state_dict(secondary_model_info.filename, map_location='cpu')
-    else:
-        theta_1 = None
-
-    if theta_func1:
-        shared.state.textinfo = "Loading C"
-        print(f"Loading {tertiary_model_info.filename}...")
-        theta_2 = sd_models.read_state_dict(tertiary_model_info.filename, map_location='cpu')
-
-        shared.state.textinfo = 'Merging B and C'
-        shared.state.sampling_steps = len(theta_1.keys())
-        for key in tqdm.tqdm(theta_1.keys()):
-            if key in checkpoint_dict_skip_on_merge:
-                continue
-
-            if 'model' in key:
-                if key in theta_2:
-                    t2 = theta_2.get(key, torch.zeros_like(theta_1[key]))
-                    theta_1[key] = theta_func1(theta_1[key], t2)
-                else:
-                    theta_1[key] = torch.zeros_like(theta_1[key])
-
-            shared.state.sampling_step += 1
-        del theta_2
-
-        shared.state.nextjob()
-
-    shared.state.textinfo = f"Loading {primary_model_info.filename}..."
-    print(f"Loading {primary_model_info.filename}...")
-    theta_0 = sd_models.read_state_dict(primary_model_info.filename, map_location='cpu')
-
-    print("Merging...")
-    shared.state.textinfo = 'Merging A and B'
-    shared.state.sampling_steps = len(theta_0.keys())
-    for key in tqdm.tqdm(theta_0.keys()):
-        if theta_1 and 'model' in key and key in theta_1:
+    tertiary_model_info = sd_models.checkpoints_list[tertiary_model_name] if method.uses_tertiary else None
 
-            if key in checkpoint_dict_skip_on_merge:
-                continue
-
-            a = theta_0[key]
-            b = theta_1[key]
-
-            # this enables merging an inpainting model (A) with another one (B);
-            # where normal model would have 4 channels, for latenst space, inpainting model would
-            # have another 4 channels for unmasked picture's latent space, plus one channel for mask, for a total of 9
-            if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
-                if a.shape[1] == 4 and b.shape[1] == 9:
-                    raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
-                if a.shape[1] == 4 and b.shape[1] == 8:
-                    raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
-
-                if a.shape[1] == 8 and b.shape[1] == 4:#If we have an Instruct-Pix2Pix model...
-                    theta_0[key][:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)#Merge only the vectors the models have in common.  Otherwise we get an error due to dimension mismatch.
-                    result_is_instruct_pix2pix_model = True
-                else:
-                    assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
-                    theta_0[key][:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)
-                    result_is_inpainting_model = True
-            else:
-                theta_0[key] = theta_func2(a, b, multiplier)
-
-            theta_0[key] = to_half(theta_0[key], save_as_half)
-
-        shared.state.sampling_step += 1
+    multipliers = [multiplier]
+    if method.uses_secondary and extra_multipliers:
+        try:
+            multipliers += [float(x) for x in extra_multipliers.split(",") if x.strip()]
+        except ValueError:
+            return fail(f"Failed: Can't parse additional multipliers: {extra_multipliers}")
 
-    del theta_1
+    multipliers = list(dict.fromkeys(multipliers))
 
+    vae_dict = None
     bake_in_vae_filename = sd_vae.vae_dict.get(bake_in_vae, None)
     if bake_in_vae_filename is not None:
         print(f"Baking in VAE from {bake_in_vae_filename}")
-        shared.state.textinfo = 'Baking in VAE'
+        shared.state.textinfo = 'Loading VAE'
         vae_dict = sd_vae.load_vae_dict(bake_in_vae_filename, map_location='cpu')
 
-        for key in vae_dict.keys():
-            theta_0_key = 'first_stage_model.' + key
-            if theta_0_key in theta_0:
-                theta_0[theta_0_key] = to_half(vae_dict[key], save_as_half)
-
-        del vae_dict
-
-    if save_as_half and not theta_func2:
-        for key in theta_0.keys():
-            theta_0[key] = to_half(theta_0[key], save_as_half)
+    recipes = [checkpoint_merger.MergeRecipe(interp_method, m, save_as_half, discard_weights, vae_dict) for m in multipliers]
 
-    if discard_weights:
-        regex = re.compile(discard_weights)
-        for key in list(theta_0):
-            if re.search(regex, key):
-                theta_0.pop(key, None)
-
-    ckpt_dir = shared.cmd_opts.ckpt_dir or sd_models.model_path
+    shared.state.textinfo = f"Loading {primary_model_info.filename}..."
+    print(f"Loading {primary_model_info.filename}...")
+    primary = open_checkpoint(primary_model_info)
 
-    filename = filename_generator() if custom_name == '' else custom_name
-    filename += ".inpainting" if result_is_inpainting_model else ""
-    filename += ".instruct-pix2pix" if result_is_instruct_pix2pix_model else ""
-    filename += "." + checkpoint_format
+    secondary = None
+    if secondary_model_info:
+        shared.state.textinfo = "Loading B"
+        print(f"Loading {secondary_model_info.filename}...")
+        secondary = open_checkpoint(secondary_model_info)
 
-    output_modelname = os.path.join(ckpt_dir, filename)
+    tertiary = None
+    if tertiary_model_info:
+        shared.state.textinfo = "Loading C"
+        print(f"Loading {tertiary_model_info.filename}...")
+        tertiary = open_checkpoint(tertiary_model_info)
 
-    shared.state.nextjob()
-    shared.state.textinfo = "Saving"
-    print(f"Saving to {output_modelname}...")
+    for recipe in recipes:
+        checkpoint_merger.plan(recipe, primary, secondary, tertiary)
 
     metadata = {}
 
@@ -272,25 +187,9 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
 
         metadata["format"] = "pt"
 
-    if save_metadata and add_merge_recipe:
-        merge_recipe = {
-            "type": "webui", # indicate this model was merged with webui's built-in merger
-            "primary_model_hash": primary_model_info.sha256,
-            "secondary_model_hash": secondary_model_info.sha256 if secondary_model_info else None,
-            "tertiary_model_hash": tertiary_model_info.sha256 if tertiary_model_info else None,
-            "interp_method": interp_method,
-            "multiplier": multiplier,
-            "save_as_half": save_as_half,
-            "custom_name": custom_name,
-            "config_source": config_source,
-            "bake_in_vae": bake_in_vae,
-            "discard_weights": discard_weights,
-            "is_inpainting": result_is_inpainting_model,
-            "is_instruct_pix2pix": result_is_instruct_pix2pix_model
-        }
-
-        sd_merge_models = {}
+    sd_merge_models = {}
 
+    if save_metadata and add_merge_recipe:
         def add_model_metadata(checkpoint_info):
             checkpoint_info.calculate_shorthash()
             sd_merge_models[checkpoint_info.sha256] = {
@@ -307,24 +206,73 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         if tertiary_model_info:
             add_model_metadata(tertiary_model_info)
 
-        metadata["sd_merge_recipe"] = json.dumps(merge_recipe)
-        metadata["sd_merge_models"] = json.dumps(sd_merge_models)
+    ckpt_dir = shared.cmd_opts.ckpt_dir or sd_models.model_path
+    filenames = []
+    output_modelnames = []
+
+    for recipe in recipes:
+        filename = filename_generator(recipe.multiplier) if custom_name == '' else custom_name
+        filename += f"-{round(recipe.multiplier, 2)}" if custom_name != '' and len(recipes) > 1 else ""
+        filename += ".inpainting" if recipe.is_inpainting else ""
+        filename += ".instruct-pix2pix" if recipe.is_instruct_pix2pix else ""
+        filename += "." + checkpoint_format
+
+        output_modelname = os.path.join(ckpt_dir, filename)
+        filenames.append(filename)
+        output_modelnames.append(output_modelname)
+
+        recipe_metadata = dict(metadata)
+
+        if save_metadata and add_merge_recipe:
+            merge_recipe = {
+                "type": "webui", # indicate this model was merged with webui's built-in merger
+                "primary_model_hash": primary_model_info.sha256,
+                "secondary_model_hash": secondary_model_info.sha256 if secondary_model_info else None,
+                "tertiary_model_hash": tertiary_model_info.sha256 if tertiary_model_info else None,
+                "interp_method": interp_method,
+                "multiplier": recipe.multiplier,
+                "save_as_half": save_as_half,
+                "custom_name": custom_name,
+                "config_source": config_source,
+                "bake_in_vae": bake_in_vae,
+                "discard_weights": discard_weights,
+                "is_inpainting": recipe.is_inpainting,
+                "is_instruct_pix2pix": recipe.is_instruct_pix2pix
+            }
 
-    _, extension = os.path.splitext(output_modelname)
-    if extension.lower() == ".safetensors":
-        safetensors.torch.save_file(theta_0, output_modelname, metadata=metadata if len(metadata)>0 else None)
-    else:
-        torch.save(theta_0, output_modelname)
+            recipe_metadata["sd_merge_recipe"] = json.dumps(merge_recipe)
+            recipe_metadata["sd_merge_models"] = json.dumps(sd_merge_models)
+
+        _, extension = os.path.splitext(output_modelname)
+        if extension.lower() == ".safetensors":
+            recipe.output = checkpoint_merger.SafetensorsOutput(output_modelname, recipe.plan, metadata=recipe_metadata)
+        else:
+            recipe.output = checkpoint_merger.StateDictOutput(output_modelname)
+
+    print(f"Merging into {', '.join(output_modelnames)}...")
+    shared.state.textinfo = 'Merging'
+    shared.state.sampling_steps = len(primary.meta)
+
+    with tqdm.tqdm(total=len(primary.meta)) as pbar:
+        def progress():
+            pbar.update()
+            shared.state.sampling_step += 1
+
+        checkpoint_merger.merge(recipes, primary, secondary, tertiary, progress=progress)
+
+    del primary, secondary, tertiary, vae_dict
 
     sd_models.list_models()
-    created_model = next((ckpt for ckpt in sd_models.checkpoints_list.values() if ckpt.name == filename), None)
-    if created_model:
-        created_model.calculate_shorthash()
+    for filename, output_modelname in zip(filenames, output_modelnames):
+        created_model = next((ckpt for ckpt in sd_models.checkpoints_list.values() if ckpt.name == filename), None)
+        if created_model:
+            created_model.calculate_shorthash()
+
+        create_config(output_modelname, config_source, primary_model_info, secondary_model_info, tertiary_model_info)
 
-    create_config(output_modelname, config_source, primary_model_info, secondary_model_info, tertiary_model_info)
+        print(f"Checkpoint saved to {output_modelname}.")
 
-    print(f"Checkpoint saved to {output_modelname}.")
     shared.state.textinfo = "Checkpoint saved"
     shared.state.end()
 
-    return [*[gr.Dropdown.update(choices=sd_models.checkpoint_tiles()) for _ in range(4)], "Checkpoint saved to " + output_modelname]
+    return [*[gr.Dropdown.update(choices=sd_models.checkpoint_tiles()) for _ in range(4)], "Checkpoint saved to " + ", ".join(output_modelnames)]
@@ -1,37 +1,120 @@
 import threading
 import collections
+import time
+
+
+class PendingAcquire(object):
+    def __init__(self, key):
+        self.key = key
+        self.event = threading.Event()
+        self.head_since = None
 
 
 # reference: https://gist.github.com/vitaliyp/6d54dd76ca2c3cdfc1149d33007dc34a
 class FIFOLock(object):
+    """A lock that hands itself over to waiting threads in the order they started waiting.
+
+    Callers may pass a key (for example, checkpoint + VAE + LoRA set) to acquire(). When max_delay is not None,
+    the queue is reordered on release: a waiter with the same key as the job that just ran is preferred over the
+    head of the queue, as long as that waiter got to the head of the queue less than max_delay seconds ago. Waiters
+    without a key are never moved ahead of others, and since nothing is known about what they load, they reset the
+    last key.
+    """
+
     def __init__(self):
         self._lock = threading.Lock()
         self._inner_lock = threading.Lock()
         self._pending_threads = collections.deque()
 
-    def acquire(self, blocking=True):
+        self.max_delay = None
+        self.last_key = None
+        self.swaps = 0
+        self.swaps_saved = 0
+
+    def acquire(self, blocking=True, key=None):
         with self._inner_lock:
             lock_acquired = self._lock.acquire(False)
             if lock_acquired:
+                self._record_key(key)
                 return True
             elif not blocking:
                 return False
 
-            release_event = threading.Event()
-            self._pending_threads.append(release_event)
+            pending = PendingAcquire(key)
+            self._pending_threads.append(pending)
+            self._mark_head()
 
-        release_event.wait()
-        return self._lock.acquire()
+        # the lock is handed over to us by release() without being unlocked, so nobody can cut in line
+        pending.event.wait()
+        return True
 
     def release(self):
         with self._inner_lock:
             if self._pending_threads:
-                release_event = self._pending_threads.popleft()
-                release_event.set()
+                pending = self._pick_next()
+                self._mark_head()
+                self._record_key(pending.key)
+                pending.event.set()
+            else:
+                self._lock.release()
+
+    def _pick_next(self):
+        head = self._pending_threads[0]
+
+        if self.max_delay is None or self.last_key is None or head.key is None or head.key == self.last_key:
+            return self._pending_threads.popleft()
+
+        if time.monotonic() - head.head_since >= self.max_delay:
+            return self._pending_threads.popleft()
+
+        for pending in self._pending_threads:
+            if pending.key == self.last_key:
+                self._pending_threads.remove(pending)
+                self.swaps_saved += 1
+                return pending
+
+        return self._pending_threads.popleft()
+
+    def _mark_head(self):
+        """Records when the first waiter got to the head of the queue; max_delay is counted from then."""
 
-            self._lock.release()
+        if self._pending_threads and self._pending_threads[0].head_since is None:
+            self._pending_threads[0].head_since = time.monotonic()
+
+    def _record_key(self, key):
+        if key is not None and self.last_key is not None and key != self.last_key:
+            self.swaps += 1
+
+        self.last_key = key
+
+    def scheduled(self, key):
+        """Returns a context manager that acquires the lock with the specified scheduling key."""
+
+        return ScheduledAcquire(self, key)
+
+    def stats(self):
+        with self._inner_lock:
+            return {
+                "pending": len(self._pending_threads),
+                "grouping": self.max_delay is not None,
+                "max_delay": self.max_delay,
+                "swaps": self.swaps,
+                "swaps_saved": self.swaps_saved,
+            }
 
     __enter__ = acquire
 
     def __exit__(self, t, v, tb):
         self.release()
+
+
+class ScheduledAcquire(object):
+    def __init__(self, lock, key):
+        self.lock = lock
+        self.key = key
+
+    def __enter__(self):
+        return self.lock.acquire(key=self.key)
+
+    def __exit__(self, t, v, tb):
+        self.lock.release()
@@ -1,5 +1,7 @@
+import concurrent.futures
 import hashlib
 import os.path
+import threading
 
 from modules import shared
 import modules.cache
@@ -7,39 +9,225 @@ import modules.cache
 dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
+hash_block_size = 8 * 1024 * 1024
+thread_data = threading.local()
 
-def calculate_sha256(filename):
-    hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+def get_hash_buffer():
+    """Returns a buffer for reading files for hashing; one per thread so that it's reused across files."""
+
+    buffer = getattr(thread_data, "buffer", None)
+    if buffer is None:
+        buffer = thread_data.buffer = memoryview(bytearray(hash_block_size))
+
+    return buffer
+
+
+def hash_file_contents(f, hash_sha256, progress=None):
+    """Feeds everything from the current position to the end of file f into hash_sha256, and returns the hex digest."""
+
+    buffer = get_hash_buffer()
+    while True:
+        n = f.readinto(buffer)
+        if not n:
+            break
+
+        hash_sha256.update(buffer[:n])
+        if progress is not None:
+            progress(n)
 
     return hash_sha256.hexdigest()
 
 
+def calculate_sha256(filename, progress=None):
+    with open(filename, "rb", buffering=0) as f:
+        return hash_file_contents(f, hashlib.sha256(), progress)
+
+
+def file_identity(filename):
+    """Returns a value that changes if the file is modified or replaced by another file: [inode, size, mtime in ns]."""
+
+    stat = os.stat(filename)
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
 def sha256_from_cache(filename, title, use_addnet_hash=False):
     hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
     try:
-        ondisk_mtime = os.path.getmtime(filename)
+        identity = file_identity(filename)
     except FileNotFoundError:
         return None
 
     if title not in hashes:
         return None
 
-    cached_sha256 = hashes[title].get("sha256", None)
-    cached_mtime = hashes[title].get("mtime", 0)
+    entry = hashes[title]
+    cached_sha256 = entry.get("sha256", None)
+    if cached_sha256 is None:
+        return None
+
+    cached_identity = entry.get("identity", None)
+    if cached_identity is not None:
+        return cached_sha256 if cached_identity == identity else None
 
-    if ondisk_mtime > cached_mtime or cached_sha256 is None:
+    # entries written by older versions only have mtime; upgrade them if they are still valid
+    if identity[2] / 1e9 > entry.get("mtime", 0):
         return None
 
+    hashes[title] = {**entry, "identity": identity}
+
     return cached_sha256
 
 
-def sha256(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+class HashingJob:
+    def __init__(self, filename, title, use_addnet_hash):
+        self.filename = filename
+        self.title = title
+        self.use_addnet_hash = use_addnet_hash
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.running = False
+        self.future = concurrent.futures.Future()
+
+    def add_progress(self, n):
+        self.bytes_done += n
+
+
+class HashingService:
+    """Calculates hashes of files on a pool of worker threads.
+
+    Requests for a file that is already being hashed share the same job, so a model that is hashed in background
+    and then requested by model loading is only read once. A request that waits for the hash (calculate) does not
+    queue behind background jobs: it hashes the file on the calling thread, unless a worker has already started it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.jobs = {}
+        self.done = 0
+        self.failed = 0
+
+    def submit(self, filename, title, use_addnet_hash=False, callback=None) -> concurrent.futures.Future:
+        """Starts calculating the hash unless it's already being calculated. Returns a future with sha256 hex digest.
+
+        If callback is specified, it's called with the hash from a worker thread when it's ready.
+        """
+
+        key = (title, use_addnet_hash)
+
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                if self.executor is None:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(int(shared.opts.hashing_workers), 1), thread_name_prefix="hashing")
+
+                job = HashingJob(filename, title, use_addnet_hash)
+                self.jobs[key] = job
+                self.executor.submit(self.run, job)
+
+        if callback is not None:
+            job.future.add_done_callback(lambda future: future.exception() is None and callback(future.result()))
+
+        return job.future
+
+    def calculate(self, filename, title, use_addnet_hash=False):
+        """Returns the hash, calculating it on the calling thread unless a worker is already calculating it; a job that
+        is queued but not started yet is taken over, and the worker skips it later."""
+
+        key = (title, use_addnet_hash)
+
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                job = HashingJob(filename, title, use_addnet_hash)
+                self.jobs[key] = job
+
+        self.run(job)
+
+        return job.future.result()
+
+    def run(self, job):
+        with self.lock:
+            if job.running:
+                return
+
+            job.running = True
+
+        try:
+            job.future.set_result(self.calculate_job(job))
+        except Exception as e:
+            job.future.set_exception(e)
+        finally:
+            with self.lock:
+                self.jobs.pop((job.title, job.use_addnet_hash), None)
+
+    def calculate_job(self, job):
+        try:
+            sha256_value = sha256_from_cache(job.filename, job.title, job.use_addnet_hash)
+            if sha256_value is not None:
+                return sha256_value
+
+            identity = file_identity(job.filename)
+            job.bytes_total = identity[1]
+
+            if job.use_addnet_hash:
+                with open(job.filename, "rb", buffering=0) as file:
+                    sha256_value = addnet_hash_safetensors(file, job.add_progress)
+            else:
+                sha256_value = calculate_sha256(job.filename, job.add_progress)
+
+            print(f"Calculating sha256 for {job.filename}: {sha256_value}")
+
+            hashes = cache("hashes-addnet") if job.use_addnet_hash else cache("hashes")
+            hashes[job.title] = {
+                "mtime": identity[2] / 1e9,
+                "identity": identity,
+                "sha256": sha256_value,
+            }
+
+            dump_cache()
+
+            with self.lock:
+                self.done += 1
+
+            return sha256_value
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+
+    def progress(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+
+            return {
+                "queued": sum(1 for job in jobs if not job.running),
+                "running": sum(1 for job in jobs if job.running),
+                "done": self.done,
+                "failed": self.failed,
+                "files": [
+                    {
+                        "title": job.title,
+                        "filename": job.filename,
+                        "running": job.running,
+                        "bytes_total": job.bytes_total,
+                        "bytes_done": job.bytes_done,
+                    }
+                    for job in jobs
+                ],
+            }
+
+
+hashing = HashingService()
+
+
+def sha256(filename, title, use_addnet_hash=False, wait=True, callback=None):
+    """Returns sha256 of the file, from cache if possible.
+
+    If wait is False and the hash is not in cache, returns None immediately and calculates the hash in background;
+    callback, if specified, is then called with the hash once it's ready.
+    """
 
     sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
     if sha256_value is not None:
@@ -48,28 +236,31 @@ def sha256(filename, title, use_addnet_hash=False):
     if shared.cmd_opts.no_hashing:
         return None
 
-    print(f"Calculating sha256 for {filename}: ", end='')
-    if use_addnet_hash:
-        with open(filename, "rb") as file:
-            sha256_value = addnet_hash_safetensors(file)
-    else:
-        sha256_value = calculate_sha256(filename)
-    print(f"{sha256_value}")
+    if wait:
+        return hashing.calculate(filename, title, use_addnet_hash)
+
+    hashing.submit(filename, title, use_addnet_hash, callback=callback)
+    return None
+
 
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
+def prehash(files):
+    """Starts calculating hashes in background for those of files that do not have them in cache.
 
-    dump_cache()
+    files is an iterable of (filename, title, use_addnet_hash, callback) tuples; callback may be None.
+    Does nothing unless enabled in settings.
+    """
 
-    return sha256_value
+    if shared.cmd_opts.no_hashing or not shared.opts.hashing_in_background:
+        return
 
+    for filename, title, use_addnet_hash, callback in files:
+        if sha256_from_cache(filename, title, use_addnet_hash) is None:
+            hashing.submit(filename, title, use_addnet_hash, callback=callback)
 
-def addnet_hash_safetensors(b):
+
+def addnet_hash_safetensors(b, progress=None):
     """kohya-ss hash for safetensors from https://github.com/kohya-ss/sd-scripts/blob/main/library/train_util.py"""
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
     b.seek(0)
     header = b.read(8)
@@ -77,8 +268,5 @@ def addnet_hash_safetensors(b):
 
     offset = n + 8
     b.seek(offset)
-    for chunk in iter(lambda: b.read(blksize), b""):
-        hash_sha256.update(chunk)
-
-    return hash_sha256.hexdigest()
 
+    return hash_file_contents(b, hash_sha256, progress)
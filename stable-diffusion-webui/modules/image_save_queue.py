@@ -0,0 +1,133 @@
+"""Writing saved images to disk on background threads.
+
+images.save_image picks the filename and runs before_image_saved callbacks right away, but encoding the image and
+writing it, together with its .txt file and downscaled JPG copy, can be handed to this queue, so that generation of
+the next batch does not wait for the disk. Filenames that are queued but not written yet are remembered, so that
+sequence numbers keep increasing in the order images were saved. image_saved callbacks are called in the same order
+as well, even when several workers write images at the same time.
+
+The number of queued images is limited: saving an image when the queue is full waits until one of the queued images
+is written, so memory use does not grow if the disk is slower than generation.
+"""
+
+import atexit
+import concurrent.futures
+import threading
+
+from modules import errors
+
+max_pending_per_worker = 4
+
+
+class ImageSaveQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.executor = None
+        self.workers = 0
+        self.slots = None
+        self.pending_filenames = {}
+        self.futures = set()
+        self.previous_done = None
+
+    def start(self, workers):
+        """Makes sure there are as many worker threads as requested; waits for queued images if the number changes."""
+
+        if workers == self.workers:
+            return
+
+        self.stop()
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-save")
+        self.slots = threading.BoundedSemaphore(workers * max_pending_per_worker)
+        self.workers = workers
+
+    def stop(self):
+        """Waits for all queued images to be written and stops worker threads."""
+
+        if self.executor is None:
+            return
+
+        self.flush()
+        self.executor.shutdown()
+        self.executor = None
+        self.workers = 0
+
+    def is_pending(self, filename):
+        """Returns True if filename is queued to be written, but does not exist yet."""
+
+        with self.lock:
+            return filename in self.pending_filenames
+
+    def submit(self, workers, filename, write, done):
+        """Queues write, a function without arguments that writes filename, to run on a worker thread.
+
+        done is called after write on the worker thread, in the same order as functions were submitted. Waits if
+        there are too many images queued already.
+        """
+
+        with self.start_lock:
+            self.start(workers)
+            slots = self.slots
+            executor = self.executor
+
+        slots.acquire()
+
+        with self.lock:
+            self.pending_filenames[filename] = self.pending_filenames.get(filename, 0) + 1
+            wait_for = self.previous_done
+            self.previous_done = finished = threading.Event()
+
+        def run():
+            try:
+                try:
+                    write()
+                    written = True
+                except Exception as e:
+                    errors.display(e, f"saving image {filename}")
+                    written = False
+
+                if wait_for is not None:
+                    wait_for.wait()
+
+                if written:
+                    try:
+                        done()
+                    except Exception as e:
+                        errors.display(e, f"after saving image {filename}")
+            finally:
+                with self.lock:
+                    self.pending_filenames[filename] -= 1
+                    if not self.pending_filenames[filename]:
+                        del self.pending_filenames[filename]
+
+                finished.set()
+                slots.release()
+
+        future = executor.submit(run)
+
+        with self.lock:
+            self.futures.add(future)
+
+        future.add_done_callback(self.discard)
+
+    def discard(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def flush(self):
+        """Waits until all queued images are written."""
+
+        while True:
+            with self.lock:
+                futures = list(self.futures)
+
+            if not futures:
+                break
+
+            concurrent.futures.wait(futures)
+
+
+queue = ImageSaveQueue()
+
+atexit.register(queue.stop)
@@ -8,6 +8,7 @@ import math
 import os
 from collections import namedtuple
 import re
+import tempfile
 
 import numpy as np
 import piexif
@@ -19,7 +20,7 @@ import string
 import json
 import hashlib
 
-from modules import sd_samplers, shared, script_callbacks, errors
+from modules import sd_samplers, shared, script_callbacks, errors, image_save_queue, sequence_numbers
 from modules.paths_internal import roboto_ttf_file
 from modules.shared import opts
 
@@ -66,6 +67,86 @@ def image_grid(imgs, batch_size=1, rows=None):
     return grid
 
 
+class GridCanvas:
+    """An RGB image for grids too large to keep in memory; pixels are kept in a memory-mapped temporary file.
+
+    Parts of the grid are pasted in as they become available; the OS writes pixels that are not being used to disk.
+    The result can be saved as tiles, and a downscaled preview can be made, both without loading the whole image.
+    """
+
+    band_height = 256
+
+    def __init__(self, width, height, color, directory=None):
+        self.width = width
+        self.height = height
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.array = np.memmap(self.file, dtype=np.uint8, mode="w+", shape=(height, width, 3))
+
+        color = np.array(ImageColor.getcolor(color, 'RGB') if isinstance(color, str) else color, dtype=np.uint8)
+        for y in range(0, height, self.band_height):
+            self.array[y:y + self.band_height] = color
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def paste(self, image, box):
+        """Pastes a PIL image or another GridCanvas with its top left corner at box; parts outside are cut off."""
+
+        x, y = box
+        w = min(image.width, self.width - x)
+        h = min(image.height, self.height - y)
+        if w <= 0 or h <= 0:
+            return
+
+        if isinstance(image, GridCanvas):
+            for top in range(0, h, self.band_height):
+                bottom = min(top + self.band_height, h)
+                self.array[y + top:y + bottom, x:x + w] = image.array[top:bottom, :w]
+        else:
+            self.array[y:y + h, x:x + w] = np.asarray(image.convert("RGB"))[:h, :w]
+
+    def crop(self, box):
+        x1, y1, x2, y2 = box
+        return Image.fromarray(np.ascontiguousarray(self.array[y1:y2, x1:x2]))
+
+    def to_image(self):
+        return Image.fromarray(np.array(self.array))
+
+    def preview(self, max_side):
+        """Returns the image downscaled so that neither side is longer than max_side, by averaging blocks of pixels."""
+
+        factor = max(math.ceil(max(self.width, self.height) / max_side), 1)
+        result = Image.new("RGB", (math.ceil(self.width / factor), math.ceil(self.height / factor)))
+
+        band = factor * max(self.band_height // factor, 1)
+        for y in range(0, self.height, band):
+            result.paste(self.crop((0, y, self.width, min(y + band, self.height))).reduce(factor), (0, y // factor))
+
+        return result
+
+    def save_tiles(self, directory, tile_size, extension="png"):
+        """Saves the image into directory as tiles of tile_size x tile_size pixels named {row}-{column}.{extension}.
+
+        Returns the list of saved files.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+
+        filenames = []
+        for row, y in enumerate(range(0, self.height, tile_size)):
+            for col, x in enumerate(range(0, self.width, tile_size)):
+                filename = os.path.join(directory, f"{row:03}-{col:03}.{extension}")
+                self.crop((x, y, min(x + tile_size, self.width), min(y + tile_size, self.height))).save(filename)
+                filenames.append(filename)
+
+        return filenames
+
+    def close(self):
+        del self.array
+        self.file.close()
+
+
 class Grid(namedtuple("_Grid", ["tiles", "tile_w", "tile_h", "image_w", "image_h", "overlap"])):
     @property
     def tile_count(self) -> int:
@@ -111,34 +192,63 @@ def split_grid(image: Image.Image, tile_w: int = 512, tile_h: int = 512, overlap
     return grid
 
 
-def combine_grid(grid):
-    def make_mask_image(r):
-        r = r * 255 / grid.overlap
-        r = r.astype(np.uint8)
-        return Image.fromarray(r, 'L')
-
-    mask_w = make_mask_image(np.arange(grid.overlap, dtype=np.float32).reshape((1, grid.overlap)).repeat(grid.tile_h, axis=0))
-    mask_h = make_mask_image(np.arange(grid.overlap, dtype=np.float32).reshape((grid.overlap, 1)).repeat(grid.image_w, axis=1))
-
-    combined_image = Image.new("RGB", (grid.image_w, grid.image_h))
-    for y, h, row in grid.tiles:
-        combined_row = Image.new("RGB", (grid.image_w, h))
-        for x, w, tile in row:
-            if x == 0:
-                combined_row.paste(tile, (0, 0))
-                continue
+class GridCombiner:
+    """Stitches tiles of a grid into one image as they arrive, blending neighbouring tiles with linear ramps where they
+    overlap; tiles must be added in the same order as they are in grid.tiles.
+
+    Every tile is pasted once, straight into the output; only the strips where it overlaps what is already there are
+    blended, using the part of the output under the strip saved before pasting. The same goes for rows of tiles.
+    """
+
+    def __init__(self, grid: Grid):
+        def make_mask_image(r):
+            r = r * 255 / grid.overlap
+            r = r.astype(np.uint8)
+            return Image.fromarray(r, 'L')
+
+        self.overlap = grid.overlap
+        self.mask_w = make_mask_image(np.arange(grid.overlap, dtype=np.float32).reshape((1, grid.overlap)).repeat(grid.tile_h, axis=0))
+        self.mask_h = make_mask_image(np.arange(grid.overlap, dtype=np.float32).reshape((grid.overlap, 1)).repeat(grid.image_w, axis=1))
+
+        self.image = Image.new("RGB", (grid.image_w, grid.image_h))
+        self.positions = [(y, h, x, w, i == 0, i == len(row) - 1) for y, h, row in grid.tiles for i, (x, w, _) in enumerate(row)]
+        self.count = 0
+        self.previous_row = None
+
+    def add(self, tile: Image.Image):
+        y, h, x, w, first_in_row, last_in_row = self.positions[self.count]
+        self.count += 1
 
-            combined_row.paste(tile.crop((0, 0, grid.overlap, h)), (x, 0), mask=mask_w)
-            combined_row.paste(tile.crop((grid.overlap, 0, w, h)), (x + grid.overlap, 0))
+        image = self.image
+        overlap = self.overlap
 
-        if y == 0:
-            combined_image.paste(combined_row, (0, 0))
-            continue
+        if first_in_row and y != 0:
+            self.previous_row = image.crop((0, y, image.width, y + overlap)) if overlap else None
+            image.paste((0, 0, 0), (0, y, image.width, min(y + h, image.height)))
 
-        combined_image.paste(combined_row.crop((0, 0, combined_row.width, grid.overlap)), (0, y), mask=mask_h)
-        combined_image.paste(combined_row.crop((0, grid.overlap, combined_row.width, h)), (0, y + grid.overlap))
+        if tile.width != w or tile.height != h:
+            tile = tile.crop((0, 0, w, h))
 
-    return combined_image
+        previous = image.crop((x, y, x + overlap, y + h)) if x != 0 and overlap else None
+        image.paste(tile, (x, y))
+
+        if previous is not None:
+            previous.paste(tile.crop((0, 0, overlap, h)), (0, 0), mask=self.mask_w)
+            image.paste(previous, (x, y))
+
+        if last_in_row and self.previous_row is not None:
+            self.previous_row.paste(image.crop((0, y, image.width, y + overlap)), (0, 0), mask=self.mask_h)
+            image.paste(self.previous_row, (0, y))
+            self.previous_row = None
+
+
+def combine_grid(grid):
+    combiner = GridCombiner(grid)
+    for _y, _h, row in grid.tiles:
+        for _x, _w, tile in row:
+            combiner.add(tile)
+
+    return combiner.image
 
 
 class GridAnnotation:
@@ -148,12 +258,51 @@ class GridAnnotation:
         self.size = None
 
 
-def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
+class GridAnnotationLayout:
+    """Sizes of texts drawn around a grid of cells, each width x height, with margin pixels between cells.
+
+    Lines of hor_texts and ver_texts are wrapped to fit in place (the lists are modified).
+    """
+
+    def __init__(self, width, height, hor_texts, ver_texts, margin=0):
+        self.width = width
+        self.height = height
+        self.hor_texts = hor_texts
+        self.ver_texts = ver_texts
+        self.margin = margin
 
-    color_active = ImageColor.getcolor(opts.grid_text_active_color, 'RGB')
-    color_inactive = ImageColor.getcolor(opts.grid_text_inactive_color, 'RGB')
-    color_background = ImageColor.getcolor(opts.grid_background_color, 'RGB')
+        self.color_active = ImageColor.getcolor(opts.grid_text_active_color, 'RGB')
+        self.color_inactive = ImageColor.getcolor(opts.grid_text_inactive_color, 'RGB')
+        self.color_background = ImageColor.getcolor(opts.grid_background_color, 'RGB')
 
+        self.fontsize = (width + height) // 25
+        self.line_spacing = self.fontsize // 2
+        self.fnt = get_font(self.fontsize)
+
+        self.pad_left = 0 if sum([sum([len(line.text) for line in lines]) for lines in ver_texts]) == 0 else width * 3 // 4
+
+        calc_img = Image.new("RGB", (1, 1), self.color_background)
+        calc_d = ImageDraw.Draw(calc_img)
+
+        for texts, allowed_width in zip(hor_texts + ver_texts, [width] * len(hor_texts) + [self.pad_left] * len(ver_texts)):
+            items = [] + texts
+            texts.clear()
+
+            for line in items:
+                wrapped = self.wrap(calc_d, line.text, self.fnt, allowed_width)
+                texts += [GridAnnotation(x, line.is_active) for x in wrapped]
+
+            for line in texts:
+                bbox = calc_d.multiline_textbbox((0, 0), line.text, font=self.fnt)
+                line.size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
+                line.allowed_width = allowed_width
+
+        self.hor_text_heights = [sum([line.size[1] + self.line_spacing for line in lines]) - self.line_spacing for lines in hor_texts]
+        self.ver_text_heights = [sum([line.size[1] + self.line_spacing for line in lines]) - self.line_spacing * len(lines) for lines in ver_texts]
+
+        self.pad_top = 0 if sum(self.hor_text_heights) == 0 else max(self.hor_text_heights) + self.line_spacing * 2
+
+    @staticmethod
     def wrap(drawing, text, font, line_length):
         lines = ['']
         for word in text.split():
@@ -164,74 +313,84 @@ def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
                 lines.append(word)
         return lines
 
-    def draw_texts(drawing, draw_x, draw_y, lines, initial_fnt, initial_fontsize):
+    @property
+    def size(self):
+        """Size of the annotated grid."""
+
+        cols = len(self.hor_texts)
+        rows = len(self.ver_texts)
+        return self.pad_left + self.width * cols + self.margin * (cols - 1), self.pad_top + self.height * rows + self.margin * (rows - 1)
+
+    def cell_position(self, col, row):
+        return self.pad_left + (self.width + self.margin) * col, self.pad_top + (self.height + self.margin) * row
+
+    def draw_texts(self, drawing, draw_x, draw_y, lines):
         for line in lines:
-            fnt = initial_fnt
-            fontsize = initial_fontsize
+            fnt = self.fnt
+            fontsize = self.fontsize
             while drawing.multiline_textsize(line.text, font=fnt)[0] > line.allowed_width and fontsize > 0:
                 fontsize -= 1
                 fnt = get_font(fontsize)
-            drawing.multiline_text((draw_x, draw_y + line.size[1] / 2), line.text, font=fnt, fill=color_active if line.is_active else color_inactive, anchor="mm", align="center")
+            drawing.multiline_text((draw_x, draw_y + line.size[1] / 2), line.text, font=fnt, fill=self.color_active if line.is_active else self.color_inactive, anchor="mm", align="center")
 
             if not line.is_active:
-                drawing.line((draw_x - line.size[0] // 2, draw_y + line.size[1] // 2, draw_x + line.size[0] // 2, draw_y + line.size[1] // 2), fill=color_inactive, width=4)
+                drawing.line((draw_x - line.size[0] // 2, draw_y + line.size[1] // 2, draw_x + line.size[0] // 2, draw_y + line.size[1] // 2), fill=self.color_inactive, width=4)
 
-            draw_y += line.size[1] + line_spacing
+            draw_y += line.size[1] + self.line_spacing
 
-    fontsize = (width + height) // 25
-    line_spacing = fontsize // 2
+    def draw_column_texts(self, drawing, col, offset=(0, 0)):
+        x = self.pad_left + (self.width + self.margin) * col + self.width / 2
+        y = self.pad_top / 2 - self.hor_text_heights[col] / 2
 
-    fnt = get_font(fontsize)
+        self.draw_texts(drawing, x - offset[0], y - offset[1], self.hor_texts[col])
 
-    pad_left = 0 if sum([sum([len(line.text) for line in lines]) for lines in ver_texts]) == 0 else width * 3 // 4
+    def draw_row_texts(self, drawing, row, offset=(0, 0)):
+        x = self.pad_left / 2
+        y = self.pad_top + (self.height + self.margin) * row + self.height / 2 - self.ver_text_heights[row] / 2
 
-    cols = im.width // width
-    rows = im.height // height
+        self.draw_texts(drawing, x - offset[0], y - offset[1], self.ver_texts[row])
 
-    assert cols == len(hor_texts), f'bad number of horizontal texts: {len(hor_texts)}; must be {cols}'
-    assert rows == len(ver_texts), f'bad number of vertical texts: {len(ver_texts)}; must be {rows}'
+    def draw_on_canvas(self, canvas):
+        """Draws texts onto a GridCanvas of self.size, one strip at a time."""
 
-    calc_img = Image.new("RGB", (1, 1), color_background)
-    calc_d = ImageDraw.Draw(calc_img)
+        if self.pad_top:
+            strip = Image.new("RGB", (canvas.width, self.pad_top), self.color_background)
+            drawing = ImageDraw.Draw(strip)
+            for col in range(len(self.hor_texts)):
+                self.draw_column_texts(drawing, col)
+            canvas.paste(strip, (0, 0))
 
-    for texts, allowed_width in zip(hor_texts + ver_texts, [width] * len(hor_texts) + [pad_left] * len(ver_texts)):
-        items = [] + texts
-        texts.clear()
+        if self.pad_left:
+            for row in range(len(self.ver_texts)):
+                _, y = self.cell_position(0, row)
+                strip = Image.new("RGB", (self.pad_left, self.height), self.color_background)
+                self.draw_row_texts(ImageDraw.Draw(strip), row, offset=(0, y))
+                canvas.paste(strip, (0, y))
 
-        for line in items:
-            wrapped = wrap(calc_d, line.text, fnt, allowed_width)
-            texts += [GridAnnotation(x, line.is_active) for x in wrapped]
 
-        for line in texts:
-            bbox = calc_d.multiline_textbbox((0, 0), line.text, font=fnt)
-            line.size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
-            line.allowed_width = allowed_width
+def draw_grid_annotations(im, width, height, hor_texts, ver_texts, margin=0):
+    cols = im.width // width
+    rows = im.height // height
 
-    hor_text_heights = [sum([line.size[1] + line_spacing for line in lines]) - line_spacing for lines in hor_texts]
-    ver_text_heights = [sum([line.size[1] + line_spacing for line in lines]) - line_spacing * len(lines) for lines in ver_texts]
+    assert cols == len(hor_texts), f'bad number of horizontal texts: {len(hor_texts)}; must be {cols}'
+    assert rows == len(ver_texts), f'bad number of vertical texts: {len(ver_texts)}; must be {rows}'
 
-    pad_top = 0 if sum(hor_text_heights) == 0 else max(hor_text_heights) + line_spacing * 2
+    layout = GridAnnotationLayout(width, height, hor_texts, ver_texts, margin)
 
-    result = Image.new("RGB", (im.width + pad_left + margin * (cols-1), im.height + pad_top + margin * (rows-1)), color_background)
+    result = Image.new("RGB", (im.width + layout.pad_left + margin * (cols-1), im.height + layout.pad_top + margin * (rows-1)), layout.color_background)
 
     for row in range(rows):
         for col in range(cols):
             cell = im.crop((width * col, height * row, width * (col+1), height * (row+1)))
-            result.paste(cell, (pad_left + (width + margin) * col, pad_top + (height + margin) * row))
+            result.paste(cell, layout.cell_position(col, row))
 
     d = ImageDraw.Draw(result)
 
     for col in range(cols):
-        x = pad_left + (width + margin) * col + width / 2
-        y = pad_top / 2 - hor_text_heights[col] / 2
-
-        draw_texts(d, x, y, hor_texts[col], fnt, fontsize)
+        layout.draw_column_texts(d, col)
 
     for row in range(rows):
-        x = pad_left / 2
-        y = pad_top + (height + margin) * row + height / 2 - ver_text_heights[row] / 2
-
-        draw_texts(d, x, y, ver_texts[row], fnt, fontsize)
+        layout.draw_row_texts(d, row)
 
     return result
 
@@ -562,6 +721,9 @@ def get_next_sequence_number(path, basename):
     return result + 1
 
 
+image_sequence_numbers = sequence_numbers.SequenceNumbers(get_next_sequence_number)
+
+
 def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_pnginfo=None, pnginfo_section_name='parameters'):
     """
     Saves image to filename, including geninfo as text information for generation info.
@@ -648,6 +810,9 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
         save_to_dirs (bool):
             If true, the image will be saved into a subdirectory of `path`.
 
+    If save_images_background_workers option is set, the image is written to disk on a background thread, and this
+    function returns as soon as the filename is known; use image_save_queue.queue.flush() to wait for it to be written.
+
     Returns: (fullfn, txt_fullfn)
         fullfn (`str`):
             The full path of the saved imaged.
@@ -686,12 +851,14 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             file_decoration = f"-{file_decoration}"
 
         if add_number:
-            basecount = get_next_sequence_number(path, basename)
+            def numbered_filename(number):
+                fn = f"{number:05}" if basename == '' else f"{basename}-{number:04}"
+                return os.path.join(path, f"{fn}{file_decoration}.{extension}")
+
             fullfn = None
-            for i in range(500):
-                fn = f"{basecount + i:05}" if basename == '' else f"{basename}-{basecount + i:04}"
-                fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
-                if not os.path.exists(fullfn):
+            for _ in range(500):
+                fullfn = numbered_filename(image_sequence_numbers.allocate(path, basename, numbered_filename))
+                if not image_save_queue.queue.is_pending(fullfn):
                     break
         else:
             fullfn = os.path.join(path, f"{file_decoration}.{extension}")
@@ -731,38 +898,47 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
         fullfn_without_extension = fullfn_without_extension[:max_name_len - max(4, len(extension))]
         params.filename = fullfn_without_extension + extension
         fullfn = params.filename
-    _atomically_save_image(image, fullfn_without_extension, extension)
+
+    if opts.save_txt and info is not None:
+        txt_fullfn = f"{fullfn_without_extension}.txt"
+    else:
+        txt_fullfn = None
 
     image.already_saved_as = fullfn
 
-    oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
-    if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
-        ratio = image.width / image.height
-        resize_to = None
-        if oversize and ratio > 1:
-            resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
-        elif oversize:
-            resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+    def write():
+        _atomically_save_image(image, fullfn_without_extension, extension)
+
+        oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
+        if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
+            ratio = image.width / image.height
+            resize_to = None
+            if oversize and ratio > 1:
+                resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
+            elif oversize:
+                resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
 
-        if resize_to is not None:
+            downscaled = image
+            if resize_to is not None:
+                try:
+                    # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
+                    downscaled = image.resize(resize_to, LANCZOS)
+                except Exception:
+                    downscaled = image.resize(resize_to)
             try:
-                # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
-                image = image.resize(resize_to, LANCZOS)
-            except Exception:
-                image = image.resize(resize_to)
-        try:
-            _atomically_save_image(image, fullfn_without_extension, ".jpg")
-        except Exception as e:
-            errors.display(e, "saving image as downscaled JPG")
+                _atomically_save_image(downscaled, fullfn_without_extension, ".jpg")
+            except Exception as e:
+                errors.display(e, "saving image as downscaled JPG")
 
-    if opts.save_txt and info is not None:
-        txt_fullfn = f"{fullfn_without_extension}.txt"
-        with open(txt_fullfn, "w", encoding="utf8") as file:
-            file.write(f"{info}\n")
-    else:
-        txt_fullfn = None
+        if txt_fullfn is not None:
+            with open(txt_fullfn, "w", encoding="utf8") as file:
+                file.write(f"{info}\n")
 
-    script_callbacks.image_saved_callback(params)
+    if opts.save_images_background_workers > 0:
+        image_save_queue.queue.submit(opts.save_images_background_workers, fullfn, write, lambda: script_callbacks.image_saved_callback(params))
+    else:
+        write()
+        script_callbacks.image_saved_callback(params)
 
     return fullfn, txt_fullfn
 
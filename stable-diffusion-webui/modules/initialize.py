@@ -127,8 +127,15 @@ def initialize_rest(*, reload_script_modules=False):
     textual_inversion.textual_inversion.list_textual_inversion_templates()
     startup_timer.record("refresh textual inversion templates")
 
-    from modules import script_callbacks, sd_hijack_optimizations, sd_hijack
+    from modules import model_index
+    model_index.add_watch_callback([sd_models.model_path, shared.cmd_opts.ckpt_dir], sd_models.list_models)
+    model_index.add_watch_callback([sd_models.model_path, sd_vae.vae_path, shared.cmd_opts.ckpt_dir, shared.cmd_opts.vae_dir], sd_vae.refresh_vae_list)
+    model_index.add_watch_callback([shared.cmd_opts.embeddings_dir], textual_inversion.textual_inversion.reload_embeddings_if_model_loaded)
+    model_index.start_watching()
+
+    from modules import script_callbacks, sd_hijack_optimizations, sd_hijack, cond_cache
     script_callbacks.on_list_optimizers(sd_hijack_optimizations.list_optimizers)
+    script_callbacks.on_model_loaded(cond_cache.clear)
     sd_hijack.list_optimizers()
     startup_timer.record("scripts list_optimizers")
 
@@ -175,7 +175,7 @@ def configure_sigint_handler():
 
 
 def configure_opts_onchange():
-    from modules import shared, sd_models, sd_vae, ui_tempdir, sd_hijack
+    from modules import shared, sd_models, sd_vae, ui_tempdir, sd_hijack, cond_cache
     from modules.call_queue import wrap_queued_call
 
     shared.opts.onchange("sd_model_checkpoint", wrap_queued_call(lambda: sd_models.reload_model_weights()), call=False)
@@ -186,6 +186,7 @@ def configure_opts_onchange():
     shared.opts.onchange("cross_attention_optimization", wrap_queued_call(lambda: sd_hijack.model_hijack.redo_hijack(shared.sd_model)), call=False)
     shared.opts.onchange("fp8_storage", wrap_queued_call(lambda: sd_models.reload_model_weights()), call=False)
     shared.opts.onchange("cache_fp16_weight", wrap_queued_call(lambda: sd_models.reload_model_weights(forced_reload=True)), call=False)
+    shared.opts.onchange("cond_cache_mb", lambda: cond_cache.cache.purge(int(shared.opts.cond_cache_mb * 1024 * 1024)), call=False)
     startup_timer.record("opts onchange")
 
 
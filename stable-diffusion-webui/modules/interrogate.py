@@ -10,7 +10,7 @@ import torch.hub
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 
-from modules import devices, paths, shared, lowvram, modelloader, errors, torch_utils
+from modules import devices, paths, shared, lowvram, modelloader, errors, torch_utils, interrogate_index
 
 blip_image_eval_size = 384
 clip_model_name = 'ViT-L/14'
@@ -52,17 +52,26 @@ class InterrogateModels:
     def __init__(self, content_dir):
         self.loaded_categories = None
         self.skip_categories = []
+        self.categories_files = None
         self.content_dir = content_dir
         self.running_on_cpu = devices.device_interrogate == torch.device("cpu")
+        self.text_index = interrogate_index.TextFeatureIndex(clip_model_name)
+
+    def list_categories_files(self):
+        """Returns names, sizes and modification times of category files, to find out whether any of them changed."""
+
+        return sorted((f.name, f.stat().st_size, f.stat().st_mtime_ns) for f in Path(self.content_dir).glob('*.txt'))
 
     def categories(self):
         if not os.path.exists(self.content_dir):
             download_default_clip_interrogate_categories(self.content_dir)
 
-        if self.loaded_categories is not None and self.skip_categories == shared.opts.interrogate_clip_skip_categories:
+        categories_files = self.list_categories_files() if os.path.exists(self.content_dir) else None
+        if self.loaded_categories is not None and self.skip_categories == shared.opts.interrogate_clip_skip_categories and self.categories_files == categories_files:
            return self.loaded_categories
 
         self.loaded_categories = []
+        self.categories_files = categories_files
 
         if os.path.exists(self.content_dir):
             self.skip_categories = shared.opts.interrogate_clip_skip_categories
@@ -138,6 +147,8 @@ class InterrogateModels:
             if self.clip_model is not None:
                 self.clip_model = self.clip_model.to(devices.cpu)
 
+            self.text_index.unload()
+
     def send_blip_to_ram(self):
         if not shared.opts.interrogate_keep_models_in_memory:
             if self.blip_model is not None:
@@ -149,38 +160,95 @@ class InterrogateModels:
 
         devices.torch_gc()
 
-    def rank(self, image_features, text_array, top_count=1):
+    def encode_text(self, texts):
         import clip
 
-        devices.torch_gc()
+        text_tokens = clip.tokenize(list(texts), truncate=True).to(devices.device_interrogate)
+        return self.clip_model.encode_text(text_tokens).type(self.dtype)
 
+    def rank(self, image_features, text_array, top_count=1):
         if shared.opts.interrogate_clip_dict_limit != 0:
             text_array = text_array[0:int(shared.opts.interrogate_clip_dict_limit)]
 
         top_count = min(top_count, len(text_array))
-        text_tokens = clip.tokenize(list(text_array), truncate=True).to(devices.device_interrogate)
-        text_features = self.clip_model.encode_text(text_tokens).type(self.dtype)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
+        if top_count == 0:
+            return []
 
-        similarity = torch.zeros((1, len(text_array))).to(devices.device_interrogate)
-        for i in range(image_features.shape[0]):
-            similarity += (100.0 * image_features[i].unsqueeze(0) @ text_features.T).softmax(dim=-1)
-        similarity /= image_features.shape[0]
+        text_features = self.text_index.get(list(text_array), self.encode_text, devices.device_interrogate, self.dtype)
+        labels, probs = interrogate_index.rank(image_features, text_features, top_count)
 
-        top_probs, top_labels = similarity.cpu().topk(top_count, dim=-1)
-        return [(text_array[top_labels[0][i].numpy()], (top_probs[0][i].numpy()*100)) for i in range(top_count)]
+        return [(text_array[label], prob) for label, prob in zip(labels, probs)]
 
-    def generate_caption(self, pil_image):
-        gpu_image = transforms.Compose([
+    def rank_batch(self, image_features, text_array, top_count=1):
+        """Same as rank, but for a batch of images with one row of image_features each; returns a list of matches for every image."""
+
+        if shared.opts.interrogate_clip_dict_limit != 0:
+            text_array = text_array[0:int(shared.opts.interrogate_clip_dict_limit)]
+
+        top_count = min(top_count, len(text_array))
+        if top_count == 0:
+            return [[] for _ in range(image_features.shape[0])]
+
+        text_features = self.text_index.get(list(text_array), self.encode_text, devices.device_interrogate, self.dtype)
+        return [[(text_array[label], prob) for label, prob in zip(labels, probs)] for labels, probs in interrogate_index.rank_batch(image_features, text_features, top_count)]
+
+    def describe(self, image_features):
+        """Returns, for every image in the batch, matches from all categories as text to be added to its caption."""
+
+        res = ["" for _ in range(image_features.shape[0])]
+
+        with torch.no_grad(), devices.autocast():
+            for cat in self.categories():
+                for i, matches in enumerate(self.rank_batch(image_features, cat.items, top_count=cat.topn)):
+                    for match, score in matches:
+                        if shared.opts.interrogate_return_ranks:
+                            res[i] += f", ({match}:{score/100:.3f})"
+                        else:
+                            res[i] += f", {match}"
+
+        return res
+
+    def blip_transform(self, pil_image):
+        """Prepares an image for BLIP; returns a CHW tensor on CPU."""
+
+        return transforms.Compose([
             transforms.Resize((blip_image_eval_size, blip_image_eval_size), interpolation=InterpolationMode.BICUBIC),
             transforms.ToTensor(),
             transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-        ])(pil_image).unsqueeze(0).type(self.dtype).to(devices.device_interrogate)
+        ])(pil_image)
+
+    def generate_captions(self, blip_images):
+        """Captions a batch of images prepared with blip_transform, stacked into one NCHW tensor."""
+
+        gpu_images = blip_images.type(self.dtype).to(devices.device_interrogate)
 
         with torch.no_grad():
-            caption = self.blip_model.generate(gpu_image, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
+            return self.blip_model.generate(gpu_images, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
+
+    def generate_caption(self, pil_image):
+        return self.generate_captions(self.blip_transform(pil_image).unsqueeze(0))[0]
+
+    def image_features(self, clip_images):
+        """Returns normalized CLIP features for a batch of images prepared with clip_preprocess, stacked into one NCHW tensor."""
+
+        clip_images = clip_images.type(self.dtype).to(devices.device_interrogate)
+
+        with torch.no_grad(), devices.autocast():
+            image_features = self.clip_model.encode_image(clip_images).type(self.dtype)
+            image_features /= image_features.norm(dim=-1, keepdim=True)
 
-        return caption[0]
+        return image_features
+
+    def interrogate_batch(self, blip_images, clip_images):
+        """Describes a batch of images prepared with blip_transform and clip_preprocess; returns a list of prompts.
+
+        Models must be loaded with load() beforehand, and both stay on the device; call unload() when done.
+        """
+
+        captions = self.generate_captions(blip_images)
+        descriptions = self.describe(self.image_features(clip_images))
+
+        return [caption + description for caption, description in zip(captions, descriptions)]
 
     def interrogate(self, pil_image):
         res = ""
@@ -197,20 +265,8 @@ class InterrogateModels:
 
             res = caption
 
-            clip_image = self.clip_preprocess(pil_image).unsqueeze(0).type(self.dtype).to(devices.device_interrogate)
-
-            with torch.no_grad(), devices.autocast():
-                image_features = self.clip_model.encode_image(clip_image).type(self.dtype)
-
-                image_features /= image_features.norm(dim=-1, keepdim=True)
-
-                for cat in self.categories():
-                    matches = self.rank(image_features, cat.items, top_count=cat.topn)
-                    for match, score in matches:
-                        if shared.opts.interrogate_return_ranks:
-                            res += f", ({match}:{score/100:.3f})"
-                        else:
-                            res += f", {match}"
+            image_features = self.image_features(self.clip_preprocess(pil_image).unsqueeze(0))
+            res += self.describe(image_features)[0]
 
         except Exception:
             errors.report("Error interrogating", exc_info=True)
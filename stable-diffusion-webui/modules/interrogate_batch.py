@@ -0,0 +1,133 @@
+"""Interrogation of many images with models kept on the device for the whole job.
+
+Interrogating one image at a time moves models to the device and back for every image. Here, models are loaded once,
+images are loaded and preprocessed on worker threads a few batches ahead of the model, and stacked into batches for
+forward passes. Results are produced in the same order as images, as soon as their batch is done.
+"""
+
+import collections
+import concurrent.futures
+
+import torch
+
+from modules import deepbooru, devices, errors, lowvram, shared
+
+image_extensions = (".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff")
+preprocess_workers = 4
+prefetch_batches = 2
+
+
+class ClipInterrogator:
+    def start(self):
+        lowvram.send_everything_to_cpu()
+        devices.torch_gc()
+        shared.interrogator.load()
+
+    def preprocess(self, image):
+        return shared.interrogator.blip_transform(image), shared.interrogator.clip_preprocess(image)
+
+    def run(self, items):
+        return shared.interrogator.interrogate_batch(torch.stack([x[0] for x in items]), torch.stack([x[1] for x in items]))
+
+    def stop(self):
+        shared.interrogator.unload()
+
+
+class DeepDanbooruInterrogator:
+    def start(self):
+        deepbooru.model.start()
+
+    def preprocess(self, image):
+        return deepbooru.model.preprocess(image)
+
+    def run(self, items):
+        return deepbooru.model.tag_batch(items)
+
+    def stop(self):
+        deepbooru.model.stop()
+
+
+interrogators = {
+    "clip": ClipInterrogator,
+    "deepdanbooru": DeepDanbooruInterrogator,
+}
+
+
+def list_directory(path):
+    return list(shared.walk_files(path, allowed_extensions=image_extensions))
+
+
+def error_text(e):
+    return str(getattr(e, "detail", None) or e) or type(e).__name__
+
+
+def interrogate_images(sources, model="clip", batch_size=8, cancelled=None):
+    """Interrogates images in batches; yields (name, caption, error) for every source, in order.
+
+    sources is an iterable of (name, load) pairs, where load is a function without arguments that returns a PIL image;
+    it's called on a worker thread. For images that could not be loaded or interrogated, caption is None and error
+    is a description of what went wrong. Stops early if the job is interrupted, or if cancelled (a threading.Event)
+    is set.
+    """
+
+    if model not in interrogators:
+        raise ValueError(f"Unknown interrogate model: {model}; must be one of: {', '.join(interrogators)}")
+
+    interrogator = interrogators[model]()
+    batch_size = max(int(batch_size), 1)
+
+    def prepare(load):
+        return interrogator.preprocess(load().convert("RGB"))
+
+    interrogator.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=preprocess_workers, thread_name_prefix="interrogate") as executor:
+            pending = collections.deque()
+            sources = iter(sources)
+
+            def submit_more():
+                while len(pending) < batch_size * (prefetch_batches + 1):
+                    source = next(sources, None)
+                    if source is None:
+                        break
+
+                    name, load = source
+                    pending.append((name, executor.submit(prepare, load)))
+
+            submit_more()
+            while pending:
+                if shared.state.interrupted or cancelled is not None and cancelled.is_set():
+                    for _, future in pending:
+                        future.cancel()
+                    break
+
+                batch = []
+                while pending and len(batch) < batch_size:
+                    name, future = pending.popleft()
+                    try:
+                        batch.append((name, future.result(), None))
+                    except Exception as e:
+                        batch.append((name, None, error_text(e)))
+
+                submit_more()
+
+                ready = [item for _, item, error in batch if error is None]
+                captions = []
+                run_error = None
+                if ready:
+                    try:
+                        captions = list(interrogator.run(ready))
+                    except Exception as e:
+                        errors.display(e, "interrogating a batch of images")
+                        run_error = error_text(e)
+
+                captions = iter(captions)
+                for name, _, error in batch:
+                    if error is None and run_error is None:
+                        yield name, next(captions), None
+                    else:
+                        yield name, None, error or run_error
+
+                    shared.state.nextjob()
+    finally:
+        interrogator.stop()
@@ -0,0 +1,146 @@
+"""Precomputed CLIP text features for interrogate categories.
+
+Running CLIP's text encoder over thousands of lines from category files was the slowest part of interrogation, and
+its result only depends on the lines and the model. Normalized features for a list of lines are saved into a .npy file
+named after a hash of the model name, dtype and the lines, and are memory-mapped from it when needed again, also after
+restart. Editing a category file changes its lines, and so the hash, which makes features be calculated again. When
+there are more than max_files files, the ones that were not used for the longest time are removed.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from modules import cache
+
+max_files = 32
+encode_batch_size = 256
+
+
+def default_directory():
+    return os.path.join(cache.cache_dir, "interrogate-text-features")
+
+
+def items_digest(model_name, dtype, items) -> str:
+    digest = hashlib.sha256(f"{model_name}\n{dtype}\n".encode("utf8"))
+    for item in items:
+        digest.update(item.encode("utf8"))
+        digest.update(b"\n")
+
+    return digest.hexdigest()[:32]
+
+
+def encode_items(items, encode, dtype) -> np.ndarray:
+    """Calls encode (a function that takes a list of texts and returns a tensor of their features) for items in
+    batches; returns normalized features as a float16 array for float16 dtype, float32 otherwise."""
+
+    chunks = []
+    for i in range(0, len(items), encode_batch_size):
+        with torch.no_grad():
+            features = encode(items[i:i + encode_batch_size]).float()
+
+        features /= features.norm(dim=-1, keepdim=True)
+        chunks.append(features.cpu().numpy())
+
+    return np.concatenate(chunks).astype(np.float16 if dtype == torch.float16 else np.float32)
+
+
+def rank(image_features, text_features, top_count):
+    """Returns (indices, probabilities in percent) of top_count texts that best match the image.
+
+    Rows of image_features are features of the same image; probabilities are softmax over similarities to all texts,
+    averaged over rows. Features must be normalized.
+    """
+
+    similarity = (100.0 * image_features.to(text_features.dtype) @ text_features.T).float().softmax(dim=-1).mean(dim=0)
+    probs, labels = similarity.cpu().topk(top_count)
+
+    return labels.tolist(), (probs * 100).tolist()
+
+
+def rank_batch(image_features, text_features, top_count):
+    """Same as rank, but for a batch of images with one row of image_features each; returns (indices, probabilities)
+    for every image."""
+
+    similarity = (100.0 * image_features.to(text_features.dtype) @ text_features.T).float().softmax(dim=-1)
+    probs, labels = similarity.cpu().topk(top_count, dim=-1)
+
+    return [(row_labels.tolist(), (row_probs * 100).tolist()) for row_labels, row_probs in zip(labels, probs)]
+
+
+class TextFeatureIndex:
+    def __init__(self, model_name, directory=None):
+        self.model_name = model_name
+        self.directory = directory
+        self.loaded = {}
+
+    def path(self, digest):
+        return os.path.join(self.directory or default_directory(), f"{digest}.npy")
+
+    def get(self, items, encode, device, dtype) -> torch.Tensor:
+        """Returns normalized features for items, as a (len(items), features) tensor on the device.
+
+        encode is a function that takes a list of texts and returns a tensor of their features; it's only called if
+        features for items are not in memory or on disk.
+        """
+
+        digest = items_digest(self.model_name, dtype, items)
+
+        features = self.loaded.get(digest)
+        if features is None:
+            array = self.load(digest, len(items))
+            if array is None:
+                array = self.build(digest, items, encode, dtype)
+
+            features = self.loaded[digest] = torch.from_numpy(array).to(device=device, dtype=dtype)
+
+        return features
+
+    def load(self, digest, count):
+        path = self.path(digest)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            array = np.load(path, mmap_mode="c")
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return array if array.ndim == 2 and array.shape[0] == count else None
+
+    def build(self, digest, items, encode, dtype):
+        print(f"Calculating CLIP text features for {len(items)} texts...")
+
+        array = encode_items(items, encode, dtype)
+
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(f"{path}.tmp", "wb") as file:
+            np.save(file, array)
+        os.replace(f"{path}.tmp", path)
+
+        self.prune()
+
+        return array
+
+    def prune(self):
+        directory = os.path.dirname(self.path(""))
+        files = [os.path.join(directory, x) for x in os.listdir(directory) if x.endswith(".npy")]
+        if len(files) <= max_files:
+            return
+
+        files.sort(key=os.path.getmtime)
+        for filename in files[:len(files) - max_files]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def unload(self):
+        """Releases features kept in memory; they will be loaded from disk when needed again."""
+
+        self.loaded.clear()
@@ -0,0 +1,263 @@
+"""Incremental index of files in model directories.
+
+Listing a directory tree with os.walk and looking at every file in it is slow when there are thousands of models. The
+index remembers, for every directory, its modification time and the files and subdirectories in it, and keeps that in
+diskcache so it survives restarts. On refresh, only directories are stat'ed; a directory is listed again only if its
+modification time changed, which happens when files are added to it, removed from it or renamed. Files that are
+modified in place without changing the directory are not noticed until something else in their directory changes, or
+until the index is invalidated, which explicit refreshes from the UI and API do.
+
+Code that builds objects from files (checkpoint info, Lora networks, embeddings) can use file_stat() to find out
+whether a file changed since the last time it looked at it, and reuse what it built before if it didn't.
+
+If enabled in settings, a background thread refreshes all indexes every few seconds and calls callbacks registered
+with add_watch_callback for directories where something changed.
+"""
+
+import concurrent.futures
+import os
+import threading
+import time
+
+from modules import cache, errors, shared
+from modules.util import natural_sort_key
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+watch_callbacks = []
+watch_thread = None
+
+
+def scan_directory(path, mtime_ns):
+    """Lists a directory; returns its index entry."""
+
+    files = {}
+    subdirs = []
+
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                    continue
+
+                stat = entry.stat()
+            except FileNotFoundError:
+                print(f"Skipping broken symlink: {entry.path}")
+                continue
+            except OSError:
+                continue
+
+            files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+    return {"mtime_ns": mtime_ns, "files": files, "subdirs": subdirs}
+
+
+class DirectoryIndex:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirs = None
+        self.version = 0
+        self.sorted_files = None
+        self.rescan = False
+
+    def invalidate(self):
+        """Makes the next refresh list every directory again and stat every file, instead of trusting saved entries."""
+
+        with self.lock:
+            self.rescan = True
+
+    def refresh(self) -> bool:
+        """Brings the index up to date with the filesystem; returns True if anything changed."""
+
+        with self.lock:
+            if self.dirs is None:
+                self.dirs = cache.cache("model-index").get(self.path, None) or {}
+
+            dirs = {}
+            visited = set()
+            stack = [self.path]
+            while stack:
+                dirpath = stack.pop()
+
+                try:
+                    stat = os.stat(dirpath)
+                except OSError:
+                    continue
+
+                if (stat.st_dev, stat.st_ino) in visited:
+                    continue
+                visited.add((stat.st_dev, stat.st_ino))
+
+                entry = self.dirs.get(dirpath)
+                if self.rescan or entry is None or entry["mtime_ns"] != stat.st_mtime_ns:
+                    try:
+                        entry = scan_directory(dirpath, stat.st_mtime_ns)
+                    except OSError:
+                        continue
+
+                dirs[dirpath] = entry
+                stack.extend(os.path.join(dirpath, name) for name in entry["subdirs"])
+
+            changed = dirs != self.dirs
+            self.dirs = dirs
+            self.rescan = False
+
+            if changed:
+                self.version += 1
+                self.sorted_files = None
+                cache.cache("model-index")[self.path] = dirs
+
+            return changed
+
+    def files(self):
+        """Returns a list of (directory, filename) pairs in the same order as util.walk_files."""
+
+        with self.lock:
+            if self.sorted_files is None:
+                dirs = self.dirs or {}
+                self.sorted_files = [(dirpath, filename) for dirpath in sorted(dirs, key=natural_sort_key) for filename in sorted(dirs[dirpath]["files"], key=natural_sort_key)]
+
+            return self.sorted_files
+
+    def stat(self, dirpath, filename):
+        with self.lock:
+            entry = (self.dirs or {}).get(dirpath)
+
+        return None if entry is None else entry["files"].get(filename)
+
+
+def get_index(path) -> DirectoryIndex:
+    path = os.path.normpath(path)
+
+    with indexes_lock:
+        index = indexes.get(path)
+        if index is None:
+            index = indexes[path] = DirectoryIndex(path)
+
+    return index
+
+
+def invalidate(paths):
+    """Makes indexes for paths pick up files changed in place on their next refresh; used for explicit refreshes."""
+
+    for path in paths:
+        if path:
+            get_index(path).invalidate()
+
+
+def walk_files(path, allowed_extensions=None):
+    """Same as util.walk_files, but uses an index for the directory instead of walking it."""
+
+    if not os.path.exists(path):
+        return
+
+    if allowed_extensions is not None:
+        allowed_extensions = set(allowed_extensions)
+
+    index = get_index(path)
+    index.refresh()
+
+    for root, filename in index.files():
+        if allowed_extensions is not None:
+            _, ext = os.path.splitext(filename)
+            if ext.lower() not in allowed_extensions:
+                continue
+
+        if not shared.opts.list_hidden_files and ("/." in root or "\\." in root):
+            continue
+
+        yield os.path.join(root, filename)
+
+
+def file_stat(filename):
+    """Returns (size, mtime in ns) of a file from an index that contains it, or from the filesystem if no index does.
+
+    Returns None if the file does not exist.
+    """
+
+    dirpath, name = os.path.split(os.path.normpath(filename))
+
+    with indexes_lock:
+        candidates = list(indexes.values())
+
+    for index in candidates:
+        stat = index.stat(dirpath, name)
+        if stat is not None:
+            return stat
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    return stat.st_size, stat.st_mtime_ns
+
+
+def map_parallel(func, items):
+    """Returns [func(x) for x in items], calculated on a pool of threads; meant for work dominated by reading files."""
+
+    items = list(items)
+    if len(items) < 2:
+        return [func(x) for x in items]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(items)), thread_name_prefix="model-index") as executor:
+        return list(executor.map(func, items))
+
+
+def add_watch_callback(paths, callback):
+    """Makes callback (without arguments) be called from the watch thread when files change in any of the directories.
+
+    Adding the same callback again replaces its directories.
+    """
+
+    remove_watch_callback(callback)
+    watch_callbacks.append(([os.path.normpath(x) for x in paths if x], callback))
+
+
+def remove_watch_callback(callback):
+    watch_callbacks[:] = [x for x in watch_callbacks if x[1] != callback]
+
+
+def check_for_changes():
+    with indexes_lock:
+        candidates = list(indexes.values())
+
+    changed = {index.path for index in candidates if index.refresh()}
+    if not changed:
+        return
+
+    from modules.call_queue import queue_lock
+
+    for paths, callback in watch_callbacks:
+        if not changed.intersection(paths):
+            continue
+
+        try:
+            with queue_lock:
+                callback()
+        except Exception as e:
+            errors.display(e, f"refreshing after changes in {', '.join(paths)}")
+
+
+def watch_loop():
+    while True:
+        time.sleep(max(float(shared.opts.model_index_watch_interval), 0.5))
+
+        if not shared.opts.model_index_watch:
+            continue
+
+        try:
+            check_for_changes()
+        except Exception as e:
+            errors.display(e, "watching model directories")
+
+
+def start_watching():
+    global watch_thread
+
+    if watch_thread is None:
+        watch_thread = threading.Thread(target=watch_loop, daemon=True, name="model-index-watch")
+        watch_thread.start()
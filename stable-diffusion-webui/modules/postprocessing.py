@@ -1,3 +1,6 @@
+import collections
+import concurrent.futures
+import functools
 import os
 
 from PIL import Image
@@ -6,7 +9,58 @@ from modules import shared, images, devices, scripts, scripts_postprocessing, ui
 from modules.shared import opts
 
 
+def load_image(load):
+    """Calls load to get an image and decodes it; returns the image and its existing PNG info. Runs on a worker thread."""
+
+    image_data = load()
+    image_data.load()
+    image_data = image_data if image_data.mode in ("RGBA", "RGB") else image_data.convert("RGB")
+
+    parameters, existing_pnginfo = images.read_info_from_image(image_data)
+    if parameters:
+        existing_pnginfo["parameters"] = parameters
+
+    return image_data, existing_pnginfo
+
+
+def save_postprocessed_image(pp, outpath, basename, infotext, existing_pnginfo, forced_filename, suffix):
+    """Saves a processed image and its caption. Runs on a worker thread."""
+
+    fullfn, _ = images.save_image(pp.image, path=outpath, basename=basename, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=forced_filename, suffix=suffix)
+
+    if pp.caption:
+        caption_filename = os.path.splitext(fullfn)[0] + ".txt"
+        existing_caption = ""
+        try:
+            with open(caption_filename, encoding="utf8") as file:
+                existing_caption = file.read().strip()
+        except FileNotFoundError:
+            pass
+
+        action = shared.opts.postprocessing_existing_caption_action
+        if action == 'Prepend' and existing_caption:
+            caption = f"{existing_caption} {pp.caption}"
+        elif action == 'Append' and existing_caption:
+            caption = f"{pp.caption} {existing_caption}"
+        elif action == 'Keep' and existing_caption:
+            caption = existing_caption
+        else:
+            caption = pp.caption
+
+        caption = caption.strip()
+        if caption:
+            with open(caption_filename, "w", encoding="utf8") as file:
+                file.write(caption)
+
+
 def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output: bool = True):
+    """Runs postprocessing scripts over images.
+
+    Work is pipelined: a pool of threads reads and decodes images ahead of the one being processed, and another thread
+    saves processed images while next ones are processed. Both are limited to postprocessing_prefetch_images images,
+    so memory use does not grow with the number of images.
+    """
+
     devices.torch_gc()
 
     shared.state.begin(job="extras")
@@ -17,22 +71,19 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
         if extras_mode == 1:
             for img in image_folder:
                 if isinstance(img, Image.Image):
-                    image = images.fix_image(img)
-                    fn = ''
+                    yield functools.partial(images.fix_image, img), ''
                 else:
-                    image = images.read(os.path.abspath(img.name))
-                    fn = os.path.splitext(img.orig_name)[0]
-                yield image, fn
+                    yield functools.partial(images.read, os.path.abspath(img.name)), os.path.splitext(img.orig_name)[0]
         elif extras_mode == 2:
             assert not shared.cmd_opts.hide_ui_dir_config, '--hide-ui-dir-config option must be disabled'
             assert input_dir, 'input directory not selected'
 
             image_list = shared.listfiles(input_dir)
             for filename in image_list:
-                yield filename, filename
+                yield functools.partial(images.read, filename), filename
         else:
             assert image, 'image not selected'
-            yield image, None
+            yield lambda: image, None
 
     if extras_mode == 2 and output_dir != '':
         outpath = output_dir
@@ -44,85 +95,87 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
     data_to_process = list(get_images(extras_mode, image, image_folder, input_dir))
     shared.state.job_count = len(data_to_process)
 
-    for image_placeholder, name in data_to_process:
-        image_data: Image.Image
+    prefetch = max(int(opts.postprocessing_prefetch_images), 1)
 
-        shared.state.nextjob()
-        shared.state.textinfo = name
-        shared.state.skipped = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(prefetch, 4), thread_name_prefix="postprocessing-load") as loader, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="postprocessing-save") as saver:
 
-        if shared.state.interrupted or shared.state.stopping_generation:
-            break
+        # a single thread saves images, so that they get sequence numbers in the same order as they are processed
+        loading = collections.deque()
+        saving = collections.deque()
+        remaining = iter(data_to_process)
 
-        if isinstance(image_placeholder, str):
-            try:
-                image_data = images.read(image_placeholder)
-            except Exception:
-                continue
-        else:
-            image_data = image_placeholder
+        def load_more():
+            while len(loading) < prefetch:
+                item = next(remaining, None)
+                if item is None:
+                    break
 
-        image_data = image_data if image_data.mode in ("RGBA", "RGB") else image_data.convert("RGB")
+                load, name = item
+                loading.append((loader.submit(load_image, load), name))
 
-        parameters, existing_pnginfo = images.read_info_from_image(image_data)
-        if parameters:
-            existing_pnginfo["parameters"] = parameters
+        load_more()
+        while loading:
+            future, name = loading.popleft()
 
-        initial_pp = scripts_postprocessing.PostprocessedImage(image_data)
+            shared.state.nextjob()
+            shared.state.textinfo = name
+            shared.state.skipped = False
 
-        scripts.scripts_postproc.run(initial_pp, args)
+            if shared.state.interrupted or shared.state.stopping_generation:
+                for pending, _ in loading:
+                    pending.cancel()
+                break
 
-        if shared.state.skipped:
-            continue
+            try:
+                image_data, existing_pnginfo = future.result()
+            except Exception:
+                if extras_mode != 2:
+                    raise
 
-        used_suffixes = {}
-        for pp in [initial_pp, *initial_pp.extra_images]:
-            suffix = pp.get_suffix(used_suffixes)
+                continue
+            finally:
+                load_more()
+
+            initial_pp = scripts_postprocessing.PostprocessedImage(image_data)
+
+            scripts.scripts_postproc.run(initial_pp, args)
 
-            if opts.use_original_name_batch and name is not None:
-                basename = os.path.splitext(os.path.basename(name))[0]
-                forced_filename = basename + suffix
-            else:
-                basename = ''
-                forced_filename = None
+            if shared.state.skipped:
+                continue
+
+            used_suffixes = {}
+            for pp in [initial_pp, *initial_pp.extra_images]:
+                suffix = pp.get_suffix(used_suffixes)
 
-            infotext = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in pp.info.items() if v is not None])
+                if opts.use_original_name_batch and name is not None:
+                    basename = os.path.splitext(os.path.basename(name))[0]
+                    forced_filename = basename + suffix
+                else:
+                    basename = ''
+                    forced_filename = None
 
-            if opts.enable_pnginfo:
-                pp.image.info = existing_pnginfo
-                pp.image.info["postprocessing"] = infotext
+                infotext = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in pp.info.items() if v is not None])
 
-            shared.state.assign_current_image(pp.image)
+                # every image gets its own copy: the saving thread adds to it while next images are processed
+                pnginfo = dict(existing_pnginfo)
+                if opts.enable_pnginfo:
+                    pnginfo["postprocessing"] = infotext
+                    pp.image.info = dict(pnginfo)
 
-            if save_output:
-                fullfn, _ = images.save_image(pp.image, path=outpath, basename=basename, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=forced_filename, suffix=suffix)
+                shared.state.assign_current_image(pp.image)
 
-                if pp.caption:
-                    caption_filename = os.path.splitext(fullfn)[0] + ".txt"
-                    existing_caption = ""
-                    try:
-                        with open(caption_filename, encoding="utf8") as file:
-                            existing_caption = file.read().strip()
-                    except FileNotFoundError:
-                        pass
+                if save_output:
+                    while len(saving) >= prefetch:
+                        saving.popleft().result()
 
-                    action = shared.opts.postprocessing_existing_caption_action
-                    if action == 'Prepend' and existing_caption:
-                        caption = f"{existing_caption} {pp.caption}"
-                    elif action == 'Append' and existing_caption:
-                        caption = f"{pp.caption} {existing_caption}"
-                    elif action == 'Keep' and existing_caption:
-                        caption = existing_caption
-                    else:
-                        caption = pp.caption
+                    saving.append(saver.submit(save_postprocessed_image, pp, outpath, basename, infotext, pnginfo, forced_filename, suffix))
 
-                    caption = caption.strip()
-                    if caption:
-                        with open(caption_filename, "w", encoding="utf8") as file:
-                            file.write(caption)
+                if extras_mode != 2 or show_extras_results:
+                    outputs.append(pp.image)
 
-            if extras_mode != 2 or show_extras_results:
-                outputs.append(pp.image)
+        for future in saving:
+            future.result()
 
     devices.torch_gc()
     shared.state.end()
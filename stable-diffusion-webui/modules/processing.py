@@ -16,7 +16,8 @@ from skimage import exposure
 from typing import Any
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, profiling
+import modules.sd_hijack_optimizations
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, profiling, image_save_queue
 from modules.rng import slerp # noqa: F401
 from modules.sd_hijack import model_hijack
 from modules.sd_samplers_common import images_tensor_to_samples, decode_first_stage, approximation_indexes
@@ -622,52 +623,88 @@ class DecodedSamples(list):
     already_decoded = True
 
 
+def decode_latent_with_autofix(model, latent):
+    """
+    Decodes latent with VAE. If the result has NaNs, and settings allow it, converts VAE to a more precise dtype and
+    decodes again; otherwise, raises NansException.
+    """
+
+    sample = decode_first_stage(model, latent)
+
+    try:
+        devices.test_for_nans(sample, "vae")
+    except devices.NansException as e:
+        if shared.opts.auto_vae_precision_bfloat16:
+            autofix_dtype = torch.bfloat16
+            autofix_dtype_text = "bfloat16"
+            autofix_dtype_setting = "Automatically convert VAE to bfloat16"
+            autofix_dtype_comment = ""
+        elif shared.opts.auto_vae_precision:
+            autofix_dtype = torch.float32
+            autofix_dtype_text = "32-bit float"
+            autofix_dtype_setting = "Automatically revert VAE to 32-bit floats"
+            autofix_dtype_comment = "\nTo always start with 32-bit VAE, use --no-half-vae commandline flag."
+        else:
+            raise e
+
+        if devices.dtype_vae == autofix_dtype:
+            raise e
+
+        errors.print_error_explanation(
+            "A tensor with all NaNs was produced in VAE.\n"
+            f"Web UI will now convert VAE into {autofix_dtype_text} and retry.\n"
+            f"To disable this behavior, disable the '{autofix_dtype_setting}' setting.{autofix_dtype_comment}"
+        )
+
+        devices.dtype_vae = autofix_dtype
+        model.first_stage_model.to(devices.dtype_vae)
+
+        sample = decode_first_stage(model, latent)
+
+    return sample
+
+
+def get_vae_decode_batch_size(batch):
+    """Returns how many latents from batch to decode with VAE at once, according to settings and available memory."""
+
+    batch_size = shared.opts.sd_vae_decode_batch_size
+    if batch_size > 0:
+        return batch_size
+
+    # rough estimate of peak memory use of the VAE decoder per pixel of output: a few activations with 128 channels at full resolution
+    pixels = batch.shape[2] * batch.shape[3] * opt_f * opt_f
+    bytes_per_sample = pixels * torch.finfo(devices.dtype_vae).bits // 8 * 512
+
+    available = modules.sd_hijack_optimizations.get_available_vram()
+
+    return max(1, int(available * 0.8) // bytes_per_sample)
+
+
 def decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
     samples = DecodedSamples()
 
     if check_for_nans:
         devices.test_for_nans(batch, "unet")
 
-    for i in range(batch.shape[0]):
-        sample = decode_first_stage(model, batch[i:i + 1])[0]
-
-        if check_for_nans:
-
-            try:
-                devices.test_for_nans(sample, "vae")
-            except devices.NansException as e:
-                if shared.opts.auto_vae_precision_bfloat16:
-                    autofix_dtype = torch.bfloat16
-                    autofix_dtype_text = "bfloat16"
-                    autofix_dtype_setting = "Automatically convert VAE to bfloat16"
-                    autofix_dtype_comment = ""
-                elif shared.opts.auto_vae_precision:
-                    autofix_dtype = torch.float32
-                    autofix_dtype_text = "32-bit float"
-                    autofix_dtype_setting = "Automatically revert VAE to 32-bit floats"
-                    autofix_dtype_comment = "\nTo always start with 32-bit VAE, use --no-half-vae commandline flag."
-                else:
-                    raise e
-
-                if devices.dtype_vae == autofix_dtype:
-                    raise e
+    chunk_size = get_vae_decode_batch_size(batch)
 
-                errors.print_error_explanation(
-                    "A tensor with all NaNs was produced in VAE.\n"
-                    f"Web UI will now convert VAE into {autofix_dtype_text} and retry.\n"
-                    f"To disable this behavior, disable the '{autofix_dtype_setting}' setting.{autofix_dtype_comment}"
-                )
+    for i in range(0, batch.shape[0], chunk_size):
+        chunk = batch[i:i + chunk_size]
 
-                devices.dtype_vae = autofix_dtype
-                model.first_stage_model.to(devices.dtype_vae)
-                batch = batch.to(devices.dtype_vae)
+        if chunk.shape[0] == 1:
+            decoded = decode_latent_with_autofix(model, chunk) if check_for_nans else decode_first_stage(model, chunk)
+        else:
+            decoded = decode_first_stage(model, chunk)
 
-                sample = decode_first_stage(model, batch[i:i + 1])[0]
+            # test_for_nans only looks at the first sample, so every sample has to be checked separately
+            if check_for_nans and any(devices.has_nans(sample, "vae") for sample in decoded):
+                decoded = [decode_latent_with_autofix(model, chunk[j:j + 1])[0] for j in range(chunk.shape[0])]
 
-        if target_device is not None:
-            sample = sample.to(target_device)
+        for sample in decoded:
+            if target_device is not None:
+                sample = sample.to(target_device)
 
-        samples.append(sample)
+            samples.append(sample)
 
     return samples
 
@@ -849,6 +886,9 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
     finally:
         sd_models.apply_token_merging(p.sd_model, 0)
 
+        # images written in background use current settings, so they must be written before overrides are undone
+        image_save_queue.queue.flush()
+
         # restore opts to original state
         if p.override_settings_restore_afterwards:
             for k, v in stored_opts.items():
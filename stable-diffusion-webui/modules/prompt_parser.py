@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import bisect
+import copy
+import functools
 import re
 from collections import namedtuple
 import lark
@@ -25,6 +28,42 @@ plain: /([^\\\[\]():|]|\\.)+/
 %import common.SIGNED_NUMBER -> NUMBER
 """)
 
+parse_cache_size = 4096
+"""How many distinct prompts to remember results of parsing for, for each of the parsing functions below."""
+
+
+def memoize_lists(func):
+    """Memoizes a parsing function that returns a list of lists in a bounded LRU cache.
+
+    Results are stored as tuples, and every caller gets its own copy as lists, so that callers are free to modify them.
+    """
+
+    @functools.lru_cache(maxsize=parse_cache_size)
+    def cached(*args, **kwargs):
+        return tuple(tuple(x) for x in func(*args, **kwargs))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return [list(x) for x in cached(*args, **kwargs)]
+
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@functools.lru_cache(maxsize=parse_cache_size)
+def parse_schedule(prompt):
+    """Returns lark parse tree for prompt, or None if it can't be parsed. The tree is shared between callers and must not be modified."""
+
+    try:
+        return schedule_parser.parse(prompt)
+    except lark.exceptions.LarkError:
+        if 0:
+            import traceback
+            traceback.print_exc()
+        return None
+
+
 def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=None, use_old_scheduling=False):
     """
     >>> g = lambda p: get_learned_conditioning_prompt_schedules([p], 10)[0]
@@ -63,6 +102,14 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
     [[5, 'a  c'], [10, 'a b c']]
     """
 
+    promptdict = {prompt: get_prompt_schedule(prompt, base_steps, hires_steps, use_old_scheduling) for prompt in set(prompts)}
+    return [promptdict[prompt] for prompt in prompts]
+
+
+@memoize_lists
+def get_prompt_schedule(prompt, base_steps, hires_steps=None, use_old_scheduling=False):
+    """Returns prompt schedule for one prompt; see get_learned_conditioning_prompt_schedules."""
+
     if hires_steps is None or use_old_scheduling:
         int_offset = 0
         flt_offset = 0
@@ -119,18 +166,12 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
                     yield child
         return AtStep().transform(tree)
 
-    def get_schedule(prompt):
-        try:
-            tree = schedule_parser.parse(prompt)
-        except lark.exceptions.LarkError:
-            if 0:
-                import traceback
-                traceback.print_exc()
-            return [[steps, prompt]]
-        return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
-
-    promptdict = {prompt: get_schedule(prompt) for prompt in set(prompts)}
-    return [promptdict[prompt] for prompt in prompts]
+    tree = parse_schedule(prompt)
+    if tree is None:
+        return [[steps, prompt]]
+
+    tree = copy.deepcopy(tree)  # collect_steps modifies the tree
+    return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
 
 
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
@@ -172,6 +213,8 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
         ]
     ]
     """
+    from modules import cond_cache
+
     res = []
 
     prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps, hires_steps, use_old_scheduling)
@@ -185,7 +228,7 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
             continue
 
         texts = SdConditioning([x[1] for x in prompt_schedule], copy_from=prompts)
-        conds = model.get_learned_conditioning(texts)
+        conds = cond_cache.get_learned_conditioning(model, texts)
 
         cond_schedule = []
         for i, (end_at_step, _) in enumerate(prompt_schedule):
@@ -349,6 +392,78 @@ def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
     return conds_list, stacked
 
 
+class ConditioningTable:
+    """Conditioning for a batch of prompt schedules, indexed by ranges of sampling steps in which none of the schedules
+    change. Created once per sampling pass.
+
+    Getting the batch for a step is a binary search; the batch is stacked and padded only when the step enters a new
+    range, rather than on every step. Results are the same as from reconstruct_cond_batch and
+    reconstruct_multicond_batch, but the same tensor is returned for all steps of a range, so it must not be
+    modified in place.
+    """
+
+    def __init__(self, schedules: list[list[ScheduledPromptConditioning]], device=None, dtype=None):
+        self.schedules = schedules
+        self.schedule_ends = [[entry.end_at_step for entry in schedule] for schedule in schedules]
+        self.boundaries = sorted({end for ends in self.schedule_ends for end in ends})
+        self.device = device
+        self.dtype = dtype
+
+        self.current_range = None
+        self.current = None
+
+    def get(self, current_step):
+        range_index = bisect.bisect_left(self.boundaries, current_step)
+
+        if range_index != self.current_range:
+            self.current = self.make_batch(current_step)
+            self.current_range = range_index
+
+        if isinstance(self.current, dict):
+            return DictWithShape(self.current, self.current['crossattn'].shape)
+
+        return self.current
+
+    def make_batch(self, current_step):
+        conds = []
+        for schedule, ends in zip(self.schedules, self.schedule_ends):
+            target_index = bisect.bisect_left(ends, current_step)
+            if target_index >= len(ends):
+                target_index = 0
+
+            conds.append(schedule[target_index].cond)
+
+        if isinstance(conds[0], dict):
+            return {k: stack_conds([x[k] for x in conds]) for k in conds[0].keys()}
+
+        return stack_conds(conds).to(device=self.device or conds[0].device, dtype=self.dtype or conds[0].dtype)
+
+
+class MulticondConditioningTable:
+    """Same as ConditioningTable, but for MulticondLearnedConditioning: returns the same results as reconstruct_multicond_batch."""
+
+    def __init__(self, c: MulticondLearnedConditioning):
+        schedules = []
+        self.conds_list = []
+        for composable_prompts in c.batch:
+            conds_for_batch = []
+
+            for composable_prompt in composable_prompts:
+                conds_for_batch.append((len(schedules), composable_prompt.weight))
+                schedules.append(composable_prompt.schedules)
+
+            self.conds_list.append(conds_for_batch)
+
+        param = c.batch[0][0].schedules[0].cond
+        if isinstance(param, dict):
+            self.table = ConditioningTable(schedules)
+        else:
+            self.table = ConditioningTable(schedules, device=param.device, dtype=param.dtype)
+
+    def get(self, current_step):
+        return self.conds_list, self.table.get(current_step)
+
+
 re_attention = re.compile(r"""
 \\\(|
 \\\)|
@@ -367,6 +482,7 @@ re_attention = re.compile(r"""
 
 re_break = re.compile(r"\s*\bBREAK\b\s*", re.S)
 
+@memoize_lists
 def parse_prompt_attention(text):
     """
     Parses a string with attention tokens and returns a list of pairs: text and its associated weight.
@@ -9,7 +9,7 @@ from torch import einsum
 from ldm.util import default
 from einops import rearrange
 
-from modules import shared, errors, devices, sub_quadratic_attention
+from modules import shared, errors, devices, sub_quadratic_attention, attention_autotune
 from modules.hypernetworks import hypernetwork
 
 import ldm.modules.attention
@@ -143,6 +143,19 @@ class SdOptimizationDoggettx(SdOptimization):
         sgm.modules.diffusionmodules.model.AttnBlock.forward = cross_attention_attnblock_forward
 
 
+class SdOptimizationAutotune(SdOptimization):
+    name = "auto-tune"
+    label = "fastest for each shape, benchmarked on first use"
+    cmd_opt = "opt_attention_autotune"
+    priority = 5
+
+    def apply(self):
+        ldm.modules.attention.CrossAttention.forward = autotune_attention_forward
+        ldm.modules.diffusionmodules.model.AttnBlock.forward = autotune_attnblock_forward
+        sgm.modules.attention.CrossAttention.forward = autotune_attention_forward
+        sgm.modules.diffusionmodules.model.AttnBlock.forward = autotune_attnblock_forward
+
+
 def list_optimizers(res):
     res.extend([
         SdOptimizationXformers(),
@@ -152,6 +165,7 @@ def list_optimizers(res):
         SdOptimizationV1(),
         SdOptimizationInvokeAI(),
         SdOptimizationDoggettx(),
+        SdOptimizationAutotune(),
     ])
 
 
@@ -462,6 +476,41 @@ def sub_quad_attention(q, k, v, q_chunk_size=1024, kv_chunk_size=None, kv_chunk_
         )
 
 
+attention_tuner = attention_autotune.AttentionAutotuner(lambda: get_available_vram() * shared.opts.attention_autotune_memory_budget / 100)
+
+
+def autotune_attention_forward(self, x, context=None, mask=None, **kwargs):
+    assert mask is None, "attention-mask not currently implemented for auto-tuned attention."
+
+    h = self.heads
+
+    q = self.to_q(x)
+    context = default(context, x)
+
+    context_k, context_v = hypernetwork.apply_hypernetworks(shared.loaded_hypernetworks, context)
+    k = self.to_k(context_k)
+    v = self.to_v(context_v)
+    del context, context_k, context_v, x
+
+    q, k, v = (t.unflatten(-1, (h, -1)).transpose(1, 2).flatten(end_dim=1) for t in (q, k, v))
+
+    if q.device.type == 'mps':
+        q, k, v = q.contiguous(), k.contiguous(), v.contiguous()
+
+    dtype = q.dtype
+    if shared.opts.upcast_attn:
+        q, k, v = q.float(), k.float(), v.float()
+
+    with devices.without_autocast(disable=not shared.opts.upcast_attn):
+        x = attention_tuner(q, k, v)
+
+    x = x.to(dtype)
+
+    x = x.unflatten(0, (-1, h)).transpose(1, 2).flatten(start_dim=2)
+
+    return self.to_out(x)
+
+
 def get_xformers_flash_attention_op(q, k, v):
     if not shared.cmd_opts.xformers_flash_attention:
         return None
@@ -675,3 +724,25 @@ def sub_quad_attnblock_forward(self, x):
     out = rearrange(out, 'b (h w) c -> b c h w', h=h)
     out = self.proj_out(out)
     return x + out
+
+
+def autotune_attnblock_forward(self, x):
+    h_ = x
+    h_ = self.norm(h_)
+    q = self.q(h_)
+    k = self.k(h_)
+    v = self.v(h_)
+    b, c, h, w = q.shape
+    q, k, v = (rearrange(t, 'b c h w -> b (h w) c') for t in (q, k, v))
+    dtype = q.dtype
+    if shared.opts.upcast_attn:
+        q, k, v = q.float(), k.float(), v.float()
+    q = q.contiguous()
+    k = k.contiguous()
+    v = v.contiguous()
+    with devices.without_autocast(disable=not shared.opts.upcast_attn):
+        out = attention_tuner(q, k, v)
+    out = out.to(dtype)
+    out = rearrange(out, 'b (h w) c -> b c h w', h=h)
+    out = self.proj_out(out)
+    return x + out
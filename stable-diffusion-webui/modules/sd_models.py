@@ -12,7 +12,7 @@ from omegaconf import OmegaConf, ListConfig
 from urllib import request
 import ldm.modules.midas as midas
 
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, cache, extra_networks, processing, lowvram, sd_hijack, patches
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, cache, extra_networks, processing, lowvram, sd_hijack, patches, model_index
 from modules.timer import Timer
 from modules.shared import opts
 import tomesd
@@ -24,6 +24,7 @@ model_path = os.path.abspath(os.path.join(paths.models_path, model_dir))
 checkpoints_list = {}
 checkpoint_aliases = {}
 checkpoint_alisases = checkpoint_aliases  # for compatibility with old name
+checkpoint_infos_by_filename = {}
 checkpoints_loaded = collections.OrderedDict()
 
 
@@ -87,7 +88,7 @@ class CheckpointInfo:
         self.name = name
         self.name_for_extra = os.path.splitext(os.path.basename(filename))[0]
         self.model_name = os.path.splitext(name.replace("/", "_").replace("\\", "_"))[0]
-        self.hash = model_hash(filename)
+        self.hash = cache.cached_data_for_file('checkpoint-model-hash', "checkpoint/" + name, filename, lambda: model_hash(filename))
 
         self.sha256 = hashes.sha256_from_cache(self.filename, f"checkpoint/{name}")
         self.shorthash = self.sha256[0:10] if self.sha256 else None
@@ -104,10 +105,24 @@ class CheckpointInfo:
         for id in self.ids:
             checkpoint_aliases[id] = self
 
-    def calculate_shorthash(self):
-        self.sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}")
-        if self.sha256 is None:
-            return
+    def calculate_shorthash(self, wait=True, callback=None):
+        """Calculates hash of the checkpoint if it's not known and returns its short version.
+
+        If wait is False and the hash is not known yet, returns None and calculates the hash in background; this object
+        is updated when it's ready, and callback, if specified, is called with the short hash after that.
+        """
+
+        def on_hash_calculated(sha256):
+            shorthash = self.calculate_shorthash()
+            if callback is not None:
+                callback(shorthash)
+
+        # the callback may already have run and filled in the hash, so it's not overwritten with None
+        sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}", wait=wait, callback=on_hash_calculated)
+        if sha256 is None:
+            return self.shorthash if self.sha256 else None
+
+        self.sha256 = sha256
 
         shorthash = self.sha256[0:10]
         if self.shorthash == self.sha256[0:10]:
@@ -172,9 +187,21 @@ def list_models():
     elif cmd_ckpt is not None and cmd_ckpt != shared.default_sd_model_file:
         print(f"Checkpoint in --ckpt argument not found (Possible it was moved to {model_path}: {cmd_ckpt}", file=sys.stderr)
 
+    # reuse CheckpointInfo objects for files that did not change since last time, and create others in parallel
+    known = dict(checkpoint_infos_by_filename)
+    checkpoint_infos_by_filename.clear()
+
+    stats = {filename: model_index.file_stat(filename) for filename in model_list}
+    changed = [filename for filename in model_list if filename not in known or known[filename][0] != stats[filename]]
+    for filename, checkpoint_info in zip(changed, model_index.map_parallel(CheckpointInfo, changed)):
+        known[filename] = (stats[filename], checkpoint_info)
+
     for filename in model_list:
-        checkpoint_info = CheckpointInfo(filename)
+        checkpoint_info = known[filename][1]
         checkpoint_info.register()
+        checkpoint_infos_by_filename[filename] = (stats[filename], checkpoint_info)
+
+    hashes.prehash((info.filename, f"checkpoint/{info.name}", False, None) for info in checkpoints_list.values() if info.sha256 is None)
 
 
 re_strip_checksum = re.compile(r"\s*\[[^]]+]\s*$")
@@ -330,7 +357,7 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
 
 
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
+    sd_model_hash = checkpoint_info.calculate_shorthash(wait=not shared.opts.sd_checkpoint_hash_in_background)
     timer.record("calculate hash")
 
     if checkpoint_info in checkpoints_loaded:
@@ -408,7 +435,15 @@ def set_model_fields(model):
 
 
 def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
+    def on_hash_calculated(shorthash):
+        if model.sd_checkpoint_info is checkpoint_info:
+            model.sd_model_hash = shorthash
+            shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+
+    # set before hashing, because the callback can run before this function returns
+    model.sd_checkpoint_info = checkpoint_info
+
+    sd_model_hash = checkpoint_info.calculate_shorthash(wait=not shared.opts.sd_checkpoint_hash_in_background, callback=on_hash_calculated)
     timer.record("calculate hash")
 
     if devices.fp8:
@@ -524,9 +559,8 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     while len(checkpoints_loaded) > shared.opts.sd_checkpoint_cache:
         checkpoints_loaded.popitem(last=False)
 
-    model.sd_model_hash = sd_model_hash
+    model.sd_model_hash = checkpoint_info.shorthash if checkpoint_info.sha256 else sd_model_hash
     model.sd_model_checkpoint = checkpoint_info.filename
-    model.sd_checkpoint_info = checkpoint_info
     shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
 
     if hasattr(model, 'logvar'):
@@ -63,6 +63,9 @@ class CFGDenoiser(torch.nn.Module):
         self.need_last_noise_uncond = False
         self.last_noise_uncond = None
 
+        self.cond_tables = {}
+        """conditioning tables for cond/uncond objects used in current sampling pass, by id of the object"""
+
         # NOTE: masking before denoising can cause the original latents to be oversmoothed
         # as the original latents do not have noise
         self.mask_before_denoising = False
@@ -90,6 +93,14 @@ class CFGDenoiser(torch.nn.Module):
     def get_pred_x0(self, x_in, x_out, sigma):
         return x_out
 
+    def get_cond_table(self, cond, make_table):
+        source, table = self.cond_tables.get(id(cond), (None, None))
+        if source is not cond:
+            table = make_table(cond)
+            self.cond_tables[id(cond)] = (cond, table)
+
+        return table
+
     def update_inner_model(self):
         self.model_wrap = None
 
@@ -165,8 +176,8 @@ class CFGDenoiser(torch.nn.Module):
         # so is_edit_model is set to False to support AND composition.
         is_edit_model = shared.sd_model.cond_stage_key == "edit" and self.image_cfg_scale is not None and self.image_cfg_scale != 1.0
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        uncond = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+        conds_list, tensor = self.get_cond_table(cond, prompt_parser.MulticondConditioningTable).get(self.step)
+        uncond = self.get_cond_table(uncond, prompt_parser.ConditioningTable).get(self.step)
 
         assert not is_edit_model or all(len(conds) == 1 for conds in conds_list), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
@@ -1,9 +1,10 @@
+import functools
 import inspect
 from collections import namedtuple
 import numpy as np
 import torch
 from PIL import Image
-from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, shared, sd_models
+from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, sd_vae_tiled, shared, sd_models
 from modules.shared import opts, state
 import k_diffusion.sampling
 
@@ -34,6 +35,21 @@ def setup_img2img_steps(p, steps=None):
 approximation_indexes = {"Full": 0, "Approx NN": 1, "Approx cheap": 2, "TAESD": 3}
 
 
+def use_tiled_vae(height, width):
+    """Tells whether an image of the specified size in pixels should be encoded/decoded by VAE in tiles."""
+
+    threshold = opts.sd_vae_tiled_threshold
+    return threshold > 0 and height * width > threshold * 1024 * 1024
+
+
+def get_vae_tile_size():
+    """Returns tile size and overlap for tiled VAE in pixels, rounded to multiples of 8 so that they map to whole latent pixels."""
+
+    tile_size = max(int(opts.sd_vae_tile_size) // 8 * 8, 64)
+    overlap = min(max(int(opts.sd_vae_tile_overlap) // 8 * 8, 0), tile_size // 2)
+    return tile_size, overlap
+
+
 def samples_to_images_tensor(sample, approximation=None, model=None):
     """Transforms 4-channel latent space images into 3-channel RGB image tensors, with values in range [-1, 1]."""
 
@@ -55,7 +71,12 @@ def samples_to_images_tensor(sample, approximation=None, model=None):
         if model is None:
             model = shared.sd_model
         with torch.no_grad(), devices.without_autocast(): # fixes an issue with unstable VAEs that are flaky even in fp32
-            x_sample = model.decode_first_stage(sample.to(model.first_stage_model.dtype))
+            sample = sample.to(model.first_stage_model.dtype)
+            if use_tiled_vae(sample.shape[-2] * 8, sample.shape[-1] * 8):
+                tile_size, overlap = get_vae_tile_size()
+                x_sample = sd_vae_tiled.tiled_apply(model.decode_first_stage, sample, model.first_stage_model, tile_size=tile_size // 8, overlap=overlap // 8)
+            else:
+                x_sample = model.decode_first_stage(sample)
 
     return x_sample
 
@@ -99,15 +120,21 @@ def images_tensor_to_samples(image, approximation=None, model=None):
 
         image = image.to(shared.device, dtype=devices.dtype_vae)
         image = image * 2 - 1
+
+        def encode(x):
+            return model.get_first_stage_encoding(model.encode_first_stage(x))
+
+        if use_tiled_vae(*image.shape[-2:]):
+            tile_size, overlap = get_vae_tile_size()
+            encode = functools.partial(sd_vae_tiled.tiled_encode, model, tile_size=tile_size, overlap=overlap)
+
         if len(image) > 1:
             x_latent = torch.stack([
-                model.get_first_stage_encoding(
-                    model.encode_first_stage(torch.unsqueeze(img, 0))
-                )[0]
+                encode(torch.unsqueeze(img, 0))[0]
                 for img in image
             ])
         else:
-            x_latent = model.get_first_stage_encoding(model.encode_first_stage(image))
+            x_latent = encode(image)
 
     return x_latent
 
@@ -289,6 +316,7 @@ class Sampler:
         self.model_wrap_cfg.mask = p.mask if hasattr(p, 'mask') else None
         self.model_wrap_cfg.nmask = p.nmask if hasattr(p, 'nmask') else None
         self.model_wrap_cfg.step = 0
+        self.model_wrap_cfg.cond_tables.clear()
         self.model_wrap_cfg.image_cfg_scale = getattr(p, 'image_cfg_scale', None)
         self.eta = p.eta if p.eta is not None else getattr(opts, self.eta_option_field, 0.0)
         self.s_min_uncond = getattr(p, 's_min_uncond', 0.0)
@@ -2,9 +2,8 @@ import os
 import collections
 from dataclasses import dataclass
 
-from modules import paths, shared, devices, script_callbacks, sd_models, extra_networks, lowvram, sd_hijack, hashes
+from modules import paths, shared, devices, script_callbacks, sd_models, extra_networks, lowvram, sd_hijack, hashes, model_index
 
-import glob
 from copy import deepcopy
 
 
@@ -72,32 +71,23 @@ def get_filename(filepath):
 def refresh_vae_list():
     vae_dict.clear()
 
-    paths = [
-        os.path.join(sd_models.model_path, '**/*.vae.ckpt'),
-        os.path.join(sd_models.model_path, '**/*.vae.pt'),
-        os.path.join(sd_models.model_path, '**/*.vae.safetensors'),
-        os.path.join(vae_path, '**/*.ckpt'),
-        os.path.join(vae_path, '**/*.pt'),
-        os.path.join(vae_path, '**/*.safetensors'),
+    checkpoint_vae_suffixes = ('.vae.ckpt', '.vae.pt', '.vae.safetensors')
+    vae_extensions = ('.ckpt', '.pt', '.safetensors')
+
+    places = [
+        (sd_models.model_path, checkpoint_vae_suffixes),
+        (vae_path, vae_extensions),
     ]
 
     if shared.cmd_opts.ckpt_dir is not None and os.path.isdir(shared.cmd_opts.ckpt_dir):
-        paths += [
-            os.path.join(shared.cmd_opts.ckpt_dir, '**/*.vae.ckpt'),
-            os.path.join(shared.cmd_opts.ckpt_dir, '**/*.vae.pt'),
-            os.path.join(shared.cmd_opts.ckpt_dir, '**/*.vae.safetensors'),
-        ]
+        places.append((shared.cmd_opts.ckpt_dir, checkpoint_vae_suffixes))
 
     if shared.cmd_opts.vae_dir is not None and os.path.isdir(shared.cmd_opts.vae_dir):
-        paths += [
-            os.path.join(shared.cmd_opts.vae_dir, '**/*.ckpt'),
-            os.path.join(shared.cmd_opts.vae_dir, '**/*.pt'),
-            os.path.join(shared.cmd_opts.vae_dir, '**/*.safetensors'),
-        ]
+        places.append((shared.cmd_opts.vae_dir, vae_extensions))
 
     candidates = []
-    for path in paths:
-        candidates += glob.iglob(path, recursive=True)
+    for place, suffixes in places:
+        candidates += [filepath for filepath in model_index.walk_files(place, allowed_extensions=vae_extensions) if filepath.endswith(suffixes)]
 
     for filepath in candidates:
         name = get_filename(filepath)
@@ -0,0 +1,278 @@
+"""Tiled VAE encoding and decoding.
+
+The image (or latent) is split into overlapping tiles that are processed one at a time and blended back together
+with weights that ramp linearly across the overlap, so peak memory depends on tile size rather than image size.
+
+Each tile on its own would be normalized with its own GroupNorm statistics, which shows up as tiles with visibly
+different brightness and contrast. To avoid that, the model is first run on a downscaled copy of the whole input that
+fits into one tile, the mean and variance seen by every GroupNorm layer are recorded, and all tiles are then
+normalized with those recorded statistics.
+
+When encoding, tiles are blended as latent distributions (mean and log variance) and a single latent is sampled from
+the blended distribution, rather than blending latents that were sampled separately for each tile.
+
+Run as `python -m modules.sd_vae_tiled` to compare time and peak memory of decoding with and without tiles, using a
+randomly initialized decoder shaped like SD's VAE decoder; it works without a GPU, but peak memory is only measured
+on CUDA.
+"""
+
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+def tile_positions(size: int, tile_size: int, overlap: int) -> list[int]:
+    """Returns start offsets of tiles of tile_size covering size, with neighbouring tiles overlapping by at least overlap."""
+
+    if size <= tile_size:
+        return [0]
+
+    stride = max(tile_size - overlap, 1)
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def blend_ramp(length: int, ramp: int, ramp_start: bool, ramp_end: bool, device=None) -> torch.Tensor:
+    """1D blending weights for a tile: 1 in the middle, linearly rising/falling over ramp elements on sides that overlap
+    with a neighbouring tile. Weights are never zero so every output element gets a contribution."""
+
+    weights = torch.ones(length, device=device)
+    ramp = min(ramp, length // 2)
+    if ramp <= 0:
+        return weights
+
+    values = torch.arange(1, ramp + 1, device=device) / (ramp + 1)
+    if ramp_start:
+        weights[:ramp] = values
+    if ramp_end:
+        weights[-ramp:] = values.flip(0)
+
+    return weights
+
+
+class GroupNormStats:
+    """Context manager that makes all GroupNorm layers of a model use statistics recorded during one pass for all
+    following passes.
+
+    Call start_pass(record=True) before the pass that should record statistics, and start_pass(record=False) before
+    every pass that should reuse them. Layers are matched to recorded statistics by the order in which they are called.
+    """
+
+    def __init__(self, model: torch.nn.Module):
+        self.layers = [module for module in model.modules() if isinstance(module, torch.nn.GroupNorm)]
+        self.stats = []
+        self.record = True
+        self.index = 0
+
+    def __enter__(self):
+        for layer in self.layers:
+            layer.forward = self.make_forward(layer)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for layer in self.layers:
+            layer.__dict__.pop('forward', None)
+
+    def start_pass(self, record: bool):
+        self.record = record
+        self.index = 0
+        if record:
+            self.stats.clear()
+
+    def make_forward(self, layer):
+        def forward(x):
+            return self.forward(layer, x)
+
+        return forward
+
+    def forward(self, layer: torch.nn.GroupNorm, x: torch.Tensor) -> torch.Tensor:
+        b, c = x.shape[:2]
+        grouped = x.reshape(b, layer.num_groups, -1)
+
+        if self.record or self.index >= len(self.stats):
+            var, mean = torch.var_mean(grouped.float(), dim=-1, correction=0)
+            if self.record:
+                self.stats.append((mean, var))
+        else:
+            mean, var = self.stats[self.index]
+
+        self.index += 1
+
+        scale = torch.rsqrt(var + layer.eps).to(x.dtype).unsqueeze(-1)
+        shift = (-mean.to(x.dtype)).unsqueeze(-1) * scale
+        out = (grouped * scale + shift).reshape(x.shape)
+
+        if layer.affine:
+            shape = (1, c) + (1,) * (x.ndim - 2)
+            out = out * layer.weight.reshape(shape) + layer.bias.reshape(shape)
+
+        return out
+
+
+def downscaled_for_stats(x: torch.Tensor, tile_size: int, align: int) -> torch.Tensor:
+    """Returns x downscaled so that it fits into one tile, with sides that are multiples of align."""
+
+    h, w = x.shape[-2:]
+    ratio = min(tile_size / h, tile_size / w, 1)
+    size = (max(int(h * ratio) // align * align, align), max(int(w * ratio) // align * align, align))
+    if size == (h, w):
+        return x
+
+    return F.interpolate(x, size=size, mode="nearest")
+
+
+def tiled_apply(fn, x: torch.Tensor, model: torch.nn.Module, *, tile_size: int, overlap: int, align: int = 1) -> torch.Tensor:
+    """Applies fn to x in overlapping tiles of tile_size and blends the results.
+
+    fn must be a spatially resizing function such as VAE encode or decode (output size is input size times a constant
+    factor), and model must be the module that contains the GroupNorm layers fn uses. tile_size and overlap are in
+    units of x and should be multiples of align so that tile offsets map to whole output pixels.
+    """
+
+    h, w = x.shape[-2:]
+    h_positions = tile_positions(h, tile_size, overlap)
+    w_positions = tile_positions(w, tile_size, overlap)
+
+    if len(h_positions) == 1 and len(w_positions) == 1:
+        return fn(x)
+
+    with GroupNormStats(model) as stats:
+        stats.start_pass(record=True)
+        fn(downscaled_for_stats(x, tile_size, align))
+
+        result = None
+        weights = None
+        for h_idx in h_positions:
+            for w_idx in w_positions:
+                tile = x[..., h_idx:h_idx + tile_size, w_idx:w_idx + tile_size]
+
+                stats.start_pass(record=False)
+                out = fn(tile)
+
+                scale = out.shape[-1] / tile.shape[-1]
+                if result is None:
+                    result = torch.zeros(out.shape[:-2] + (round(h * scale), round(w * scale)), device=out.device, dtype=out.dtype)
+                    weights = torch.zeros((round(h * scale), round(w * scale)), device=out.device, dtype=out.dtype)
+
+                ramp = round(overlap * scale)
+                out_h, out_w = out.shape[-2:]
+                y0, x0 = round(h_idx * scale), round(w_idx * scale)
+                mask = torch.outer(
+                    blend_ramp(out_h, ramp, h_idx > 0, h_idx + tile_size < h, device=out.device),
+                    blend_ramp(out_w, ramp, w_idx > 0, w_idx + tile_size < w, device=out.device),
+                ).to(out.dtype)
+
+                result[..., y0:y0 + out_h, x0:x0 + out_w].add_(out * mask)
+                weights[y0:y0 + out_h, x0:x0 + out_w].add_(mask)
+
+    return result.div_(weights)
+
+
+def tiled_encode(model, x: torch.Tensor, *, tile_size: int, overlap: int) -> torch.Tensor:
+    """Encodes images x with the VAE of model in tiles; returns latents like
+    model.get_first_stage_encoding(model.encode_first_stage(x)) does.
+
+    If the VAE returns a distribution (an object with parameters, like DiagonalGaussianDistribution), parameters of
+    tiles are blended and the latent is sampled once from the result.
+    """
+
+    distribution_type = None
+
+    def encode(tile):
+        nonlocal distribution_type
+
+        encoded = model.encode_first_stage(tile)
+        parameters = getattr(encoded, "parameters", None)
+        if not isinstance(parameters, torch.Tensor):
+            return encoded
+
+        distribution_type = type(encoded)
+        return parameters
+
+    encoded = tiled_apply(encode, x, model.first_stage_model, tile_size=tile_size, overlap=overlap, align=8)
+    if distribution_type is not None:
+        encoded = distribution_type(encoded)
+
+    return model.get_first_stage_encoding(encoded)
+
+
+class BenchmarkDecoder(torch.nn.Module):
+    """A stand-in for SD's VAE decoder: GroupNorm and 3x3 convolutions at three 2x upscaling levels."""
+
+    def __init__(self, channels=128):
+        super().__init__()
+
+        layers = [torch.nn.Conv2d(4, channels, 3, padding=1)]
+        for _ in range(3):
+            layers += [torch.nn.GroupNorm(32, channels), torch.nn.SiLU(), torch.nn.Conv2d(channels, channels, 3, padding=1), torch.nn.Upsample(scale_factor=2, mode="nearest")]
+        layers += [torch.nn.GroupNorm(32, channels), torch.nn.SiLU(), torch.nn.Conv2d(channels, 3, 3, padding=1)]
+
+        self.layers = torch.nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.layers(x)
+
+
+def benchmark_decode(fn, x, repeats):
+    """Returns the best of repeats runs of fn(x) in seconds, peak memory allocated while running on CUDA in bytes (0 on
+    other devices), and the result."""
+
+    device = x.device
+    peak = 0
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        allocated = torch.cuda.memory_allocated(device)
+
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn(x)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        best = min(best, time.perf_counter() - start)
+
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device) - allocated
+
+    return best, peak, out
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark tiled VAE decoding against decoding the whole latent at once.")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--width", type=int, default=1024, help="image width in pixels")
+    parser.add_argument("--height", type=int, default=1024, help="image height in pixels")
+    parser.add_argument("--channels", type=int, default=128, help="channels of the decoder; SD's decoder has up to 512")
+    parser.add_argument("--tile-sizes", type=int, nargs="+", default=[32, 64], help="tile sizes to try, in latent pixels")
+    parser.add_argument("--overlap", type=int, default=8, help="overlap of tiles, in latent pixels")
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = BenchmarkDecoder(args.channels).to(device)
+    x = torch.randn(1, 4, args.height // 8, args.width // 8, device=device)
+
+    def memory(peak):
+        return f" {peak / 1024 / 1024:9.1f} MB" if device.type == "cuda" else ""
+
+    with torch.no_grad():
+        seconds, peak, expected = benchmark_decode(model, x, args.repeats)
+        print(f"whole latent {x.shape[-1]}x{x.shape[-2]}: {seconds * 1000:9.1f} ms{memory(peak)}")
+
+        for tile_size in args.tile_sizes:
+            def decode(x, tile_size=tile_size):
+                return tiled_apply(model, x, model, tile_size=tile_size, overlap=args.overlap)
+
+            seconds, peak, out = benchmark_decode(decode, x, args.repeats)
+            difference = (out - expected).abs().max().item()
+            print(f"tiles of {tile_size:4}:      {seconds * 1000:9.1f} ms{memory(peak)}, max difference {difference:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Sequence numbers for saved images without listing the directory for every image.
+
+The next number for a directory and basename is found by listing the directory once per process; after that, numbers
+are taken from a counter kept in the diskcache, which is safe to use from multiple threads and processes at the same
+time. The directory is listed again if it was deleted and created anew, or if a number given out turns out to be
+used by a file that something else has written.
+
+The result of the last listing is kept with the counter. If a listing finds fewer files than the one before, files
+were removed, and numbering continues from what the listing found, like it did when the directory was listed for every
+image; so numbers start over after the directory is emptied, from the next start of webui. Otherwise the counter is
+not moved back, as a lower listing may just mean that another process has not written its files yet.
+"""
+
+import os
+import threading
+
+subsection = "sequence-numbers"
+max_attempts = 500
+
+
+class SequenceNumbers:
+    def __init__(self, scan, storage=None):
+        """scan is a function that lists the directory; it takes path and basename, and returns the first unused
+        number. storage is a diskcache.Cache; by default, a subsection of webui's cache is used."""
+
+        self.scan = scan
+        self.storage = storage
+        self.lock = threading.Lock()
+        self.scanned = set()
+
+    def get_storage(self):
+        if self.storage is None:
+            from modules import cache
+
+            self.storage = cache.cache(subsection)
+
+        return self.storage
+
+    def allocate(self, path, basename, filename=None):
+        """Returns the next sequence number for an image saved into path, and makes sure it's not returned again.
+
+        filename, if specified, is a function that returns the full path of the file for a number; numbers for which
+        the file already exists are skipped, and the directory is listed again, because something else wrote it.
+        """
+
+        for _ in range(max_attempts):
+            number = self.next_number(path, basename)
+            if filename is None or not os.path.exists(filename(number)):
+                break
+
+            self.invalidate(path, basename)
+
+        return number
+
+    def next_number(self, path, basename):
+        key = f"{os.path.abspath(path)}\n{basename}"
+        stat = os.stat(path)
+        identity = (stat.st_dev, stat.st_ino)
+
+        with self.lock:
+            scanned = key in self.scanned
+
+        first_free = None if scanned else self.scan(path, basename)
+
+        storage = self.get_storage()
+        with storage.transact():
+            stored = storage.get(key)
+            if stored is not None and tuple(stored[0]) != identity:
+                stored = None
+
+            if stored is None and first_free is None:
+                first_free = self.scan(path, basename)
+
+            counter = stored[1] if stored is not None else 0
+            last_scan = stored[2] if stored is not None and len(stored) > 2 else None
+
+            if first_free is None:
+                number = counter
+            elif last_scan is not None and first_free < last_scan:
+                number = first_free  # files were removed
+            else:
+                number = max(counter, first_free)
+
+            storage.set(key, (identity, number + 1, first_free if first_free is not None else last_scan))
+
+        with self.lock:
+            self.scanned.add(key)
+
+        return number
+
+    def invalidate(self, path, basename):
+        """Makes the next allocate list the directory again; for when a file was saved by something else."""
+
+        with self.lock:
+            self.scanned.discard(f"{os.path.abspath(path)}\n{basename}")
@@ -58,7 +58,10 @@ def list_checkpoint_tiles(use_short=False):
 
 
 def refresh_checkpoints():
+    import modules.model_index
     import modules.sd_models
+
+    modules.model_index.invalidate([modules.sd_models.model_path, cmd_opts.ckpt_dir])
     return modules.sd_models.list_models()
 
 
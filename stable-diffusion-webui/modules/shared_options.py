@@ -37,12 +37,14 @@ options_templates.update(options_section(('saving-images', "Saving images/grids"
     "samples_filename_pattern": OptionInfo("", "Images filename pattern", component_args=hide_dirs).link("wiki", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/wiki/Custom-Images-Filename-Name-and-Subdirectory"),
     "save_images_add_number": OptionInfo(True, "Add number to filename when saving", component_args=hide_dirs),
     "save_images_replace_action": OptionInfo("Replace", "Saving the image to an existing file", gr.Radio, {"choices": ["Replace", "Add number suffix"], **hide_dirs}),
+    "save_images_background_workers": OptionInfo(0, "Number of threads writing images to disk in background", gr.Slider, {"minimum": 0, "maximum": 8, "step": 1}).info("0 = write images before continuing; otherwise, the next batch is generated while images are encoded and written; image_saved callbacks are called from those threads"),
     "grid_save": OptionInfo(True, "Always save all generated image grids"),
     "grid_format": OptionInfo('png', 'File format for grids'),
     "grid_extended_filename": OptionInfo(False, "Add extended info (seed, prompt) to filename when saving grid"),
     "grid_only_if_multiple": OptionInfo(True, "Do not save grids consisting of one picture"),
     "grid_prevent_empty_spots": OptionInfo(False, "Prevent empty spots in grid (when set to autodetect)"),
     "grid_zip_filename_pattern": OptionInfo("", "Archive filename pattern", component_args=hide_dirs).link("wiki", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/wiki/Custom-Images-Filename-Name-and-Subdirectory"),
+    "grid_stream_above_mp": OptionInfo(256, "Build X/Y/Z plot grids on disk when they are larger than", gr.Number).info("in megapixels; cell images are kept on disk instead of memory, the grid is shown as a downscaled preview and saved as tiles next to it; 0 = never"),
     "n_rows": OptionInfo(-1, "Grid row count; use -1 for autodetect and 0 for it to be same as batch size", gr.Slider, {"minimum": -1, "maximum": 16, "step": 1}),
     "font": OptionInfo("", "Font for image grids that have text"),
     "grid_text_active_color": OptionInfo("#000000", "Text color for image grids", ui_components.FormColorPicker, {}),
@@ -103,6 +105,7 @@ options_templates.update(options_section(('upscaling', "Upscaling", "postprocess
     "dat_enabled_models": OptionInfo(["DAT x2", "DAT x3", "DAT x4"], "Select which DAT models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.dat_models_names()}),
     "DAT_tile": OptionInfo(192, "Tile size for DAT upscalers.", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}).info("0 = no tiling"),
     "DAT_tile_overlap": OptionInfo(8, "Tile overlap for DAT upscalers.", gr.Slider, {"minimum": 0, "maximum": 48, "step": 1}).info("Low values = visible seam"),
+    "upscaler_tile_batch_size": OptionInfo(0, "Number of tiles upscaled together", gr.Slider, {"minimum": 0, "maximum": 32, "step": 1}).info("0 = automatic; higher values are faster but use more memory"),
     "upscaler_for_img2img": OptionInfo(None, "Upscaler for img2img", gr.Dropdown, lambda: {"choices": [x.name for x in shared.sd_upscalers]}),
     "set_scale_by_when_changing_upscaler": OptionInfo(False, "Automatically set the Scale by factor based on the name of the selected Upscaler."),
 }))
@@ -128,6 +131,11 @@ options_templates.update(options_section(('system', "System", "system"), {
     "disable_mmap_load_safetensors": OptionInfo(False, "Disable memmapping for loading .safetensors files.").info("fixes very slow loading speed in some cases"),
     "hide_ldm_prints": OptionInfo(True, "Prevent Stability-AI's ldm/sgm modules from printing noise to console."),
     "dump_stacks_on_signal": OptionInfo(False, "Print stack traces before exiting the program with ctrl+c."),
+    "hashing_workers": OptionInfo(2, "Number of threads for calculating hashes of model files", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}).needs_restart(),
+    "hashing_in_background": OptionInfo(False, "Calculate hashes of checkpoints and Lora in background").info("at startup and when the lists are refreshed, for files whose hash is not known yet"),
+    "sd_checkpoint_hash_in_background": OptionInfo(False, "Load checkpoints without waiting for their hash").info("the hash is calculated in background; pictures generated before it's ready will not have model hash in infotext"),
+    "model_index_watch": OptionInfo(False, "Watch model directories for changes").info("lists of checkpoints, VAE, Lora and embeddings are updated automatically a few seconds after files are added or removed"),
+    "model_index_watch_interval": OptionInfo(2.0, "Interval for checking model directories for changes (sec)", gr.Slider, {"minimum": 0.5, "maximum": 60, "step": 0.5}),
 }))
 
 options_templates.update(options_section(('profiler', "Profiler", "system"), {
@@ -150,6 +158,8 @@ options_templates.update(options_section(('API', "API", "system"), {
     "api_enable_requests": OptionInfo(True, "Allow http:// and https:// URLs for input images in API", restrict_api=True),
     "api_forbid_local_requests": OptionInfo(True, "Forbid URLs to local resources", restrict_api=True),
     "api_useragent": OptionInfo("", "User agent for requests", restrict_api=True),
+    "api_queue_group_by_model": OptionInfo(False, "Reorder queued API requests to reduce model switching").info("run waiting requests that use the same checkpoint, VAE and LoRAs as the previous one first"),
+    "api_queue_max_delay": OptionInfo(30, "Maximum delay for a reordered API request", gr.Number).info("in seconds; after waiting this long at the head of the queue, a request is run next regardless of the models it uses"),
 }))
 
 options_templates.update(options_section(('training', "Training", "training"), {
@@ -157,6 +167,8 @@ options_templates.update(options_section(('training', "Training", "training"), {
     "pin_memory": OptionInfo(False, "Turn on pin_memory for DataLoader. Makes training slightly faster but can increase memory usage."),
     "save_optimizer_state": OptionInfo(False, "Saves Optimizer state as separate *.optim file. Training of embedding or HN can be resumed with the matching optim file."),
     "save_training_settings_to_txt": OptionInfo(True, "Save textual inversion and hypernet settings to a text file whenever training starts."),
+    "training_cache_latents": OptionInfo(True, "Cache VAE-encoded training images and text conditioning on disk").info("used again when training on the same images with the same checkpoint and VAE; makes preparing the dataset faster"),
+    "training_cache_latents_size_mb": OptionInfo(2048, "Maximum size of the above cache", gr.Number, {"precision": 0}).info("in MB; files that were not used for the longest time are removed when it grows larger"),
     "dataset_filename_word_regex": OptionInfo("", "Filename word regex"),
     "dataset_filename_join_string": OptionInfo(" ", "Filename join string"),
     "training_image_repeats_per_epoch": OptionInfo(1, "Number of repeats for a single input image per epoch; used only for displaying epoch number", gr.Number, {"precision": 0}),
@@ -210,6 +222,10 @@ For img2img, VAE is used to process user's input image before the sampling, and
     "auto_vae_precision": OptionInfo(True, "Automatically revert VAE to 32-bit floats").info("triggers when a tensor with NaNs is produced in VAE; disabling the option in this case will result in a black square image"),
     "sd_vae_encode_method": OptionInfo("Full", "VAE type for encode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Encoder').info("method to encode image to latent (use in img2img, hires-fix or inpaint mask)"),
     "sd_vae_decode_method": OptionInfo("Full", "VAE type for decode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Decoder').info("method to decode latent to image"),
+    "sd_vae_decode_batch_size": OptionInfo(1, "VAE decode batch size", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}).info("how many images to decode at once; 1 = one at a time; 0 = as many as fit into available memory"),
+    "sd_vae_tiled_threshold": OptionInfo(0.0, "Tiled VAE threshold (megapixels)", gr.Number).info("encode and decode images larger than this in overlapping tiles to limit memory use; 0 = never"),
+    "sd_vae_tile_size": OptionInfo(1024, "Tiled VAE tile size (pixels)", gr.Slider, {"minimum": 256, "maximum": 2048, "step": 64}),
+    "sd_vae_tile_overlap": OptionInfo(64, "Tiled VAE tile overlap (pixels)", gr.Slider, {"minimum": 0, "maximum": 256, "step": 8}),
 }))
 
 options_templates.update(options_section(('img2img', "img2img", "sd"), {
@@ -231,6 +247,7 @@ options_templates.update(options_section(('img2img', "img2img", "sd"), {
 
 options_templates.update(options_section(('optimizations', "Optimizations", "sd"), {
     "cross_attention_optimization": OptionInfo("Automatic", "Cross attention optimization", gr.Dropdown, lambda: {"choices": shared_items.cross_attention_optimizations()}),
+    "attention_autotune_memory_budget": OptionInfo(70, "Memory budget for auto-tune cross attention optimization", gr.Slider, {"minimum": 10, "maximum": 100, "step": 5}).info("percentage of free VRAM (RAM on CPU) one attention layer may use; implementations that need more are not used for that shape"),
     "s_min_uncond": OptionInfo(0.0, "Negative Guidance minimum sigma", gr.Slider, {"minimum": 0.0, "maximum": 15.0, "step": 0.01}, infotext='NGMS').link("PR", "https://github.com/AUTOMATIC1111/stablediffusion-webui/pull/9177").info("skip negative prompt for some steps when the image is almost ready; 0=disable, higher=faster"),
     "s_min_uncond_all": OptionInfo(False, "Negative Guidance minimum sigma all steps", infotext='NGMS all steps').info("By default, NGMS above skips every other step; this makes it skip all steps"),
     "token_merging_ratio": OptionInfo(0.0, "Token merging ratio", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}, infotext='Token merging ratio').link("PR", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/pull/9256").info("0=disable, higher=faster"),
@@ -239,6 +256,7 @@ options_templates.update(options_section(('optimizations', "Optimizations", "sd"
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt", infotext='Pad conds').info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "pad_cond_uncond_v0": OptionInfo(False, "Pad prompt/negative prompt (v0)", infotext='Pad conds v0').info("alternative implementation for the above; used prior to 1.6.0 for DDIM sampler; overrides the above if set; WARNING: truncates negative prompt if it's too long; changes seeds"),
     "persistent_cond_cache": OptionInfo(True, "Persistent cond cache").info("do not recalculate conds from prompts if prompts have not changed since previous calculation"),
+    "cond_cache_mb": OptionInfo(64, "Text conditioning cache size (MB)", gr.Number).info("keep results of the text encoder for recently used prompts and negative prompts across all generations; stored on the same device as the model; 0 = disable"),
     "batch_cond_uncond": OptionInfo(True, "Batch cond/uncond").info("do both conditional and unconditional denoising in one batch; uses a bit more VRAM during sampling, but improves speed; previously this was controlled by --always-batch-cond-uncond commandline argument"),
     "fp8_storage": OptionInfo("Disable", "FP8 weight", gr.Radio, {"choices": ["Disable", "Enable for SDXL", "Enable"]}).info("Use FP8 to store Linear/Conv layers' weight. Require pytorch>=2.1.0."),
     "cache_fp16_weight": OptionInfo(False, "Cache FP16 weight for LoRA").info("Cache fp16 weight when enabling FP8, will increase the quality of LoRA. Use more system ram."),
@@ -278,6 +296,9 @@ options_templates.update(options_section(('extra_networks', "Extra Networks", "s
     "extra_networks_default_multiplier": OptionInfo(1.0, "Default multiplier for extra networks", gr.Slider, {"minimum": 0.0, "maximum": 2.0, "step": 0.01}),
     "extra_networks_card_width": OptionInfo(0, "Card width for Extra Networks").info("in pixels"),
     "extra_networks_card_height": OptionInfo(0, "Card height for Extra Networks").info("in pixels"),
+    "extra_networks_thumbnails": OptionInfo(True, "Use thumbnails for card previews").info("smaller WebP images made from preview images, served instead of them"),
+    "extra_networks_thumbnail_size": OptionInfo(512, "Thumbnail size", gr.Slider, {"minimum": 128, "maximum": 1024, "step": 128}).info("in pixels, for the shorter side; should be at least card size times screen scaling"),
+    "extra_networks_thumbnails_pregenerate": OptionInfo(True, "Make thumbnails in background when listing cards"),
     "extra_networks_card_text_scale": OptionInfo(1.0, "Card text scale", gr.Slider, {"minimum": 0.0, "maximum": 2.0, "step": 0.01}).info("1 = original size"),
     "extra_networks_card_show_desc": OptionInfo(True, "Show description on card"),
     "extra_networks_card_description_is_html": OptionInfo(False, "Treat card description as HTML"),
@@ -415,6 +436,7 @@ options_templates.update(options_section(('postprocessing', "Postprocessing", "p
     'postprocessing_operation_order': OptionInfo([], "Postprocessing operation order", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
     'postprocessing_existing_caption_action': OptionInfo("Ignore", "Action for existing captions", gr.Radio, {"choices": ["Ignore", "Keep", "Prepend", "Append"]}).info("when generating captions using postprocessing; Ignore = use generated; Keep = use original; Prepend/Append = combine both"),
+    'postprocessing_prefetch_images': OptionInfo(4, "Batch processing: number of images to load and save in background", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}).info("images are read from disk ahead of processing and written to disk while next ones are processed; higher values use more memory"),
 }))
 
 options_templates.update(options_section((None, "Hidden options"), {
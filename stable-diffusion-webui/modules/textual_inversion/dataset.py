@@ -10,6 +10,7 @@ from random import shuffle, choices
 import random
 import tqdm
 from modules import devices, shared, images
+from modules.textual_inversion import latent_cache
 import re
 
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
@@ -27,6 +28,8 @@ class DatasetEntry:
         self.cond = cond
         self.cond_text = cond_text
         self.pixel_values = pixel_values
+        self.bucket = None
+        self.row = None
 
 
 class PersonalizedBase(Dataset):
@@ -54,6 +57,15 @@ class PersonalizedBase(Dataset):
         self.tag_drop_out = tag_drop_out
         groups = defaultdict(list)
 
+        cache = None
+        if shared.opts.training_cache_latents:
+            from modules import sd_hijack, sd_vae
+
+            cache = latent_cache.TrainingCache()
+            identity = latent_cache.model_identity(model, sd_vae.get_loaded_vae_hash())
+            cond_identity = latent_cache.conditioning_identity(model, shared.opts)
+            embeddings = sd_hijack.model_hijack.embedding_db.word_embeddings
+
         print("Preparing dataset...")
         for path in tqdm.tqdm(self.image_paths):
             alpha_channel = None
@@ -84,14 +96,24 @@ class PersonalizedBase(Dataset):
                     tokens = re_word.findall(filename_text)
                     filename_text = (shared.opts.dataset_filename_join_string or "").join(tokens)
 
-            npimage = np.array(image).astype(np.uint8)
-            npimage = (npimage / 127.5 - 1.0).astype(np.float32)
+            key = None
+            if cache is not None and identity is not None:
+                key = latent_cache.image_key(path, None if varsize else (width, height), identity)
+
+            latent_dist = self.load_latent_dist(cache, key, device)
+            if latent_dist is None:
+                npimage = np.array(image).astype(np.uint8)
+                npimage = (npimage / 127.5 - 1.0).astype(np.float32)
+
+                torchdata = torch.from_numpy(npimage).permute(2, 0, 1).to(device=device, dtype=torch.float32)
+
+                with devices.autocast():
+                    latent_dist = model.encode_first_stage(torchdata.unsqueeze(dim=0))
 
-            torchdata = torch.from_numpy(npimage).permute(2, 0, 1).to(device=device, dtype=torch.float32)
-            latent_sample = None
+                del torchdata
 
-            with devices.autocast():
-                latent_dist = model.encode_first_stage(torchdata.unsqueeze(dim=0))
+                if key is not None:
+                    self.save_latent_dist(cache, key, latent_dist)
 
             #Perform latent sampling, even for random sampling.
             #We need the sample dimensions for the weights
@@ -127,15 +149,26 @@ class PersonalizedBase(Dataset):
                 entry.cond_text = self.create_text(filename_text)
 
             if include_cond and not (self.tag_drop_out != 0 or self.shuffle_tags):
-                with devices.autocast():
-                    entry.cond = cond_model([entry.cond_text]).to(devices.cpu).squeeze(0)
+                cond_key = None
+                if cache is not None and cond_identity is not None:
+                    cond_key = latent_cache.text_key(entry.cond_text, cond_identity, embeddings)
+                    entry.cond = cache.load("cond", cond_key)
+
+                if entry.cond is None:
+                    with devices.autocast():
+                        entry.cond = cond_model([entry.cond_text]).to(devices.cpu).squeeze(0)
+
+                    if cond_key is not None:
+                        cache.save("cond", cond_key, entry.cond)
             groups[image.size].append(len(self.dataset))
             self.dataset.append(entry)
-            del torchdata
             del latent_dist
             del latent_sample
             del weight
 
+        if cache is not None:
+            cache.prune(shared.opts.training_cache_latents_size_mb * 1024 * 1024)
+
         self.length = len(self.dataset)
         self.groups = list(groups.values())
         assert self.length > 0, "No images have been found in the dataset."
@@ -149,6 +182,47 @@ class PersonalizedBase(Dataset):
                 print(f"  {w}x{h}: {len(ids)}")
             print()
 
+        if latent_sampling_method != "random":
+            self.stack_buckets()
+
+    @staticmethod
+    def load_latent_dist(cache, key, device):
+        if key is None:
+            return None
+
+        parameters = cache.load("dist", key)
+        if parameters is not None:
+            return DiagonalGaussianDistribution(parameters.to(device))
+
+        latent = cache.load("tensor", key)
+        if latent is not None:
+            return latent.to(device)
+
+        return None
+
+    @staticmethod
+    def save_latent_dist(cache, key, latent_dist):
+        if isinstance(latent_dist, DiagonalGaussianDistribution):
+            cache.save("dist", key, latent_dist.parameters)
+        else:
+            cache.save("tensor", key, latent_dist)
+
+    def stack_buckets(self):
+        """Moves latent samples and weights of each group of same-sized images into one memory-mapped array, so that
+        BatchLoader can read a batch with a single indexing operation instead of stacking separate tensors."""
+
+        for group in self.groups:
+            entries = [self.dataset[i] for i in group]
+            weights = [entry.weight for entry in entries]
+            bucket = latent_cache.LatentBucket([entry.latent_sample for entry in entries], weights if all(w is not None for w in weights) else None)
+
+            for row, entry in enumerate(entries):
+                entry.bucket = bucket
+                entry.row = row
+                entry.latent_sample, weight = bucket.row(row)
+                if weight is not None:
+                    entry.weight = weight
+
     def create_text(self, filename_text):
         text = random.choice(self.lines)
         tags = filename_text.split(',')
@@ -219,11 +293,18 @@ class BatchLoader:
     def __init__(self, data):
         self.cond_text = [entry.cond_text for entry in data]
         self.cond = [entry.cond for entry in data]
-        self.latent_sample = torch.stack([entry.latent_sample for entry in data]).squeeze(1)
-        if all(entry.weight is not None for entry in data):
-            self.weight = torch.stack([entry.weight for entry in data]).squeeze(1)
+
+        bucket = data[0].bucket
+        if bucket is not None and all(entry.bucket is bucket for entry in data):
+            latent_sample, weight = bucket.get([entry.row for entry in data])
+            self.latent_sample = latent_sample.squeeze(1)
+            self.weight = weight.squeeze(1) if weight is not None else None
         else:
-            self.weight = None
+            self.latent_sample = torch.stack([entry.latent_sample for entry in data]).squeeze(1)
+            if all(entry.weight is not None for entry in data):
+                self.weight = torch.stack([entry.weight for entry in data]).squeeze(1)
+            else:
+                self.weight = None
         #self.emb_index = [entry.emb_index for entry in data]
         #print(self.latent_sample.device)
 
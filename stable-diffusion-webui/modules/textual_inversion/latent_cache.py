@@ -0,0 +1,174 @@
+"""On-disk cache of VAE-encoded training images and text conditioning.
+
+Preparing a dataset for textual inversion or hypernetwork training runs the VAE over every image, and for hypernetworks
+also the text encoder over every caption, each time training starts. Results only depend on the image file, the size
+it's resized to, and the model, so they are saved as .npy files named after a hash of those, and memory-mapped from
+there when the same images are used again: in the next run, or in a run with different hyperparameters.
+
+Encoded images are stored as latent distributions (mean and log variance, before scaling), so a latent sample can be
+drawn from them for any latent sampling method.
+
+Files are touched when loaded. When the cache grows over the size limit from settings, files that were not used for
+the longest time are removed.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from modules import cache, devices
+
+
+def default_directory():
+    return os.path.join(cache.cache_dir, "training-latents")
+
+
+def model_identity(model, vae_hash):
+    """Returns a string that identifies the VAE used to encode images: checkpoint hash, external VAE hash and dtype;
+    None if the checkpoint does not have a hash."""
+
+    model_hash = getattr(model, "sd_model_hash", None)
+    if not model_hash:
+        return None
+
+    return f"{model_hash} {vae_hash or 'checkpoint'} {devices.dtype_vae}"
+
+
+def image_key(path, size, identity):
+    """Returns the cache key for the image in path resized to size (None if not resized) and encoded by identity."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    digest.update(f"\n{size}\n{identity}".encode("utf8"))
+    return digest.hexdigest()
+
+
+def conditioning_identity(model, opts):
+    """Returns a string that identifies how text is turned into conditioning, or None if it can't be identified."""
+
+    model_hash = getattr(model, "sd_model_hash", None)
+    if not model_hash:
+        return None
+
+    return f"{model_hash} {opts.CLIP_stop_at_last_layers} {opts.emphasis} {opts.use_old_emphasis_implementation}"
+
+
+def text_key(text, identity, embeddings=None):
+    """Returns the cache key for conditioning of text; embeddings is a dict of textual inversion embeddings by name,
+    and those used in text are part of the key."""
+
+    used = sorted(f"{name} {embedding.checksum()}" for name, embedding in (embeddings or {}).items() if name in text)
+    return hashlib.sha256("\n".join([text, identity, *used]).encode("utf8")).hexdigest()
+
+
+def to_numpy(tensor):
+    tensor = tensor.detach().cpu()
+
+    # numpy has no bfloat16
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.float()
+
+    return tensor.numpy()
+
+
+class TrainingCache:
+    def __init__(self, directory=None):
+        self.directory = directory or default_directory()
+
+    def path(self, kind, key):
+        return os.path.join(self.directory, kind, key[:2], f"{key}.npy")
+
+    def load(self, kind, key):
+        """Returns a memory-mapped tensor saved for kind and key, or None if there is none."""
+
+        path = self.path(kind, key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            array = np.load(path, mmap_mode="c")
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return torch.from_numpy(array)
+
+    def save(self, kind, key, tensor):
+        path = self.path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(f"{path}.tmp", "wb") as file:
+            np.save(file, to_numpy(tensor))
+        os.replace(f"{path}.tmp", path)
+
+    def prune(self, max_bytes):
+        """Removes files that were not used for the longest time until the cache takes at most max_bytes."""
+
+        files = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".npy"):
+                    continue
+
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                # can't remove a memory-mapped file on Windows
+                continue
+
+            total -= size
+
+
+class LatentBucket:
+    """Latent samples, and optionally loss weights, of same-sized training images, stacked in a memory-mapped
+    temporary file. A batch of rows is read with one indexing operation into one tensor."""
+
+    def __init__(self, samples, weights=None, directory=None):
+        self.samples = self.stack(samples, directory)
+        self.weights = self.stack(weights, directory) if weights is not None else None
+
+    @staticmethod
+    def stack(tensors, directory):
+        first = to_numpy(tensors[0])
+
+        # the mapping keeps the file alive after it's closed
+        with tempfile.TemporaryFile(dir=directory) as file:
+            array = np.memmap(file, dtype=first.dtype, mode="w+", shape=(len(tensors), *first.shape))
+
+        for i, tensor in enumerate(tensors):
+            array[i] = to_numpy(tensor)
+
+        return array
+
+    def row(self, index):
+        """Returns (sample, weight) of one image as views into the mapped file."""
+
+        sample = torch.from_numpy(self.samples[index])
+        weight = torch.from_numpy(self.weights[index]) if self.weights is not None else None
+        return sample, weight
+
+    def get(self, rows):
+        """Returns (samples, weights) for rows; weights is None if the bucket has no weights."""
+
+        samples = torch.from_numpy(self.samples[rows])
+        weights = torch.from_numpy(self.weights[rows]) if self.weights is not None else None
+        return samples, weights
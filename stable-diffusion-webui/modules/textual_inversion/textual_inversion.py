@@ -12,7 +12,7 @@ import safetensors.torch
 import numpy as np
 from PIL import Image, PngImagePlugin
 
-from modules import shared, devices, sd_hijack, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, hashes
+from modules import shared, devices, sd_hijack, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, hashes, cond_cache, model_index
 import modules.textual_inversion.dataset
 from modules.textual_inversion.learn_schedule import LearnRateScheduler
 
@@ -91,21 +91,20 @@ class Embedding:
 class DirWithTextualInversionEmbeddings:
     def __init__(self, path):
         self.path = path
-        self.mtime = None
+        self.version = None
 
     def has_changed(self):
         if not os.path.isdir(self.path):
             return False
 
-        mt = os.path.getmtime(self.path)
-        if self.mtime is None or mt > self.mtime:
-            return True
+        index = model_index.get_index(self.path)
+        return index.refresh() or index.version != self.version
 
     def update(self):
         if not os.path.isdir(self.path):
             return
 
-        self.mtime = os.path.getmtime(self.path)
+        self.version = model_index.get_index(self.path).version
 
 
 class EmbeddingDatabase:
@@ -116,6 +115,8 @@ class EmbeddingDatabase:
         self.expected_shape = -1
         self.embedding_dirs = {}
         self.previously_displayed_embeddings = ()
+        self.loaded_files = {}
+        """Embeddings read from files, with (size, mtime) of files, so that unchanged files are not read again on reload."""
 
     def add_embedding_dir(self, path):
         self.embedding_dirs[path] = DirWithTextualInversionEmbeddings(path)
@@ -154,14 +155,16 @@ class EmbeddingDatabase:
         vec = shared.sd_model.cond_stage_model.encode_embedding_init_text(",", 1)
         return vec.shape[1]
 
-    def load_from_file(self, path, filename):
+    def read_from_file(self, path, filename):
+        """Returns the embedding from a file, or None if it's not an embedding file."""
+
         name, ext = os.path.splitext(filename)
         ext = ext.upper()
 
         if ext in ['.PNG', '.WEBP', '.JXL', '.AVIF']:
             _, second_ext = os.path.splitext(name)
             if second_ext.upper() == '.PREVIEW':
-                return
+                return None
 
             embed_image = Image.open(path)
             if hasattr(embed_image, 'text') and 'sd-ti-embedding' in embed_image.text:
@@ -173,44 +176,78 @@ class EmbeddingDatabase:
                     name = data.get('name', name)
                 else:
                     # if data is None, means this is not an embedding, just a preview image
-                    return
+                    return None
         elif ext in ['.BIN', '.PT']:
             data = torch.load(path, map_location="cpu")
         elif ext in ['.SAFETENSORS']:
             data = safetensors.torch.load_file(path, device="cpu")
         else:
-            return
+            return None
 
-        if data is not None:
-            embedding = create_embedding_from_data(data, name, filename=filename, filepath=path)
+        if data is None:
+            print(f"Unable to load Textual inversion embedding due to data issue: '{name}'.")
+            return None
 
-            if self.expected_shape == -1 or self.expected_shape == embedding.shape:
-                self.register_embedding(embedding, shared.sd_model)
-            else:
-                self.skipped_embeddings[name] = embedding
+        return create_embedding_from_data(data, name, filename=filename, filepath=path)
+
+    def register_or_skip(self, embedding):
+        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
+            self.register_embedding(embedding, shared.sd_model)
         else:
-            print(f"Unable to load Textual inversion embedding due to data issue: '{name}'.")
+            self.skipped_embeddings[embedding.name] = embedding
 
+    def load_from_file(self, path, filename):
+        embedding = self.read_from_file(path, filename)
+        if embedding is not None:
+            self.register_or_skip(embedding)
+
+        return embedding
 
     def load_from_dir(self, embdir):
         if not os.path.isdir(embdir.path):
             return
 
-        for root, _, fns in os.walk(embdir.path, followlinks=True):
-            for fn in fns:
-                try:
-                    fullfn = os.path.join(root, fn)
+        index = model_index.get_index(embdir.path)
+        index.refresh()
+
+        files = []
+        for root, fn in index.files():
+            stat = index.stat(root, fn)
+            if stat is None or stat[0] == 0:
+                continue
+
+            files.append((os.path.join(root, fn), fn, stat))
+
+        def read(item):
+            fullfn, fn, stat = item
+            try:
+                return stat, self.read_from_file(fullfn, fn)
+            except Exception:
+                errors.report(f"Error loading embedding {fn}", exc_info=True)
+                return None
+
+        # only read files that are new or changed since the last time, and read them in parallel
+        changed = [item for item in files if self.loaded_files.get(item[0], (None, None))[0] != item[2]]
+        for (fullfn, _, _), loaded in zip(changed, model_index.map_parallel(read, changed)):
+            if loaded is None:
+                self.loaded_files.pop(fullfn, None)
+            else:
+                self.loaded_files[fullfn] = loaded
 
-                    if os.stat(fullfn).st_size == 0:
-                        continue
+        present = {fullfn for fullfn, _, _ in files}
+        prefix = os.path.join(os.path.normpath(embdir.path), '')
+        for fullfn in [x for x in self.loaded_files if x.startswith(prefix) and x not in present]:
+            del self.loaded_files[fullfn]
 
-                    self.load_from_file(fullfn, fn)
-                except Exception:
-                    errors.report(f"Error loading embedding {fn}", exc_info=True)
-                    continue
+        for fullfn, _, _ in files:
+            _, embedding = self.loaded_files.get(fullfn, (None, None))
+            if embedding is not None:
+                self.register_or_skip(embedding)
 
     def load_textual_inversion_embeddings(self, force_reload=False):
-        if not force_reload:
+        if force_reload:
+            model_index.invalidate([embdir.path for embdir in self.embedding_dirs.values()])
+        else:
             need_reload = False
             for embdir in self.embedding_dirs.values():
                 if embdir.has_changed():
@@ -224,6 +261,7 @@ class EmbeddingDatabase:
         self.word_embeddings.clear()
         self.skipped_embeddings.clear()
         self.expected_shape = self.get_expected_shape()
+        cond_cache.clear()
 
         for embdir in self.embedding_dirs.values():
             self.load_from_dir(embdir)
@@ -284,6 +322,13 @@ def create_embedding(name, num_vectors_per_token, overwrite_old, init_text='*'):
     return fn
 
 
+def reload_embeddings_if_model_loaded():
+    """Reloads embeddings if directories with them changed; does nothing if no model has been loaded yet."""
+
+    if sd_models.model_data.sd_model is not None:
+        sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings()
+
+
 def create_embedding_from_data(data, name, filename='unknown embedding file', filepath=None):
     if 'string_to_param' in data:  # textual inversion embeddings
         param_dict = data['string_to_param']
@@ -594,6 +639,9 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
 
                     shared.sd_model.first_stage_model.to(devices.device)
 
+                    # the embedding has been changed by training, so conds made with it earlier are no longer valid
+                    cond_cache.clear()
+
                     p = processing.StableDiffusionProcessingTxt2Img(
                         sd_model=shared.sd_model,
                         do_not_save_grid=True,
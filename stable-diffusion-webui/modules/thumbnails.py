@@ -0,0 +1,152 @@
+"""Thumbnails for preview images of extra networks cards.
+
+Thumbnails are WebP images scaled so that their shorter side is one of size_buckets, which is enough for cards that
+crop previews to fill them. They are kept in diskcache, keyed by image and bucket and checked against the identity of
+the source (inode, size and mtime for files), and served with ETag and Last-Modified headers so that browsers can
+revalidate them with a 304 response instead of downloading them again.
+"""
+
+import concurrent.futures
+import email.utils
+import hashlib
+import threading
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from modules import cache, errors, hashes, images, shared
+
+size_buckets = (128, 256, 384, 512, 768, 1024)
+webp_quality = 85
+
+
+def size_bucket(size):
+    """Returns the smallest bucket that is at least size."""
+
+    return next((x for x in size_buckets if x >= size), size_buckets[-1])
+
+
+def default_bucket():
+    """Returns the bucket to use for cards, or None if thumbnails are disabled in settings."""
+
+    if not shared.opts.extra_networks_thumbnails:
+        return None
+
+    return size_bucket(int(shared.opts.extra_networks_thumbnail_size))
+
+
+def make_thumbnail(image: Image.Image, bucket: int) -> bytes:
+    image = ImageOps.exif_transpose(image)
+
+    scale = bucket / min(image.size)
+    if scale < 1:
+        image = image.resize((max(round(image.width * scale), 1), max(round(image.height * scale), 1)), images.LANCZOS)
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.mode in ("LA", "PA", "P") or "transparency" in image.info else "RGB")
+
+    buffer = BytesIO()
+    image.save(buffer, format="WEBP", quality=webp_quality)
+    return buffer.getvalue()
+
+
+def etag(key, identity, bucket=None):
+    return '"' + hashlib.sha1(repr((key, identity, bucket, webp_quality)).encode()).hexdigest()[:20] + '"'
+
+
+def get_thumbnail(key, identity, bucket, open_image) -> bytes:
+    """Returns WebP thumbnail for the bucket of an image identified by key, from cache if identity did not change.
+
+    open_image is a function without arguments that returns the image as PIL.Image; it's only called if the thumbnail
+    needs to be made.
+    """
+
+    thumbnails = cache.cache("thumbnails")
+    cache_key = f"{bucket}:{key}"
+
+    entry = thumbnails.get(cache_key)
+    if entry is not None and entry["identity"] == identity:
+        return entry["data"]
+
+    with open_image() as image:
+        data = make_thumbnail(image, bucket)
+
+    thumbnails[cache_key] = {"identity": identity, "data": data}
+    return data
+
+
+def get_file_thumbnail(filename, bucket) -> tuple[bytes, list]:
+    """Returns WebP thumbnail for an image file and the identity of the file."""
+
+    identity = hashes.file_identity(filename)
+    return get_thumbnail(filename, identity, bucket, lambda: Image.open(filename)), identity
+
+
+def is_not_modified(request, etag_value, mtime=None) -> bool:
+    """Checks request's If-None-Match and If-Modified-Since headers; returns True if the client has an up-to-date copy."""
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [x.strip().removeprefix("W/") for x in if_none_match.split(",")]
+        return "*" in tags or etag_value in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and mtime is not None:
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def cache_headers(etag_value, mtime=None):
+    headers = {"ETag": etag_value, "Cache-Control": "no-cache"}
+    if mtime is not None:
+        headers["Last-Modified"] = email.utils.formatdate(mtime, usegmt=True)
+
+    return headers
+
+
+class Pregenerator:
+    """Makes thumbnails for files in background, one at a time, so that they are ready when the browser asks for them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = set()
+
+    def submit(self, filename, bucket):
+        key = (filename, bucket)
+
+        with self.lock:
+            if key in self.pending:
+                return
+
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnails")
+
+            self.pending.add(key)
+            self.executor.submit(self.run, key)
+
+    def run(self, key):
+        filename, bucket = key
+        try:
+            get_file_thumbnail(filename, bucket)
+        except Exception as e:
+            errors.display_once(e, f"making thumbnail for {filename}")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+
+pregenerator = Pregenerator()
+
+
+def pregenerate(filename, bucket):
+    """Starts making a thumbnail for the file in background if enabled in settings."""
+
+    if bucket is None or not shared.opts.extra_networks_thumbnails_pregenerate or filename.lower().endswith(".gif"):
+        return
+
+    pregenerator.submit(filename, bucket)
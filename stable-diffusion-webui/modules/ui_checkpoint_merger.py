@@ -45,6 +45,7 @@ class UiCheckpointMerger:
 
                     self.custom_name = gr.Textbox(label="Custom Name (Optional)", elem_id="modelmerger_custom_name")
                     self.interp_amount = gr.Slider(minimum=0.0, maximum=1.0, step=0.05, label='Multiplier (M) - set to 0 to get model A', value=0.3, elem_id="modelmerger_interp_amount")
+                    self.extra_multipliers = gr.Textbox(value="", label="Additional multipliers", placeholder="comma-separated, e.g. 0.5, 0.7; makes one more checkpoint for each, reading models only once", elem_id="modelmerger_extra_multipliers")
                     self.interp_method = gr.Radio(choices=["No interpolation", "Weighted sum", "Add difference"], value="Weighted sum", label="Interpolation Method", elem_id="modelmerger_interp_method")
                     self.interp_method.change(fn=update_interp_description, inputs=[self.interp_method], outputs=[self.interp_description])
 
@@ -109,6 +110,7 @@ class UiCheckpointMerger:
                 self.add_merge_recipe,
                 self.copy_metadata_fields,
                 self.metadata_json,
+                self.extra_multipliers,
             ],
             outputs=[
                 self.primary_model_name,
@@ -1,4 +1,5 @@
 import functools
+import hashlib
 import os.path
 import urllib.parse
 from base64 import b64decode
@@ -7,11 +8,12 @@ from pathlib import Path
 from typing import Optional, Union
 from dataclasses import dataclass
 
-from modules import shared, ui_extra_networks_user_metadata, errors, extra_networks, util
+from modules import shared, ui_extra_networks_user_metadata, errors, extra_networks, util, hashes, thumbnails, ui_extra_networks_index
 from modules.images import read_info_from_image, save_image_with_geninfo
 import gradio as gr
 import json
 import html
+from fastapi import Request
 from fastapi.exceptions import HTTPException
 from PIL import Image
 
@@ -94,8 +96,10 @@ def register_page(page):
     allowed_dirs.update(set(sum([x.allowed_directories_for_previews() for x in extra_pages], [])))
 
 
-def fetch_file(filename: str = ""):
-    from starlette.responses import FileResponse
+def fetch_file(request: Request, filename: str = "", size: int = 0):
+    """Returns a preview image; if size is specified, returns a WebP thumbnail of it for that size instead."""
+
+    from starlette.responses import FileResponse, Response
 
     if not os.path.isfile(filename):
         raise HTTPException(status_code=404, detail="File not found")
@@ -107,13 +111,28 @@ def fetch_file(filename: str = ""):
     if ext not in allowed_preview_extensions():
         raise ValueError(f"File cannot be fetched: {filename}. Extensions allowed: {allowed_preview_extensions()}.")
 
-    # would profit from returning 304
-    return FileResponse(filename, headers={"Accept-Ranges": "bytes"})
+    identity = hashes.file_identity(filename)
+    mtime = identity[2] / 1e9
+    bucket = thumbnails.size_bucket(size) if size > 0 and ext != "gif" else None  # thumbnails would lose gif animation
+    etag = thumbnails.etag(filename, identity, bucket)
+    headers = thumbnails.cache_headers(etag, mtime)
+
+    if thumbnails.is_not_modified(request, etag, mtime):
+        return Response(status_code=304, headers=headers)
+
+    if bucket is None:
+        return FileResponse(filename, headers={"Accept-Ranges": "bytes", **headers})
+
+    data = thumbnails.get_thumbnail(filename, identity, bucket, lambda: Image.open(filename))
+    return Response(content=data, media_type="image/webp", headers=headers)
 
 
-def fetch_cover_images(page: str = "", item: str = "", index: int = 0):
+def fetch_cover_images(request: Request, page: str = "", item: str = "", index: int = 0, size: int = 0):
+    """Returns a cover image from safetensors metadata; if size is specified, returns a WebP thumbnail of it for that size instead."""
+
     from starlette.responses import Response
 
+    page_name = page
     page = next(iter([x for x in extra_pages if x.name == page]), None)
     if page is None:
         raise HTTPException(status_code=404, detail="File not found")
@@ -127,11 +146,25 @@ def fetch_cover_images(page: str = "", item: str = "", index: int = 0):
     if not image:
         raise HTTPException(status_code=404, detail="File not found")
 
+    key = f"cover-images/{page_name}/{item}/{index}"
+    identity = hashlib.sha1(image.encode()).hexdigest()
+    bucket = thumbnails.size_bucket(size) if size > 0 else None
+    etag = thumbnails.etag(key, identity, bucket)
+    headers = thumbnails.cache_headers(etag)
+
+    if thumbnails.is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
     try:
-        image = Image.open(BytesIO(b64decode(image)))
-        buffer = BytesIO()
-        image.save(buffer, format=image.format)
-        return Response(content=buffer.getvalue(), media_type=image.get_format_mimetype())
+        if bucket is not None:
+            data = thumbnails.get_thumbnail(key, identity, bucket, lambda: Image.open(BytesIO(b64decode(image))))
+            return Response(content=data, media_type="image/webp", headers=headers)
+
+        data = b64decode(image)
+        with Image.open(BytesIO(data)) as img:
+            media_type = img.get_format_mimetype()
+
+        return Response(content=data, media_type=media_type, headers=headers)
     except Exception as err:
         raise ValueError(f"File cannot be fetched: {item}. Failed to load cover image.") from err
 
@@ -170,11 +203,40 @@ def get_single_card(page: str = "", tabname: str = "", name: str = ""):
     return JSONResponse({"html": item_html})
 
 
+def get_items(page: str = "", search: str = "", path: str = "", sort: str = "default", reverse: bool = False, offset: int = 0, limit: int = 50, refresh: bool = False):
+    """Returns a page of items for an extra networks page as JSON; see ui_extra_networks_index.ItemsIndex.query.
+
+    The index is brought up to date when the first page (offset=0) is requested, so following pages come from the
+    same listing. If refresh is True, the list of models is reloaded from disk and all items are created again.
+    """
+
+    from starlette.responses import JSONResponse
+
+    page = next(iter([x for x in extra_pages if page in (x.name, x.extra_networks_tabname)]), None)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    if refresh:
+        page.refresh()
+
+    index = ui_extra_networks_index.get_index(page)
+    if refresh or offset == 0:
+        index.update(full=refresh)
+
+    try:
+        total, items = index.query(search=search, path=path, sort=sort, reverse=reverse, offset=offset, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+    return JSONResponse({"page": page.extra_networks_tabname, "total": total, "offset": offset, "limit": limit, "items": items})
+
+
 def add_pages_to_demo(app):
     app.add_api_route("/sd_extra_networks/thumb", fetch_file, methods=["GET"])
     app.add_api_route("/sd_extra_networks/cover-images", fetch_cover_images, methods=["GET"])
     app.add_api_route("/sd_extra_networks/metadata", get_metadata, methods=["GET"])
     app.add_api_route("/sd_extra_networks/get-single-card", get_single_card, methods=["GET"])
+    app.add_api_route("/sd_extra_networks/items", get_items, methods=["GET"])
 
 
 def quote_js(s):
@@ -220,7 +282,13 @@ class ExtraNetworksPage:
     def link_preview(self, filename):
         quoted_filename = urllib.parse.quote(filename.replace('\\', '/'))
         mtime, _ = self.lister.mctime(filename)
-        return f"./sd_extra_networks/thumb?filename={quoted_filename}&mtime={mtime}"
+
+        bucket = thumbnails.default_bucket()
+        if bucket is None:
+            return f"./sd_extra_networks/thumb?filename={quoted_filename}&mtime={mtime}"
+
+        thumbnails.pregenerate(filename, bucket)
+        return f"./sd_extra_networks/thumb?filename={quoted_filename}&mtime={mtime}&size={bucket}"
 
     def search_terms_from_path(self, filename, possible_directories=None):
         abspath = os.path.abspath(filename)
@@ -628,6 +696,21 @@ class ExtraNetworksPage:
     def list_items(self):
         raise NotImplementedError()
 
+    def list_item_names(self):
+        """Returns names of all items in default order, to be used with create_item, or None if the page can't list them."""
+
+        return None
+
+    def item_filename(self, name):
+        """Returns the filename for the item with the name without creating the item, or None if it's not known."""
+
+        return None
+
+    def items_state_key(self):
+        """Returns a value that changes whenever something that affects all items of the page changes."""
+
+        return shared.opts.sd_model_checkpoint, shared.opts.samples_format, thumbnails.default_bucket()
+
     def allowed_directories_for_previews(self):
         return []
 
@@ -664,7 +747,9 @@ class ExtraNetworksPage:
 
         file = f"{path}.safetensors"
         if self.lister.exists(file) and 'ssmd_cover_images' in metadata and len(list(filter(None, json.loads(metadata['ssmd_cover_images'])))) > 0:
-            return f"./sd_extra_networks/cover-images?page={self.extra_networks_tabname}&item={name}"
+            bucket = thumbnails.default_bucket()
+            size = f"&size={bucket}" if bucket is not None else ""
+            return f"./sd_extra_networks/cover-images?page={self.extra_networks_tabname}&item={name}{size}"
 
         return None
 
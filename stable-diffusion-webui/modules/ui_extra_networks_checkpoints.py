@@ -36,9 +36,16 @@ class ExtraNetworksPageCheckpoints(ui_extra_networks.ExtraNetworksPage):
             "sort_keys": {'default': index, **self.get_sort_keys(checkpoint.filename)},
         }
 
-    def list_items(self):
+    def list_item_names(self):
         # instantiate a list to protect against concurrent modification
-        names = list(sd_models.checkpoints_list)
+        return list(sd_models.checkpoints_list)
+
+    def item_filename(self, name):
+        checkpoint = sd_models.checkpoint_aliases.get(name)
+        return checkpoint.filename if checkpoint is not None else None
+
+    def list_items(self):
+        names = self.list_item_names()
         for index, name in enumerate(names):
             item = self.create_item(name, index)
             if item is not None:
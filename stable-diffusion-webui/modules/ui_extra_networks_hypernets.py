@@ -35,9 +35,15 @@ class ExtraNetworksPageHypernetworks(ui_extra_networks.ExtraNetworksPage):
             "sort_keys": {'default': index, **self.get_sort_keys(path + ext)},
         }
 
-    def list_items(self):
+    def list_item_names(self):
         # instantiate a list to protect against concurrent modification
-        names = list(shared.hypernetworks)
+        return list(shared.hypernetworks)
+
+    def item_filename(self, name):
+        return shared.hypernetworks.get(name)
+
+    def list_items(self):
+        names = self.list_item_names()
         for index, name in enumerate(names):
             item = self.create_item(name, index)
             if item is not None:
@@ -0,0 +1,204 @@
+"""In-memory index of extra networks items, used by the paginated JSON API for extra networks pages.
+
+Creating an item (finding its preview and description, reading user metadata) is what makes rendering the whole page
+slow, so the index keeps created items and on update only creates again those for which something changed: the file
+itself, its user metadata or description file, the contents of its directory (which changes when a preview is added
+or removed). All items are created again when the page's items_state_key() changes.
+Pages that do not implement list_item_names() have all their items created on every update.
+"""
+
+import json
+import os
+import threading
+
+from modules import errors
+
+sort_fields = ("default", "name", "path", "date_created", "date_modified")
+max_tags_per_item = 50
+
+indexes = {}
+
+
+def item_tags(item):
+    """Returns most frequent training tags from Lora metadata, if there are any."""
+
+    metadata = item.get("metadata") or {}
+
+    tag_frequency = metadata.get("ss_tag_frequency")
+    if isinstance(tag_frequency, str):
+        try:
+            tag_frequency = json.loads(tag_frequency)
+        except ValueError:
+            return []
+
+    if not isinstance(tag_frequency, dict):
+        return []
+
+    counts = {}
+    for tags in tag_frequency.values():
+        if isinstance(tags, dict):
+            for tag, count in tags.items():
+                counts[tag.strip()] = counts.get(tag.strip(), 0) + (count if isinstance(count, int) else 0)
+
+    return sorted(counts, key=lambda x: -counts[x])[:max_tags_per_item]
+
+
+class IndexEntry:
+    def __init__(self, key, item):
+        """item is None for items that the page does not show (for example, Lora for another SD version)."""
+
+        self.key = key
+        self.item = item or {}
+        self.visible = item is not None
+        self.tags = item_tags(self.item)
+
+        search_terms = [x for x in self.item.get("search_terms", []) if x]
+        self.path = (search_terms[0] if search_terms else "").replace("\\", "/").lower()
+        self.search_text = "\n".join([self.item.get("name", ""), *search_terms, *self.tags]).replace("\\", "/").lower()
+
+        sort_keys = self.item.get("sort_keys") or {}
+        self.sort_keys = {field: sort_keys.get(field) or (0 if field in ("default", "date_created", "date_modified") else "") for field in sort_fields}
+
+    def set_default_sort_key(self, index):
+        if "sort_keys" in self.item:
+            self.item["sort_keys"]["default"] = index
+
+        self.sort_keys["default"] = index
+
+    def data(self):
+        res = {k: v for k, v in self.item.items() if k != "metadata"}
+        res["has_metadata"] = bool(self.item.get("metadata"))
+        res["tags"] = self.tags
+
+        return res
+
+
+class ItemsIndex:
+    def __init__(self, page):
+        self.page = page
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.order = []
+        self.sorted_orders = {}
+        self.state = None
+
+    def item_key(self, filename, dir_mtimes):
+        if not filename:
+            return None
+
+        lister = self.page.lister
+        base = os.path.splitext(filename)[0]
+        dirname = os.path.dirname(filename)
+
+        if dirname not in dir_mtimes:
+            try:
+                dir_mtimes[dirname] = os.stat(dirname).st_mtime_ns
+            except OSError:
+                dir_mtimes[dirname] = None
+
+        return (
+            dir_mtimes[dirname],
+            lister.find(filename),
+            lister.find(f"{base}.json"),
+            lister.find(f"{base}.txt"),
+            lister.find(f"{base}.description.txt"),
+        )
+
+    def create_entry(self, key, name, index):
+        try:
+            item = self.page.create_item(name, index)
+        except Exception as e:
+            errors.display(e, f"creating item for {name}")
+            return None
+
+        if item is not None and "user_metadata" not in item:
+            self.page.read_user_metadata(item)
+
+        return IndexEntry(key, item)
+
+    def update(self, full=False):
+        """Brings the index up to date with the page's list of items; if full is True, creates all items again."""
+
+        page = self.page
+        page.lister.reset()
+
+        with self.lock:
+            state = page.items_state_key()
+            if state != self.state:
+                full = True
+                self.state = state
+
+            names = page.list_item_names()
+            if names is None:
+                items = list(page.list_items())
+                for item in items:
+                    if "user_metadata" not in item:
+                        page.read_user_metadata(item)
+
+                entries = {item["name"]: IndexEntry(None, item) for item in items}
+            else:
+                entries = {}
+                dir_mtimes = {}
+                for index, name in enumerate(names):
+                    key = self.item_key(page.item_filename(name), dir_mtimes)
+
+                    entry = self.entries.get(name)
+                    if full or entry is None or key is None or entry.key != key:
+                        entry = self.create_entry(key, name, index)
+                    elif entry.visible:
+                        entry.set_default_sort_key(index)
+
+                    if entry is not None:
+                        entries[name] = entry
+
+            self.entries = entries
+            self.order = [x for x in entries.values() if x.visible]
+            self.sorted_orders = {}
+
+            for entry in self.order:
+                metadata = entry.item.get("metadata")
+                if metadata:
+                    page.metadata[entry.item["name"]] = metadata
+
+                page.items[entry.item["name"]] = entry.item
+
+    def sorted_entries(self, sort):
+        if sort not in sort_fields:
+            raise ValueError(f"Unknown sort field: {sort}; must be one of: {', '.join(sort_fields)}")
+
+        order = self.sorted_orders.get(sort)
+        if order is None:
+            order = self.sorted_orders[sort] = sorted(self.order, key=lambda x: x.sort_keys[sort])
+
+        return order
+
+    def query(self, *, search="", path="", sort="default", reverse=False, offset=0, limit=50):
+        """Returns (total number of matching items, list of JSON-ready dicts for items from offset to offset + limit).
+
+        search is a space separated list of terms, all of which must be found in item's name, path or tags.
+        path, if specified, only allows items whose path (as shown in the directory view) starts with it.
+        """
+
+        with self.lock:
+            entries = self.sorted_entries(sort)
+
+        terms = search.lower().replace("\\", "/").split()
+        path = path.lower().replace("\\", "/")
+
+        if terms or path:
+            entries = [x for x in entries if x.path.startswith(path) and all(term in x.search_text for term in terms)]
+
+        if reverse:
+            entries = entries[::-1]
+
+        offset = max(offset, 0)
+        return len(entries), [x.data() for x in entries[offset:offset + max(limit, 0)]]
+
+
+def get_index(page) -> ItemsIndex:
+    index = indexes.get(page.name)
+    if index is None or index.page is not page:
+        index = indexes[page.name] = ItemsIndex(page)
+        index.update()
+
+    return index
@@ -33,9 +33,16 @@ class ExtraNetworksPageTextualInversion(ui_extra_networks.ExtraNetworksPage):
             "sort_keys": {'default': index, **self.get_sort_keys(embedding.filename)},
         }
 
-    def list_items(self):
+    def list_item_names(self):
         # instantiate a list to protect against concurrent modification
-        names = list(sd_hijack.model_hijack.embedding_db.word_embeddings)
+        return list(sd_hijack.model_hijack.embedding_db.word_embeddings)
+
+    def item_filename(self, name):
+        embedding = sd_hijack.model_hijack.embedding_db.word_embeddings.get(name)
+        return embedding.filename if embedding is not None else None
+
+    def list_items(self):
+        names = self.list_item_names()
         for index, name in enumerate(names):
             item = self.create_item(name, index)
             if item is not None:
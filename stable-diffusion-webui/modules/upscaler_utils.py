@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import logging
 from typing import Callable
 
@@ -6,7 +8,7 @@ import torch
 import tqdm
 from PIL import Image
 
-from modules import devices, images, shared, torch_utils
+from modules import devices, sd_vae_tiled, shared, torch_utils
 
 logger = logging.getLogger(__name__)
 
@@ -27,11 +29,16 @@ def torch_bgr_to_pil_image(tensor: torch.Tensor) -> Image.Image:
             raise ValueError(f"{tensor.shape} does not describe a BCHW tensor")
         tensor = tensor.squeeze(0)
     assert tensor.ndim == 3, f"{tensor.shape} does not describe a CHW tensor"
-    # TODO: is `tensor.float().cpu()...numpy()` the most efficient idiom?
-    arr = tensor.float().cpu().clamp_(0, 1).numpy()  # clamp
-    arr = 255.0 * np.moveaxis(arr, 0, 2)  # CHW to HWC, rescale
-    arr = arr.round().astype(np.uint8)
-    arr = arr[:, :, ::-1]  # flip BGR to RGB
+    _, h, w = tensor.shape
+    arr = np.empty((h, w, 3), dtype=np.uint8)
+    out = torch.from_numpy(arr)
+
+    # convert in strips to keep temporary tensors small, and to uint8 before moving to CPU to copy less data
+    rows = max(1, 2 ** 20 // w)
+    for y in range(0, h, rows):
+        strip = tensor[:, y:y + rows].float().clamp(0, 1).mul_(255).round_().to(torch.uint8)
+        out[y:y + rows] = strip.flip(0).permute(1, 2, 0).cpu()  # flip BGR to RGB, CHW to HWC
+
     return Image.fromarray(arr, "RGB")
 
 
@@ -48,6 +55,114 @@ def upscale_pil_patch(model, img: Image.Image) -> Image.Image:
             return torch_bgr_to_pil_image(model(tensor))
 
 
+default_tile_batch_size = 4
+max_tile_batch_size = 16
+
+
+def get_tile_batch_size(device: torch.device, tile_memory: int = None) -> int:
+    """Returns how many tiles to upscale in one forward pass.
+
+    Uses the number from settings; if it's 0, on CUDA picks as many tiles as fit into free memory, given tile_memory -
+    the memory a forward pass needs per tile, in bytes - uses 1 on CPU and default_tile_batch_size on other devices.
+    """
+
+    batch_size = int(shared.opts.upscaler_tile_batch_size)
+    if batch_size > 0:
+        return batch_size
+
+    if device.type == "cpu":
+        return 1  # there's nothing to gain from batching on CPU; bigger activations only fall out of cache
+
+    if device.type != "cuda" or not tile_memory:
+        return default_tile_batch_size
+
+    return devices.batch_size_for_free_memory(device, tile_memory, max_tile_batch_size)
+
+
+def upscale_tiles(
+    img: torch.Tensor,
+    model,
+    *,
+    tile_size: int,
+    tile_overlap: int,
+    desc="Tiled upscale",
+) -> torch.Tensor | None:
+    """Upscales a BCHW tensor with the model in overlapping tiles; returns None if interrupted.
+
+    Several tiles are stacked into one forward pass (see get_tile_batch_size). Results are moved to the CPU as each
+    batch finishes and blended there with weights that ramp linearly across the overlaps, so memory used on the
+    model's device does not depend on the size of the output. The first tile is upscaled alone to measure how much
+    memory a tile needs.
+    """
+
+    param = torch_utils.get_param(model)
+    device, dtype = param.device, param.dtype
+    h, w = img.shape[-2:]
+
+    if tile_size <= 0 or (h <= tile_size and w <= tile_size):
+        logger.debug("Upscaling %s without tiling", img.shape)
+        with devices.without_autocast():
+            return model(img.to(device=device, dtype=dtype))
+
+    positions = [(y, x) for y in sd_vae_tiled.tile_positions(h, tile_size, tile_overlap) for x in sd_vae_tiled.tile_positions(w, tile_size, tile_overlap)]
+
+    result = None
+    scale = None
+    batch_size = None
+    start = 0
+
+    with tqdm.tqdm(total=len(positions), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
+        while start < len(positions):
+            if shared.state.interrupted or shared.state.skipped:
+                return None
+
+            batch_positions = positions[start:start + (batch_size or 1)]
+            tiles = torch.cat([img[..., y:y + tile_size, x:x + tile_size] for y, x in batch_positions]).to(device=device, dtype=dtype)
+
+            measure_memory = batch_size is None and device.type == "cuda"
+            if measure_memory:
+                torch.cuda.reset_peak_memory_stats(device)
+                memory_before = torch.cuda.memory_allocated(device)
+
+            with devices.without_autocast():
+                output = model(tiles)
+
+            if batch_size is None:
+                batch_size = get_tile_batch_size(device, torch.cuda.max_memory_allocated(device) - memory_before if measure_memory else None)
+                logger.debug("Upscaling %d tiles in batches of %d", len(positions), batch_size)
+
+            output = output.to(devices.cpu).float()
+
+            if result is None:
+                scale = output.shape[-1] // tiles.shape[-1]
+                result = torch.zeros(img.shape[:-3] + (output.shape[-3], h * scale, w * scale), dtype=torch.float32)
+
+                # every tile position in one dimension is combined with every position in the other, so sums of weights are separable
+                ramp = tile_overlap * scale
+                weights_h = torch.zeros(h * scale)
+                weights_w = torch.zeros(w * scale)
+                for y in sd_vae_tiled.tile_positions(h, tile_size, tile_overlap):
+                    weights_h[y * scale:y * scale + output.shape[-2]] += sd_vae_tiled.blend_ramp(output.shape[-2], ramp, y > 0, y + tile_size < h, device=devices.cpu)
+                for x in sd_vae_tiled.tile_positions(w, tile_size, tile_overlap):
+                    weights_w[x * scale:x * scale + output.shape[-1]] += sd_vae_tiled.blend_ramp(output.shape[-1], ramp, x > 0, x + tile_size < w, device=devices.cpu)
+
+            del tiles
+
+            out_h, out_w = output.shape[-2:]
+            for i, (y, x) in enumerate(batch_positions):
+                mask = torch.outer(
+                    sd_vae_tiled.blend_ramp(out_h, ramp, y > 0, y + tile_size < h, device=devices.cpu),
+                    sd_vae_tiled.blend_ramp(out_w, ramp, x > 0, x + tile_size < w, device=devices.cpu),
+                )
+                tile_output = output[i * img.shape[0]:(i + 1) * img.shape[0]]
+                result[..., y * scale:y * scale + out_h, x * scale:x * scale + out_w].addcmul_(tile_output, mask)
+
+            start += len(batch_positions)
+            pbar.update(len(batch_positions))
+
+    return result.div_(torch.outer(weights_h, weights_w))
+
+
 def upscale_with_model(
     model: Callable[[torch.Tensor], torch.Tensor],
     img: Image.Image,
@@ -62,30 +177,12 @@ def upscale_with_model(
         logger.debug("=> %s", output)
         return output
 
-    grid = images.split_grid(img, tile_size, tile_size, tile_overlap)
-    newtiles = []
-
-    with tqdm.tqdm(total=grid.tile_count, desc=desc, disable=not shared.opts.enable_upscale_progressbar) as p:
-        for y, h, row in grid.tiles:
-            newrow = []
-            for x, w, tile in row:
-                if shared.state.interrupted:
-                    return img
-                output = upscale_pil_patch(model, tile)
-                scale_factor = output.width // tile.width
-                newrow.append([x * scale_factor, w * scale_factor, output])
-                p.update(1)
-            newtiles.append([y * scale_factor, h * scale_factor, newrow])
-
-    newgrid = images.Grid(
-        newtiles,
-        tile_w=grid.tile_w * scale_factor,
-        tile_h=grid.tile_h * scale_factor,
-        image_w=grid.image_w * scale_factor,
-        image_h=grid.image_h * scale_factor,
-        overlap=grid.overlap * scale_factor,
-    )
-    return images.combine_grid(newgrid)
+    with torch.inference_mode():
+        output = upscale_tiles(pil_image_to_torch_bgr(img).unsqueeze(0), model, tile_size=tile_size, tile_overlap=tile_overlap, desc=desc)
+        if output is None:
+            return img
+
+        return torch_bgr_to_pil_image(output)
 
 
 def tiled_upscale_2(
@@ -98,68 +195,13 @@ def tiled_upscale_2(
     device: torch.device,
     desc="Tiled upscale",
 ):
-    # Alternative implementation of `upscale_with_model` originally used by
-    # SwinIR and ScuNET.  It differs from `upscale_with_model` in that tiling and
-    # weighting is done in PyTorch space, as opposed to `images.Grid` doing it in
-    # Pillow space without weighting.
-
-    b, c, h, w = img.size()
-    tile_size = min(tile_size, h, w)
-
-    if tile_size <= 0:
-        logger.debug("Upscaling %s without tiling", img.shape)
-        return model(img)
-
-    stride = tile_size - tile_overlap
-    h_idx_list = list(range(0, h - tile_size, stride)) + [h - tile_size]
-    w_idx_list = list(range(0, w - tile_size, stride)) + [w - tile_size]
-    result = torch.zeros(
-        b,
-        c,
-        h * scale,
-        w * scale,
-        device=device,
-        dtype=img.dtype,
-    )
-    weights = torch.zeros_like(result)
-    logger.debug("Upscaling %s to %s with tiles", img.shape, result.shape)
-    with tqdm.tqdm(total=len(h_idx_list) * len(w_idx_list), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
-        for h_idx in h_idx_list:
-            if shared.state.interrupted or shared.state.skipped:
-                break
-
-            for w_idx in w_idx_list:
-                if shared.state.interrupted or shared.state.skipped:
-                    break
+    """Same as upscale_tiles; kept for compatibility. If interrupted, returns the input resized to the output size."""
 
-                # Only move this patch to the device if it's not already there.
-                in_patch = img[
-                    ...,
-                    h_idx : h_idx + tile_size,
-                    w_idx : w_idx + tile_size,
-                ].to(device=device)
+    output = upscale_tiles(img, model, tile_size=tile_size, tile_overlap=tile_overlap, desc=desc)
+    if output is None:
+        return torch.nn.functional.interpolate(img.to(device), scale_factor=scale)
 
-                out_patch = model(in_patch)
-
-                result[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch)
-
-                out_patch_mask = torch.ones_like(out_patch)
-
-                weights[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch_mask)
-
-                pbar.update(1)
-
-    output = result.div_(weights)
-
-    return output
+    return output.to(device)
 
 
 def upscale_2(
@@ -172,19 +214,14 @@ def upscale_2(
     desc: str,
 ):
     """
-    Convenience wrapper around `tiled_upscale_2` that handles PIL images.
+    Convenience wrapper around `upscale_tiles` that handles PIL images.
     """
     param = torch_utils.get_param(model)
     tensor = pil_image_to_torch_bgr(img).to(dtype=param.dtype).unsqueeze(0)  # add batch dimension
 
     with torch.no_grad():
-        output = tiled_upscale_2(
-            tensor,
-            model,
-            tile_size=tile_size,
-            tile_overlap=tile_overlap,
-            scale=scale,
-            desc=desc,
-            device=param.device,
-        )
+        output = upscale_tiles(tensor, model, tile_size=tile_size, tile_overlap=tile_overlap, desc=desc)
+        if output is None:
+            return img
+
     return torch_bgr_to_pil_image(output)
@@ -0,0 +1,254 @@
+"""Order in which cells of an X/Y/Z plot are generated, and progress saved to disk so that a plot can be resumed.
+
+Changing some values between cells is expensive: a different checkpoint or VAE has to be loaded, a prompt with
+different LoRAs has to activate them, and any prompt change means conditioning has to be calculated again. A plan
+tries every order of axes, with cells visited either row by row or back and forth (so that the value of an outer axis
+stays the same when moving to the next row), and takes the one with the lowest total cost of changes. Cells along the
+innermost axis that only differ in seed or prompt can be generated together, as one batch.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import time
+from collections import namedtuple
+
+from PIL import Image
+
+Plan = namedtuple("Plan", ["batches", "axes_order", "changes", "cost"])
+
+re_extra_network = re.compile(r"<\w+:[^>]+>")
+
+conditioning_cost = 0.05
+extra_network_cost = 0.3
+
+progress_max_age = 7 * 24 * 60 * 60
+"""Saved cells of interrupted plots that were not touched for this many seconds are deleted when another plot
+finishes."""
+
+
+def axis_cost(opt, values):
+    """Cost of changing value of the axis between cells: option's own cost, plus conditioning and extra networks
+    for axes that change the prompt."""
+
+    cost = opt.cost
+
+    if opt.label in ("Prompt S/R", "Prompt order", "Styles"):
+        cost += conditioning_cost
+
+        if any(re_extra_network.search(str(value)) for value in values):
+            cost += extra_network_cost
+
+    return cost
+
+
+def axis_batchable(opt, values, prompts, batchable_labels):
+    """Tells whether cells that only differ in value of the axis can be generated in one batch.
+
+    Prompts in a batch must use the same extra networks, because extra_networks.parse_prompts only activates networks
+    from the first prompt; so prompt axes are not batchable if their values contain extra networks, or if Prompt S/R
+    replaces text inside an extra network in prompts.
+    """
+
+    if opt.label not in batchable_labels:
+        return False
+
+    if opt.label in ("Prompt S/R", "Prompt order"):
+        texts = [str(x) for value in values for x in (value if isinstance(value, (list, tuple)) else [value])]
+        if any(re_extra_network.search(text) for text in texts):
+            return False
+
+        if opt.label == "Prompt S/R" and values:
+            networks = [network for prompt in prompts for network in re_extra_network.findall(prompt or "")]
+            if any(str(values[0]) in network for network in networks):
+                return False
+
+    return True
+
+
+def cell_order(sizes, axes_order, back_and_forth=False):
+    """Returns (ix, iy, iz) of all cells, with axes_order[0] changing slowest and axes_order[2] fastest.
+
+    With back_and_forth, every other run of an inner axis goes from last value to first.
+    """
+
+    outer, middle, inner = axes_order
+    result = []
+    runs = 0
+
+    for io in range(sizes[outer]):
+        middle_values = range(sizes[middle])
+        if back_and_forth and io % 2 == 1:
+            middle_values = reversed(middle_values)
+
+        for im in middle_values:
+            inner_values = range(sizes[inner])
+            if back_and_forth and runs % 2 == 1:
+                inner_values = reversed(inner_values)
+            runs += 1
+
+            for ii in inner_values:
+                cell = [0, 0, 0]
+                cell[outer], cell[middle], cell[inner] = io, im, ii
+                result.append(tuple(cell))
+
+    return result
+
+
+def count_changes(order):
+    """Returns how many times value of each axis changes when cells are generated in order."""
+
+    changes = [0, 0, 0]
+    for previous, current in zip(order, order[1:]):
+        for axis in range(3):
+            if previous[axis] != current[axis]:
+                changes[axis] += 1
+
+    return changes
+
+
+def split_into_batches(order, inner, batch_size):
+    """Groups consecutive cells that only differ in inner axis into batches of up to batch_size cells."""
+
+    batches = []
+    for _, run in itertools.groupby(order, key=lambda cell: tuple(x for axis, x in enumerate(cell) if axis != inner)):
+        run = list(run)
+        batches += [run[i:i + batch_size] for i in range(0, len(run), batch_size)]
+
+    return batches
+
+
+def make_plan(sizes, costs, batchable=(False, False, False), batch_size=1):
+    """Returns the plan with the lowest cost of changes; of plans with the same cost, the one with fewest batches.
+
+    sizes are numbers of values of X, Y and Z axes, costs are costs of changing a value of each axis, and batchable
+    tells for each axis whether cells that only differ in it can be generated in one batch.
+    """
+
+    best = None
+    best_key = None
+
+    # z, y, x is the order used when all axes are equally cheap
+    for axes_order in sorted(itertools.permutations(range(3)), key=lambda order: order != (2, 1, 0)):
+        for back_and_forth in (False, True):
+            order = cell_order(sizes, axes_order, back_and_forth)
+            changes = count_changes(order)
+            cost = sum(c * n for c, n in zip(costs, changes))
+
+            inner = axes_order[2]
+            if batch_size > 1 and batchable[inner]:
+                batches = split_into_batches(order, inner, batch_size)
+            else:
+                batches = [[cell] for cell in order]
+
+            key = (round(cost, 6), len(batches))
+            if best_key is None or key < best_key:
+                best = Plan(batches, axes_order, changes, cost)
+                best_key = key
+
+    return best
+
+
+def plot_key(p, seeds, axes, extra=None):
+    """Returns a string identifying a plot: made from generation parameters in p, requested seeds (before random
+    ones are picked), axes as (label, values) pairs, and anything else in extra."""
+
+    excluded = {"seed", "subseed", "outpath_samples", "outpath_grids", "user", "is_api", "do_not_save_samples", "do_not_save_grid"}
+
+    params = {k: v for k, v in vars(p).items() if k not in excluded and isinstance(v, (str, int, float, bool, type(None)))}
+    params["styles"] = p.styles
+    params["override_settings"] = p.override_settings
+    params["seeds"] = seeds
+    params["axes"] = axes
+    params["extra"] = extra
+
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf8"))
+
+    for image in (getattr(p, "init_images", None) or []) + [getattr(p, "image_mask", None)]:
+        if isinstance(image, Image.Image):
+            digest.update(image.tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+class PlotProgress:
+    """Finished cells of a plot, saved into a directory as they are generated; when the same plot is started again
+    after being interrupted, its cells are taken from here instead of being generated."""
+
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.path = os.path.join(directory, key)
+        self.state_path = os.path.join(self.path, "progress.json")
+
+        try:
+            with open(self.state_path, encoding="utf8") as file:
+                self.state = json.load(file)
+        except (OSError, ValueError):
+            self.state = {"cells": {}}
+
+    @property
+    def resumed(self):
+        return bool(self.state["cells"])
+
+    def get(self, name, default=None):
+        return self.state.get(name, default)
+
+    def set(self, name, value):
+        self.state[name] = value
+
+    def load_cell(self, index):
+        """Returns (image, prompt, seed, infotext) of a finished cell, or None."""
+
+        cell = self.state["cells"].get(str(index))
+        if cell is None:
+            return None
+
+        try:
+            image = Image.open(os.path.join(self.path, cell["file"]))
+            image.load()
+        except OSError:
+            return None
+
+        return image, cell["prompt"], cell["seed"], cell["infotext"]
+
+    def save_cell(self, index, image, prompt, seed, infotext):
+        os.makedirs(self.path, exist_ok=True)
+
+        filename = f"{index:05}.png"
+        image.save(os.path.join(self.path, filename), compress_level=1)
+
+        self.state["cells"][str(index)] = {"file": filename, "prompt": prompt, "seed": seed, "infotext": infotext}
+        self.write()
+
+    def write(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        with open(f"{self.state_path}.tmp", "w", encoding="utf8") as file:
+            json.dump(self.state, file)
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
+    def remove(self):
+        """Deletes saved cells of this plot, and of other interrupted plots older than progress_max_age, so that
+        images of plots that are never resumed don't pile up."""
+
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_dir() and time.time() - entry.stat().st_mtime > progress_max_age:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
@@ -1,13 +1,17 @@
+import concurrent.futures
 import math
 
 import modules.scripts as scripts
 import gradio as gr
+import torch
 from PIL import Image
 
 from modules import processing, shared, images, devices
 from modules.processing import Processed
 from modules.shared import opts, state
 
+max_auto_batch_size = 8
+
 
 class Script(scripts.Script):
     def title(self):
@@ -21,10 +25,11 @@ class Script(scripts.Script):
         overlap = gr.Slider(minimum=0, maximum=256, step=16, label='Tile overlap', value=64, elem_id=self.elem_id("overlap"))
         scale_factor = gr.Slider(minimum=1.0, maximum=4.0, step=0.05, label='Scale Factor', value=2.0, elem_id=self.elem_id("scale_factor"))
         upscaler_index = gr.Radio(label='Upscaler', choices=[x.name for x in shared.sd_upscalers], value=shared.sd_upscalers[0].name, type="index", elem_id=self.elem_id("upscaler_index"))
+        auto_batch_size = gr.Checkbox(label='Pick number of tiles per batch from free memory', value=False, elem_id=self.elem_id("auto_batch_size"))
 
-        return [info, overlap, upscaler_index, scale_factor]
+        return [info, overlap, upscaler_index, scale_factor, auto_batch_size]
 
-    def run(self, p, _, overlap, upscaler_index, scale_factor):
+    def run(self, p, _, overlap, upscaler_index, scale_factor, auto_batch_size=False):
         if isinstance(upscaler_index, str):
             upscaler_index = [x.name.lower() for x in shared.sd_upscalers].index(upscaler_index.lower())
         processing.fix_seed(p)
@@ -60,42 +65,81 @@ class Script(scripts.Script):
             for tiledata in row:
                 work.append(tiledata[2])
 
+        # with auto batch size, the first tile is processed alone to measure how much memory a tile needs
+        measure_memory = auto_batch_size and devices.device.type == "cuda" and not (shared.cmd_opts.lowvram or shared.cmd_opts.medvram)
+        tiles_per_batch = batch_size
+
         batch_count = math.ceil(len(work) / batch_size)
         state.job_count = batch_count * upscale_count
 
         print(f"SD upscaling will process a total of {len(work)} images tiled as {len(grid.tiles[0][2])}x{len(grid.tiles)} per upscale in a total of {state.job_count} batches.")
 
+        # conditioning is the same for all tiles, so it's only encoded once for every batch size rather than for every batch
+        conds = {}
+
         result_images = []
-        for n in range(upscale_count):
-            start_seed = seed + n
-            p.seed = start_seed
+        job_index = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sd-upscale") as executor:
+            for n in range(upscale_count):
+                start_seed = seed + n
+                p.seed = start_seed
+
+                # finished tiles are pasted into the output on a worker thread while next batches are being generated
+                combiner = images.GridCombiner(grid)
+                pasting = []
+
+                done = 0
+                while done < len(work):
+                    batch = work[done:done + (1 if measure_memory else tiles_per_batch)]
+
+                    p.batch_size = len(batch)
+                    p.init_images = batch
+                    p.cached_c, p.cached_uc = conds.setdefault(len(batch), ([None, None], [None, None]))
+                    if auto_batch_size:
+                        p.seed = start_seed + done  # every tile gets its own seed, whatever the batch size
+
+                    state.job = f"Batch {job_index + 1} out of {state.job_count}"
+
+                    if measure_memory:
+                        torch.cuda.reset_peak_memory_stats(devices.device)
+                        memory_before = torch.cuda.memory_allocated(devices.device)
+
+                    processed = processing.process_images(p)
+
+                    if measure_memory:
+                        memory_after = torch.cuda.memory_allocated(devices.device)
+                        tile_memory = torch.cuda.max_memory_allocated(devices.device) - max(memory_before, memory_after)
+                        tiles_per_batch = devices.batch_size_for_free_memory(devices.device, tile_memory, max_auto_batch_size)
+                        measure_memory = False
+
+                        # only the first upscale starts with a tile on its own
+                        batch_count = math.ceil(len(work) / tiles_per_batch)
+                        state.job_count = 1 + math.ceil((len(work) - 1) / tiles_per_batch) + batch_count * (upscale_count - 1)
+                        print(f"SD upscale will process {tiles_per_batch} tiles per batch.")
 
-            work_results = []
-            for i in range(batch_count):
-                p.batch_size = batch_size
-                p.init_images = work[i * batch_size:(i + 1) * batch_size]
+                    if initial_info is None:
+                        initial_info = processed.info
 
-                state.job = f"Batch {i + 1 + n * batch_count} out of {state.job_count}"
-                processed = processing.process_images(p)
+                    if not auto_batch_size:
+                        p.seed = processed.seed + 1
 
-                if initial_info is None:
-                    initial_info = processed.info
+                    for i in range(len(batch)):
+                        tile = processed.images[i] if i < len(processed.images) else Image.new("RGB", (p.width, p.height))
+                        pasting.append(executor.submit(combiner.add, tile))
 
-                p.seed = processed.seed + 1
-                work_results += processed.images
+                    done += len(batch)
+                    job_index += 1
 
-            image_index = 0
-            for _y, _h, row in grid.tiles:
-                for tiledata in row:
-                    tiledata[2] = work_results[image_index] if image_index < len(work_results) else Image.new("RGB", (p.width, p.height))
-                    image_index += 1
+                for future in pasting:
+                    future.result()
 
-            combined_image = images.combine_grid(grid)
-            result_images.append(combined_image)
+                combined_image = combiner.image
+                result_images.append(combined_image)
 
-            if opts.samples_save:
-                images.save_image(combined_image, p.outpath_samples, "", start_seed, p.prompt, opts.samples_format, info=initial_info, p=p)
+                if opts.samples_save:
+                    images.save_image(combined_image, p.outpath_samples, "", start_seed, p.prompt, opts.samples_format, info=initial_info, p=p)
 
+        p.batch_size = batch_size
         processed = Processed(p, result_images, seed, initial_info)
 
         return processed
@@ -4,6 +4,7 @@ from itertools import permutations, chain
 import random
 import csv
 import os.path
+import tempfile
 from io import StringIO
 from PIL import Image
 import numpy as np
@@ -11,7 +12,7 @@ import numpy as np
 import modules.scripts as scripts
 import gradio as gr
 
-from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_schedulers, errors
+from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_schedulers, errors, xyz_grid_plan
 from modules.processing import process_images, Processed, StableDiffusionProcessingTxt2Img
 from modules.shared import opts, state
 import modules.shared as shared
@@ -24,6 +25,9 @@ from modules.ui_components import ToolButton
 
 fill_values_symbol = "\U0001f4d2"  # 📒
 
+# cells that only differ in values of these axes can be generated together as one batch
+batchable_axes = ("Seed", "Var. seed", "Prompt S/R", "Prompt order")
+
 AxisInfo = namedtuple('AxisInfo', ['axis', 'values'])
 
 
@@ -284,7 +288,92 @@ axis_options = [
 ]
 
 
-def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend, include_lone_images, include_sub_grids, first_axes_processed, second_axes_processed, margin_size):
+grid_tile_size = 4096
+grid_preview_side = 4096
+
+
+class CellStore:
+    """Keeps images of X/Y/Z plot cells in a temporary directory instead of memory, for grids that are too large."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.temp_dir = tempfile.TemporaryDirectory(dir=directory, prefix="tmp-xyz-grid-")
+        self.sizes = {}
+
+    def path(self, index):
+        return os.path.join(self.temp_dir.name, f"{index}.npy")
+
+    def put(self, index, image):
+        np.save(self.path(index), np.asarray(image.convert("RGB")))
+        self.sizes[index] = image.size
+
+    def get(self, index):
+        return Image.fromarray(np.load(self.path(index)))
+
+    def close(self):
+        self.temp_dir.cleanup()
+
+
+def draw_streamed_grid(cells, indexes, cols, rows, draw_legend, hor_texts, ver_texts, margin_size, directory):
+    """Same as images.image_grid followed by images.draw_grid_annotations, but pastes cell images one at a time into
+    a GridCanvas; cells is a function that returns the image for an index, and indexes are in row-major order."""
+
+    w, h = map(max, zip(*(size for size, _ in indexes)))
+
+    if draw_legend:
+        layout = images.GridAnnotationLayout(w, h, hor_texts, ver_texts, margin_size)
+        canvas = images.GridCanvas(*layout.size, opts.grid_background_color, directory=directory)
+        position = layout.cell_position
+    else:
+        layout = None
+        canvas = images.GridCanvas(cols * w, rows * h, opts.grid_background_color, directory=directory)
+
+        def position(col, row):
+            return col * w, row * h
+
+    for i, ((img_w, img_h), index) in enumerate(indexes):
+        x, y = position(i % cols, i // cols)
+        canvas.paste(cells(index), (x + (w - img_w) // 2, y + (h - img_h) // 2))
+
+    if layout is not None:
+        layout.draw_on_canvas(canvas)
+
+    return canvas
+
+
+def draw_streamed_xyz_grids(processed_result, store, xs, ys, zs, hor_texts, ver_texts, title_texts, draw_legend, margin_size):
+    """Builds sub-grids and the grid of sub-grids from images in store; puts their downscaled previews into
+    processed_result.images, with full size grids in the grid_canvas attribute of each preview."""
+
+    directory = os.path.dirname(store.temp_dir.name)
+    empty_size = next(iter(store.sizes.values()))
+
+    def cell_image(index):
+        return store.get(index) if index in store.sizes else Image.new("RGB", empty_size, (0, 0, 0))
+
+    sub_grids = []
+    for iz in range(len(zs)):
+        start_index = iz * len(xs) * len(ys)
+        indexes = [(store.sizes.get(index, empty_size), index) for index in range(start_index, start_index + len(xs) * len(ys))]
+        sub_grids.append(draw_streamed_grid(cell_image, indexes, len(xs), len(ys), draw_legend, hor_texts, ver_texts, margin_size, directory))
+
+    z_grid = draw_streamed_grid(lambda i: sub_grids[i], [(grid.size, i) for i, grid in enumerate(sub_grids)], len(zs), 1, draw_legend, title_texts, [[images.GridAnnotation()]], 0, directory)
+
+    for i, grid in enumerate([z_grid] + sub_grids):
+        preview = grid.preview(grid_preview_side)
+        preview.grid_canvas = grid
+        processed_result.images.insert(i, preview)
+
+    processed_result.all_prompts[:0] = processed_result.all_prompts[:len(zs) * len(xs) * len(ys):len(xs) * len(ys)]
+    processed_result.all_seeds[:0] = processed_result.all_seeds[:len(zs) * len(xs) * len(ys):len(xs) * len(ys)]
+    processed_result.infotexts[:0] = [processed_result.infotexts[0]] + processed_result.infotexts[:len(zs) * len(xs) * len(ys):len(xs) * len(ys)]
+
+    store.close()
+
+    return processed_result
+
+
+def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend, include_lone_images, include_sub_grids, first_axes_processed, second_axes_processed, margin_size, stream_directory=None, plan=None, cell_batch=None):
     hor_texts = [[images.GridAnnotation(x)] for x in x_labels]
     ver_texts = [[images.GridAnnotation(y)] for y in y_labels]
     title_texts = [[images.GridAnnotation(z)] for z in z_labels]
@@ -292,19 +381,30 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
     list_size = (len(xs) * len(ys) * len(zs))
 
     processed_result = None
+    store = None
 
     state.job_count = list_size * p.n_iter
 
-    def process_cell(x, y, z, ix, iy, iz):
-        nonlocal processed_result
-
-        def index(ix, iy, iz):
-            return ix + iy * len(xs) + iz * len(xs) * len(ys)
+    def index(ix, iy, iz):
+        return ix + iy * len(xs) + iz * len(xs) * len(ys)
 
+    def process_cell(x, y, z, ix, iy, iz):
         state.job = f"{index(ix, iy, iz) + 1} out of {list_size}"
 
         processed: Processed = cell(x, y, z, ix, iy, iz)
 
+        add_cell_result(processed, ix, iy, iz)
+
+    def process_batch(batch):
+        ix, iy, iz = batch[0]
+        state.job = f"{index(ix, iy, iz) + 1}-{index(ix, iy, iz) + len(batch)} out of {list_size}"
+
+        for (ix, iy, iz), processed in zip(batch, cell_batch(batch)):
+            add_cell_result(processed, ix, iy, iz)
+
+    def add_cell_result(processed, ix, iy, iz):
+        nonlocal processed_result, store
+
         if processed_result is None:
             # Use our first processed result object as a template container to hold our full results
             processed_result = copy(processed)
@@ -314,14 +414,22 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
             processed_result.infotexts = [None] * list_size
             processed_result.index_of_first_image = 1
 
+            if stream_directory is not None and processed.images and opts.grid_stream_above_mp > 0:
+                w, h = processed.images[0].size
+                if w * h * list_size > opts.grid_stream_above_mp * 1000000:
+                    store = CellStore(stream_directory)
+
         idx = index(ix, iy, iz)
         if processed.images:
             # Non-empty list indicates some degree of success.
-            processed_result.images[idx] = processed.images[0]
+            if store is not None:
+                store.put(idx, processed.images[0])
+            else:
+                processed_result.images[idx] = processed.images[0]
             processed_result.all_prompts[idx] = processed.prompt
             processed_result.all_seeds[idx] = processed.seed
             processed_result.infotexts[idx] = processed.infotexts[0]
-        else:
+        elif store is None:
             cell_mode = "P"
             cell_size = (processed_result.width, processed_result.height)
             if processed_result.images[0] is not None:
@@ -330,7 +438,14 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
                 cell_size = processed_result.images[0].size
             processed_result.images[idx] = Image.new(cell_mode, cell_size)
 
-    if first_axes_processed == 'x':
+    if plan is not None:
+        for batch in plan.batches:
+            if len(batch) > 1 and cell_batch is not None:
+                process_batch(batch)
+            else:
+                for ix, iy, iz in batch:
+                    process_cell(xs[ix], ys[iy], zs[iz], ix, iy, iz)
+    elif first_axes_processed == 'x':
         for ix, x in enumerate(xs):
             if second_axes_processed == 'y':
                 for iy, y in enumerate(ys):
@@ -365,6 +480,8 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
         # Should never happen, I've only seen it on one of four open tabs and it needed to refresh.
         print("Unexpected error: Processing could not begin, you may need to refresh the tab or restart the service.")
         return Processed(p, [])
+    elif store is not None:
+        return draw_streamed_xyz_grids(processed_result, store, xs, ys, zs, hor_texts, ver_texts, title_texts, draw_legend, margin_size)
     elif not any(processed_result.images):
         print("Unexpected error: draw_xyz_grid failed to return even a single processed image")
         return Processed(p, [])
@@ -453,6 +570,8 @@ class Script(scripts.Script):
                 csv_mode = gr.Checkbox(label='Use text inputs instead of dropdowns', value=False, elem_id=self.elem_id("csv_mode"))
             with gr.Column():
                 margin_size = gr.Slider(label="Grid margins (px)", minimum=0, maximum=500, value=0, step=2, elem_id=self.elem_id("margin_size"))
+                cells_per_batch = gr.Slider(label="Cells per batch", minimum=1, maximum=16, value=1, step=1, elem_id=self.elem_id("cells_per_batch"), tooltip="Generate cells that only differ in seed or prompt together, as one batch; only used when batch size and count are 1.")
+                resume_plot = gr.Checkbox(label='Resume if interrupted', value=False, elem_id=self.elem_id("resume_plot"), tooltip="Save finished cells; when the same plot is started again, continue from them.")
 
         with gr.Row(variant="compact", elem_id="swap_axes"):
             swap_xy_axes_button = gr.Button(value="Swap X/Y axes", elem_id="xy_grid_swap_axes_button")
@@ -533,11 +652,13 @@ class Script(scripts.Script):
             (z_values_dropdown, lambda params: get_dropdown_update_from_params("Z", params)),
         )
 
-        return [x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, vary_seeds_x, vary_seeds_y, vary_seeds_z, margin_size, csv_mode]
+        return [x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, vary_seeds_x, vary_seeds_y, vary_seeds_z, margin_size, csv_mode, cells_per_batch, resume_plot]
 
-    def run(self, p, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, vary_seeds_x, vary_seeds_y, vary_seeds_z, margin_size, csv_mode):
+    def run(self, p, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, vary_seeds_x, vary_seeds_y, vary_seeds_z, margin_size, csv_mode, cells_per_batch=1, resume_plot=False):
         x_type, y_type, z_type = x_type or 0, y_type or 0, z_type or 0  # if axle type is None set to 0
 
+        requested_seeds = [p.seed, p.subseed]
+
         if not no_fixed_seeds:
             modules.processing.fix_seed(p)
 
@@ -640,11 +761,25 @@ class Script(scripts.Script):
             else:
                 return axis_list
 
+        progress = None
+        if resume_plot and not no_fixed_seeds:
+            key = xyz_grid_plan.plot_key(p, requested_seeds, [(x_opt.label, xs), (y_opt.label, ys), (z_opt.label, zs)], extra=[vary_seeds_x, vary_seeds_y, vary_seeds_z, opts.sd_model_checkpoint, opts.sd_vae])
+            progress = xyz_grid_plan.PlotProgress(os.path.join(p.outpath_grids, "xyz_grid-progress"), key)
+
         if not no_fixed_seeds:
             xs = fix_axis_seeds(x_opt, xs)
             ys = fix_axis_seeds(y_opt, ys)
             zs = fix_axis_seeds(z_opt, zs)
 
+        if progress is not None and progress.resumed:
+            # random seeds were picked when the plot was first started, use the same ones
+            p.seed, p.subseed = progress.get("seeds")
+            xs, ys, zs = [values if opt.label not in ['Seed', 'Var. seed'] else stored for opt, values, stored in zip((x_opt, y_opt, z_opt), (xs, ys, zs), progress.get("axes"))]
+            print(f"X/Y/Z plot: continuing interrupted plot, {len(progress.state['cells'])} cells are already done.")
+        elif progress is not None:
+            progress.set("seeds", [p.seed, p.subseed])
+            progress.set("axes", [xs, ys, zs])
+
         if x_opt.label == 'Steps':
             total_steps = sum(xs) * len(ys) * len(zs)
         elif y_opt.label == 'Steps':
@@ -678,36 +813,50 @@ class Script(scripts.Script):
         state.xyz_plot_y = AxisInfo(y_opt, ys)
         state.xyz_plot_z = AxisInfo(z_opt, zs)
 
-        # If one of the axes is very slow to change between (like SD model
-        # checkpoint), then make sure it is in the outer iteration of the nested
-        # `for` loop.
-        first_axes_processed = 'z'
-        second_axes_processed = 'y'
-        if x_opt.cost > y_opt.cost and x_opt.cost > z_opt.cost:
-            first_axes_processed = 'x'
-            if y_opt.cost > z_opt.cost:
-                second_axes_processed = 'y'
-            else:
-                second_axes_processed = 'z'
-        elif y_opt.cost > x_opt.cost and y_opt.cost > z_opt.cost:
-            first_axes_processed = 'y'
-            if x_opt.cost > z_opt.cost:
-                second_axes_processed = 'x'
-            else:
-                second_axes_processed = 'z'
-        elif z_opt.cost > x_opt.cost and z_opt.cost > y_opt.cost:
-            first_axes_processed = 'z'
-            if x_opt.cost > y_opt.cost:
-                second_axes_processed = 'x'
-            else:
-                second_axes_processed = 'y'
+        # Order cells so that slow to change values (like SD model checkpoint) change as few times as possible.
+        list_size = len(xs) * len(ys) * len(zs)
+        axes = (x_opt, y_opt, z_opt)
+        axis_values = (xs, ys, zs)
+        costs = [xyz_grid_plan.axis_cost(opt, values) for opt, values in zip(axes, axis_values)]
+        batchable = [xyz_grid_plan.axis_batchable(opt, values, (p.prompt, p.negative_prompt), batchable_axes) for opt, values in zip(axes, axis_values)]
+        plan = xyz_grid_plan.make_plan([len(values) for values in axis_values], costs, batchable, int(cells_per_batch) if p.batch_size == 1 and p.n_iter == 1 else 1)
+
+        first_axes_processed, second_axes_processed = "xyz"[plan.axes_order[0]], "xyz"[plan.axes_order[1]]
+
+        expected_changes = ", ".join(f"{opt.label}: {changes}" for opt, changes, cost in zip(axes, plan.changes, costs) if cost > 0)
+        if expected_changes or len(plan.batches) < list_size:
+            print(f"X/Y/Z plot: {len(plan.batches)} batches for {list_size} cells; expected value changes: {expected_changes or 'none'}")
+
+        loaded_models = []
+
+        def note_loaded_models():
+            loaded_models.append((getattr(getattr(shared.sd_model, "sd_checkpoint_info", None), "title", None), sd_vae.loaded_vae_file))
 
         grid_infotext = [None] * (1 + len(zs))
+        if progress is not None and progress.resumed:
+            grid_infotext = progress.get("grid_infotext", grid_infotext)
 
-        def cell(x, y, z, ix, iy, iz):
-            if shared.state.interrupted or state.stopping_generation:
-                return Processed(p, [], p.seed, "")
+        def cell_index(ix, iy, iz):
+            return ix + iy * len(xs) + iz * len(xs) * len(ys)
 
+        def resumed_cell(ix, iy, iz):
+            saved = progress.load_cell(cell_index(ix, iy, iz)) if progress is not None else None
+            if saved is None:
+                return None
+
+            image, prompt, seed, infotext = saved
+            res = Processed(p, [image], seed, "", all_prompts=[prompt], all_seeds=[seed], infotexts=[infotext])
+            res.prompt = prompt
+            return res
+
+        def save_progress(res, ix, iy, iz):
+            if progress is None or not res.images or shared.state.interrupted or state.stopping_generation or shared.state.skipped:
+                return
+
+            progress.set("grid_infotext", grid_infotext)
+            progress.save_cell(cell_index(ix, iy, iz), res.images[0], res.prompt, res.seed, res.infotexts[0])
+
+        def cell_p(x, y, z, ix, iy, iz):
             pc = copy(p)
             pc.styles = pc.styles[:]
             x_opt.apply(pc, x, xs)
@@ -724,13 +873,9 @@ class Script(scripts.Script):
             if vary_seeds_z:
                 pc.seed += iz * xdim * ydim
 
-            try:
-                res = process_images(pc)
-            except Exception as e:
-                errors.display(e, "generating image for xyz plot")
-
-                res = Processed(p, [], p.seed, "")
+            return pc
 
+        def set_grid_infotext(pc, ix, iy, iz, position_in_batch=0):
             # Sets subgrid infotexts
             subgrid_index = 1 + iz
             if grid_infotext[subgrid_index] is None and ix == 0 and iy == 0:
@@ -749,7 +894,7 @@ class Script(scripts.Script):
                     if y_opt.label in ["Seed", "Var. seed"] and not no_fixed_seeds:
                         pc.extra_generation_params["Fixed Y Values"] = ", ".join([str(y) for y in ys])
 
-                grid_infotext[subgrid_index] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds)
+                grid_infotext[subgrid_index] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds, position_in_batch=position_in_batch)
 
             # Sets main grid infotext
             if grid_infotext[0] is None and ix == 0 and iy == 0 and iz == 0:
@@ -761,10 +906,76 @@ class Script(scripts.Script):
                     if z_opt.label in ["Seed", "Var. seed"] and not no_fixed_seeds:
                         pc.extra_generation_params["Fixed Z Values"] = ", ".join([str(z) for z in zs])
 
-                grid_infotext[0] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds)
+                grid_infotext[0] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds, position_in_batch=position_in_batch)
+
+        def cell(x, y, z, ix, iy, iz):
+            if shared.state.interrupted or state.stopping_generation:
+                return Processed(p, [], p.seed, "")
+
+            res = resumed_cell(ix, iy, iz)
+            if res is not None:
+                return res
+
+            pc = cell_p(x, y, z, ix, iy, iz)
+
+            try:
+                res = process_images(pc)
+            except Exception as e:
+                errors.display(e, "generating image for xyz plot")
+
+                res = Processed(p, [], p.seed, "")
+            else:
+                set_grid_infotext(pc, ix, iy, iz)
+
+            note_loaded_models()
+            save_progress(res, ix, iy, iz)
 
             return res
 
+        def cell_batch(batch):
+            """Generates cells that only differ in a batchable axis with one process_images call."""
+
+            results = {cell_ix: resumed_cell(*cell_ix) for cell_ix in batch}
+            todo = [cell_ix for cell_ix in batch if results[cell_ix] is None]
+
+            if todo and not (shared.state.interrupted or state.stopping_generation):
+                pcs = [cell_p(xs[ix], ys[iy], zs[iz], ix, iy, iz) for ix, iy, iz in todo]
+
+                pc = copy(pcs[0])
+                pc.prompt = [x.prompt for x in pcs]
+                pc.negative_prompt = [x.negative_prompt for x in pcs]
+                pc.seed = [x.seed for x in pcs]
+                pc.subseed = [x.subseed for x in pcs]
+                pc.batch_size = len(pcs)
+                pc.do_not_save_grid = True
+
+                try:
+                    res = process_images(pc)
+                except Exception as e:
+                    errors.display(e, "generating images for xyz plot")
+
+                    res = Processed(p, [], p.seed, "")
+
+                note_loaded_models()
+
+                for j, cell_ix in enumerate(todo):
+                    image_index = res.index_of_first_image + j
+                    if image_index >= len(res.images):
+                        break
+
+                    set_grid_infotext(pc, *cell_ix, position_in_batch=j)
+
+                    cell_res = copy(res)
+                    cell_res.images = [res.images[image_index]]
+                    cell_res.infotexts = [res.infotexts[image_index]]
+                    cell_res.prompt = res.all_prompts[j]
+                    cell_res.seed = res.all_seeds[j]
+                    save_progress(cell_res, *cell_ix)
+
+                    results[cell_ix] = cell_res
+
+            return [results[cell_ix] or Processed(p, [], p.seed, "") for cell_ix in batch]
+
         with SharedSettingsStackHelper():
             processed = draw_xyz_grid(
                 p,
@@ -775,14 +986,25 @@ class Script(scripts.Script):
                 y_labels=[y_opt.format_value(p, y_opt, y) for y in ys],
                 z_labels=[z_opt.format_value(p, z_opt, z) for z in zs],
                 cell=cell,
+                cell_batch=cell_batch,
+                plan=plan,
                 draw_legend=draw_legend,
                 include_lone_images=include_lone_images,
                 include_sub_grids=include_sub_grids,
                 first_axes_processed=first_axes_processed,
                 second_axes_processed=second_axes_processed,
-                margin_size=margin_size
+                margin_size=margin_size,
+                stream_directory=None if include_lone_images else p.outpath_grids,
             )
 
+        model_changes = sum(previous != current for previous, current in zip(loaded_models, loaded_models[1:]))
+        expected_model_changes = sum(any(previous[axis] != current[axis] for axis, opt in enumerate(axes) if opt.label in ("Checkpoint name", "VAE")) for previous, current in zip([b[0] for b in plan.batches], [b[0] for b in plan.batches][1:]))
+        if model_changes or expected_model_changes:
+            print(f"X/Y/Z plot: checkpoint or VAE changed {model_changes} times; expected {expected_model_changes}")
+
+        if progress is not None and not (shared.state.interrupted or state.stopping_generation):
+            progress.remove()
+
         if not processed.images:
             # It broke, no further handling needed.
             return processed
@@ -802,10 +1024,22 @@ class Script(scripts.Script):
             for g in range(grid_count):
                 # TODO: See previous comment about intentional data misalignment.
                 adj_g = g - 1 if g > 0 else g
-                images.save_image(processed.images[g], p.outpath_grids, "xyz_grid", info=processed.infotexts[g], extension=opts.grid_format, prompt=processed.all_prompts[adj_g], seed=processed.all_seeds[adj_g], grid=True, p=processed)
+                fullfn, _ = images.save_image(processed.images[g], p.outpath_grids, "xyz_grid", info=processed.infotexts[g], extension=opts.grid_format, prompt=processed.all_prompts[adj_g], seed=processed.all_seeds[adj_g], grid=True, p=processed)
+
+                # grids built on disk are shown as previews; the full size grid is saved as tiles next to the preview
+                grid_canvas = getattr(processed.images[g], "grid_canvas", None)
+                if grid_canvas is not None:
+                    grid_canvas.save_tiles(f"{os.path.splitext(fullfn)[0]}-tiles", grid_tile_size, extension=opts.grid_format)
+
                 if not include_sub_grids:  # if not include_sub_grids then skip saving after the first grid
                     break
 
+        for image in processed.images[:z_count + 1]:
+            grid_canvas = getattr(image, "grid_canvas", None)
+            if grid_canvas is not None:
+                grid_canvas.close()
+                del image.grid_canvas
+
         if not include_sub_grids:
             # Done with sub-grids, drop all related information:
             for _ in range(z_count):
@@ -0,0 +1,95 @@
+import pytest
+import torch
+
+from modules import attention_autotune
+
+
+def reference_attention(q, k, v):
+    weights = (q @ k.transpose(1, 2) * q.shape[-1] ** -0.5).softmax(dim=-1)
+    return weights @ v
+
+
+@pytest.mark.parametrize("shape", [(8, 1100, 1100, 40), (4, 300, 77, 80)])
+def test_all_candidates_compute_attention(shape):
+    batch, q_tokens, k_tokens, channels = shape
+    q = torch.randn(batch, q_tokens, channels)
+    k = torch.randn(batch, k_tokens, channels)
+    v = torch.randn(batch, k_tokens, channels)
+
+    expected = reference_attention(q, k, v)
+
+    for candidate in attention_autotune.candidates_for(q, k, v):
+        assert torch.allclose(candidate.run(q, k, v), expected, atol=1e-4), candidate.name
+
+
+def test_results_are_saved_and_budget_is_respected(monkeypatch):
+    q = torch.randn(8, 1100, 40)
+    k = torch.randn(8, 1100, 40)
+    v = torch.randn(8, 1100, 40)
+
+    storage = {}
+    budget = 1024 ** 3
+    tuner = attention_autotune.AttentionAutotuner(lambda: budget, storage=storage, repeats=1)
+
+    assert torch.allclose(tuner(q, k, v), reference_attention(q, k, v), atol=1e-4)
+    assert len(storage) == 1
+
+    results = tuner.results[tuner.key(q, k, v)]
+    assert [x.seconds for x in results] == sorted(x.seconds for x in results)
+
+    budget = min(x.memory for x in results)
+    memory = {x.name: x.memory for x in results}
+    assert memory[tuner.select(q, k, v).name] <= budget
+
+    def fail(*args):
+        raise AssertionError("benchmarked again")
+
+    another = attention_autotune.AttentionAutotuner(lambda: 1024 ** 3, storage=storage)
+    monkeypatch.setattr(another, "benchmark", fail)
+    assert another.select(q, k, v).name == results[0].name
+
+
+def test_candidates_over_budget_are_timed_when_budget_grows():
+    q = torch.randn(8, 1100, 40)
+    k = torch.randn(8, 1100, 40)
+    v = torch.randn(8, 1100, 40)
+
+    storage = {}
+    budget = 0
+    tuner = attention_autotune.AttentionAutotuner(lambda: budget, storage=storage, repeats=1)
+
+    tuner.select(q, k, v)
+    saved = storage[tuner.key(q, k, v)]
+    assert {x[0] for x in saved} == {candidate.name for candidate in attention_autotune.candidates_for(q, k, v)}
+    assert all(x[1] == float("inf") for x in saved)
+
+    budget = 1024 ** 3
+    another = attention_autotune.AttentionAutotuner(lambda: budget, storage=storage, repeats=1)
+    selected = another.select(q, k, v)
+
+    results = {x.name: x for x in another.results[another.key(q, k, v)]}
+    assert results[selected.name].seconds != float("inf")
+    assert all(x.seconds != float("inf") for x in results.values() if x.memory <= budget)
+
+
+def test_only_out_of_memory_errors_are_recorded(monkeypatch):
+    q = torch.randn(8, 1100, 40)
+    tuner = attention_autotune.AttentionAutotuner(lambda: 1024 ** 3, storage={}, repeats=1)
+
+    def out_of_memory(candidate, q, k, v):
+        if candidate.name == "full":
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+
+        return 0.001, 0
+
+    monkeypatch.setattr(tuner, "time_candidate", out_of_memory)
+    results = {x.name: x for x in tuner.benchmark(q, q, q)}
+    assert results["full"].seconds == float("inf")
+    assert results["full"].memory > 1024 ** 3
+
+    def broken(candidate, q, k, v):
+        raise RuntimeError("shape mismatch")
+
+    monkeypatch.setattr(tuner, "time_candidate", broken)
+    with pytest.raises(RuntimeError, match="shape mismatch"):
+        tuner.benchmark(q, q, q)
@@ -0,0 +1,85 @@
+import safetensors.torch
+import torch
+
+from modules import checkpoint_merger
+
+
+def make_checkpoint(path, seed, inpainting=False):
+    generator = torch.Generator().manual_seed(seed)
+    state_dict = {
+        "model.diffusion_model.input_blocks.0.0.weight": torch.randn(8, 9 if inpainting else 4, 3, 3, generator=generator),
+        "model.diffusion_model.out.bias": torch.randn(4, generator=generator),
+        "model.half.weight": torch.randn(2, 3, generator=generator).half(),
+        "first_stage_model.decoder.conv_in.weight": torch.randn(2, 2, generator=generator),
+        "cond_stage_model.transformer.text_model.embeddings.position_ids": torch.arange(77).unsqueeze(0),
+        "alphas_cumprod": torch.rand(10, generator=generator),
+    }
+    safetensors.torch.save_file(state_dict, str(path))
+    return state_dict
+
+
+def run_merge(recipes, tmp_path, *inputs):
+    for i, recipe in enumerate(recipes):
+        plan = checkpoint_merger.plan(recipe, *inputs)
+        recipe.output = checkpoint_merger.SafetensorsOutput(str(tmp_path / f"out{i}.safetensors"), plan, metadata={"format": "pt", "recipe": {"i": i}})
+
+    checkpoint_merger.merge(recipes, *inputs)
+
+    return [safetensors.torch.load_file(str(tmp_path / f"out{i}.safetensors")) for i in range(len(recipes))]
+
+
+def test_streamed_merge_matches_merge_of_loaded_checkpoints(tmp_path):
+    a = make_checkpoint(tmp_path / "a.safetensors", 1)
+    b = make_checkpoint(tmp_path / "b.safetensors", 2)
+    c = make_checkpoint(tmp_path / "c.safetensors", 3)
+
+    inputs = [checkpoint_merger.SafetensorsInput(str(tmp_path / f"{name}.safetensors")) for name in "abc"]
+    recipes = [
+        checkpoint_merger.MergeRecipe("Weighted sum", 0.3),
+        checkpoint_merger.MergeRecipe("Add difference", 0.7, save_as_half=True, discard_weights="alphas"),
+        checkpoint_merger.MergeRecipe("No interpolation", 0, save_as_half=True),
+    ]
+
+    weighted, difference, converted = run_merge(recipes, tmp_path, *inputs)
+
+    key = "model.diffusion_model.out.bias"
+    assert torch.equal(weighted[key], 0.7 * a[key] + 0.3 * b[key])
+    assert torch.equal(difference[key], (a[key] + 0.7 * (b[key] - c[key])).half())
+    assert torch.equal(converted[key], a[key].half())
+
+    for merged in (weighted, difference):
+        assert torch.equal(merged["cond_stage_model.transformer.text_model.embeddings.position_ids"], a["cond_stage_model.transformer.text_model.embeddings.position_ids"])
+
+    assert torch.equal(weighted["alphas_cumprod"], a["alphas_cumprod"])
+    assert "alphas_cumprod" not in difference
+    assert weighted["model.half.weight"].dtype == torch.float16
+    assert safetensors.safe_open(str(tmp_path / "out1.safetensors"), framework="pt").metadata() == {"format": "pt", "recipe": '{"i": 1}'}
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_inpainting_model_is_merged_with_normal_model(tmp_path):
+    a = make_checkpoint(tmp_path / "a.safetensors", 1, inpainting=True)
+    b = make_checkpoint(tmp_path / "b.safetensors", 2)
+
+    recipe = checkpoint_merger.MergeRecipe("Weighted sum", 0.5)
+    inputs = [checkpoint_merger.SafetensorsInput(str(tmp_path / "a.safetensors")), checkpoint_merger.StateDictInput(b)]
+    merged, = run_merge([recipe], tmp_path, *inputs)
+
+    key = "model.diffusion_model.input_blocks.0.0.weight"
+    assert recipe.is_inpainting
+    assert merged[key].shape == a[key].shape
+    assert torch.equal(merged[key][:, 0:4], 0.5 * a[key][:, 0:4] + 0.5 * b[key])
+    assert torch.equal(merged[key][:, 4:], a[key][:, 4:])
+
+
+def test_keys_are_renamed_by_transform(tmp_path):
+    state_dict = {"cond_stage_model.transformer.encoder.weight": torch.ones(2)}
+    safetensors.torch.save_file(state_dict, str(tmp_path / "old.safetensors"))
+
+    def transform(sd):
+        return {k.replace("transformer.", "transformer.text_model."): v for k, v in sd.items()}
+
+    model = checkpoint_merger.SafetensorsInput(str(tmp_path / "old.safetensors"), transform=transform)
+
+    assert list(model.meta) == ["cond_stage_model.transformer.text_model.encoder.weight"]
+    assert torch.equal(model.get("cond_stage_model.transformer.text_model.encoder.weight"), torch.ones(2))
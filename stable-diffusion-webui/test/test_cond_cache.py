@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+
+class FakeModel:
+    sd_model_hash = "hash"
+
+    def __init__(self):
+        self.encoded = 0
+
+    def get_learned_conditioning(self, texts):
+        self.encoded += len(texts)
+        return torch.zeros(len(texts), 77, 8)
+
+
+@pytest.mark.parametrize("option, value", [("comma_padding_backtrack", 0), ("sdxl_clip_l_skip", True), ("sd3_enable_t5", True), ("CLIP_stop_at_last_layers", 2)])
+def test_changing_encoder_option_misses_cache(initialize, option, value):
+    from modules import cond_cache, shared
+
+    model = FakeModel()
+    original = getattr(shared.opts, option)
+    cond_cache.clear()
+
+    try:
+        cond_cache.get_learned_conditioning(model, ["a cat"])
+        cond_cache.get_learned_conditioning(model, ["a cat"])
+        assert model.encoded == 1
+
+        setattr(shared.opts, option, value)
+        cond_cache.get_learned_conditioning(model, ["a cat"])
+        assert model.encoded == 2
+    finally:
+        setattr(shared.opts, option, original)
+        cond_cache.clear()
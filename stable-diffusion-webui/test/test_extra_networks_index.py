@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+
+class SyntheticLoraPage:
+    """Imitates ExtraNetworksPageLora with files in a temporary directory."""
+
+    name = "lora"
+
+    def __init__(self, root, count):
+        from modules import util
+
+        self.root = root
+        self.lister = util.MassFileLister()
+        self.metadata = {}
+        self.items = {}
+        self.created = 0
+        self.files = {}
+
+        for i in range(count):
+            dirname = os.path.join(root, f"dir{i % 100}")
+            os.makedirs(dirname, exist_ok=True)
+            filename = os.path.join(dirname, f"lora{i}.safetensors")
+            open(filename, "wb").close()
+            self.files[f"lora{i}"] = filename
+
+    def list_item_names(self):
+        return list(self.files)
+
+    def item_filename(self, name):
+        return self.files.get(name)
+
+    def items_state_key(self):
+        return None
+
+    def read_user_metadata(self, item):
+        item["user_metadata"] = {}
+
+    def create_item(self, name, index=None):
+        self.created += 1
+        filename = self.files[name]
+        number = int(name[4:])
+
+        return {
+            "name": name,
+            "filename": filename,
+            "search_terms": [os.path.relpath(filename, os.path.dirname(self.root))],
+            "metadata": {"ss_tag_frequency": {"1_x": {f"tag{number % 7}": 3, "common": 1}}} if number % 2 == 0 else {},
+            "sort_keys": {"default": index, "name": name.lower(), "path": filename.lower()},
+        }
+
+
+@pytest.fixture
+def page(initialize, tmp_path):
+    return SyntheticLoraPage(str(tmp_path / "Lora"), 10000)
+
+
+def test_query_pagination_and_search(page):
+    from modules.ui_extra_networks_index import ItemsIndex
+
+    index = ItemsIndex(page)
+    index.update()
+
+    total, items = index.query(offset=20, limit=10)
+    assert total == 10000
+    assert [x["name"] for x in items] == [f"lora{i}" for i in range(20, 30)]
+    assert "metadata" not in items[0]
+
+    total, items = index.query(search="tag3 lora1", limit=10000)
+    assert total == len([i for i in range(10000) if i % 2 == 0 and i % 7 == 3 and str(i).startswith("1")])
+    assert all(x["tags"][0] == "tag3" for x in items)
+
+    total, _ = index.query(path="Lora/dir5/")
+    assert total == 100
+
+    _, items = index.query(sort="name", reverse=True, limit=1)
+    assert items[0]["name"] == "lora9999"
+
+    with pytest.raises(ValueError):
+        index.query(sort="size")
+
+
+def test_update_only_creates_changed_items(page):
+    from modules.ui_extra_networks_index import ItemsIndex
+
+    index = ItemsIndex(page)
+    index.update()
+    assert page.created == 10000
+
+    index.update()
+    assert page.created == 10000
+
+    open(os.path.join(page.root, "dir3", "lora3.json"), "w").close()
+    del page.files["lora7"]
+    index.update()
+    assert page.created == 10000 + 100  # every item in dir3, because the directory changed
+
+    total, _ = index.query()
+    assert total == 9999
+
+    index.update(full=True)
+    assert page.created == 10000 + 100 + 9999
@@ -0,0 +1,70 @@
+import threading
+import time
+
+from modules import fifo_lock
+
+
+def run_queued(lock, keys, before_release=None):
+    order = []
+    threads = []
+
+    def worker(key):
+        with lock.scheduled(key):
+            order.append(key)
+
+    lock.acquire(key="A")
+    for key in keys:
+        thread = threading.Thread(target=worker, args=(key,))
+        thread.start()
+        threads.append(thread)
+
+        while len(lock._pending_threads) < len(threads):
+            time.sleep(0.001)
+
+    if before_release is not None:
+        before_release()
+
+    lock.release()
+    for thread in threads:
+        thread.join()
+
+    return order
+
+
+def test_fifo_order_without_grouping():
+    lock = fifo_lock.FIFOLock()
+
+    assert run_queued(lock, ["B", "A", "B", "A"]) == ["B", "A", "B", "A"]
+    assert lock.stats()["swaps_saved"] == 0
+
+
+def test_grouping_reduces_swaps():
+    lock = fifo_lock.FIFOLock()
+    lock.max_delay = 60
+
+    assert run_queued(lock, ["B", "A", "B", "A"]) == ["A", "A", "B", "B"]
+
+    stats = lock.stats()
+    assert stats["swaps"] == 1
+    assert stats["swaps_saved"] == 2
+
+
+def test_grouping_respects_max_delay():
+    lock = fifo_lock.FIFOLock()
+    lock.max_delay = 0
+
+    assert run_queued(lock, ["B", "A"]) == ["B", "A"]
+
+
+def test_max_delay_is_counted_from_head_of_queue(monkeypatch):
+    clock = [0]
+    monkeypatch.setattr(fifo_lock.time, "monotonic", lambda: clock[0])
+
+    lock = fifo_lock.FIFOLock()
+    lock.max_delay = 10
+
+    def later():
+        clock[0] = 100
+
+    # C has been waiting for 100 seconds, but only gets to the head of the queue after the first B runs
+    assert run_queued(lock, ["B", "C", "B"], before_release=later) == ["B", "B", "C"]
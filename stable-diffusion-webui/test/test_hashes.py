@@ -0,0 +1,173 @@
+import hashlib
+import os
+import threading
+import types
+
+import pytest
+
+
+@pytest.fixture
+def env(initialize, monkeypatch, tmp_path):
+    from modules import hashes, shared
+
+    storage = {}
+    monkeypatch.setattr(hashes, "cache", lambda subsection: storage.setdefault(subsection, {}))
+    monkeypatch.setattr(hashes, "dump_cache", lambda: None)
+    monkeypatch.setattr(hashes, "hashing", hashes.HashingService())
+    monkeypatch.setitem(shared.opts.data, "hashing_workers", 1)
+    monkeypatch.setitem(shared.opts.data, "hashing_in_background", True)
+    monkeypatch.setattr(shared.cmd_opts, "no_hashing", False)
+
+    res = types.SimpleNamespace(hashes=hashes, storage=storage, calls=[], blocked=set(), unblock=threading.Event())
+
+    calculate_sha256 = hashes.calculate_sha256
+
+    def counting_calculate_sha256(filename, progress=None):
+        res.calls.append(os.path.basename(filename))
+        if os.path.basename(filename) in res.blocked:
+            assert res.unblock.wait(10)
+
+        return calculate_sha256(filename, progress)
+
+    monkeypatch.setattr(hashes, "calculate_sha256", counting_calculate_sha256)
+
+    def make_file(name, data):
+        path = tmp_path / name
+        path.write_bytes(data)
+        return str(path)
+
+    res.make_file = make_file
+
+    yield res
+
+    res.unblock.set()
+    if hashes.hashing.executor is not None:
+        hashes.hashing.executor.shutdown(wait=True)
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_requests_for_same_file_share_a_job(env):
+    filename = env.make_file("a.ckpt", b"a" * 1000)
+    env.blocked.add("a.ckpt")
+
+    first = env.hashes.hashing.submit(filename, "checkpoint/a")
+    second = env.hashes.hashing.submit(filename, "checkpoint/a")
+    assert first is second
+
+    env.unblock.set()
+    assert first.result(10) == digest(b"a" * 1000)
+    assert env.calls == ["a.ckpt"]
+
+
+def test_waiting_request_takes_over_queued_job(env):
+    other = env.make_file("other.ckpt", b"other")
+    filename = env.make_file("a.ckpt", b"a" * 1000)
+
+    # the only worker is busy with another file, so the job for a.ckpt stays queued
+    env.blocked.add("other.ckpt")
+    env.hashes.hashing.submit(other, "checkpoint/other")
+    queued = env.hashes.hashing.submit(filename, "checkpoint/a")
+
+    assert env.hashes.hashing.calculate(filename, "checkpoint/a") == digest(b"a" * 1000)
+    assert queued.done()
+
+    env.unblock.set()
+    env.hashes.hashing.executor.shutdown(wait=True)
+
+    # the worker skipped the job that was taken over instead of reading the file again
+    assert env.calls.count("a.ckpt") == 1
+
+
+def test_cached_hash_is_invalidated_when_file_changes(env):
+    filename = env.make_file("a.ckpt", b"first")
+
+    assert env.hashes.sha256(filename, "checkpoint/a") == digest(b"first")
+    assert env.hashes.sha256_from_cache(filename, "checkpoint/a") == digest(b"first")
+    assert env.hashes.sha256(filename, "checkpoint/a") == digest(b"first")
+    assert env.calls == ["a.ckpt"]
+
+    with open(filename, "wb") as file:
+        file.write(b"second version")
+
+    assert env.hashes.sha256_from_cache(filename, "checkpoint/a") is None
+    assert env.hashes.sha256(filename, "checkpoint/a") == digest(b"second version")
+
+
+def test_entries_without_identity_are_upgraded(env):
+    filename = env.make_file("a.ckpt", b"data")
+    env.storage["hashes"] = {"checkpoint/a": {"mtime": os.path.getmtime(filename) + 1, "sha256": "cached"}}
+
+    assert env.hashes.sha256_from_cache(filename, "checkpoint/a") == "cached"
+    assert env.storage["hashes"]["checkpoint/a"]["identity"] == env.hashes.file_identity(filename)
+
+
+def test_prehash_calls_callback(env):
+    filename = env.make_file("a.ckpt", b"data")
+
+    results = []
+    called = threading.Event()
+
+    def callback(sha256):
+        results.append(sha256)
+        called.set()
+
+    env.hashes.prehash([(filename, "checkpoint/a", False, callback)])
+    assert called.wait(10)
+    assert results == [digest(b"data")]
+
+    # files with hashes in cache are not submitted again
+    env.hashes.prehash([(filename, "checkpoint/a", False, callback)])
+    env.hashes.hashing.executor.shutdown(wait=True)
+    assert env.calls == ["a.ckpt"]
+    assert results == [digest(b"data")]
+
+
+def test_checkpoint_hash_ready_before_sha256_returns(env, monkeypatch):
+    from modules import cache, sd_models
+
+    monkeypatch.setattr(cache, "cached_data_for_file", lambda subsection, title, filename, func: func())
+    filename = env.make_file("a.ckpt", b"data")
+    info = sd_models.CheckpointInfo(filename)
+    assert info.sha256 is None
+
+    def sha256(filename, title, use_addnet_hash=False, wait=True, callback=None):
+        # the worker finishes and runs the callback before sha256() returns to the caller
+        if not wait:
+            callback(digest(b"data"))
+            return None
+
+        return digest(b"data")
+
+    monkeypatch.setattr(sd_models.hashes, "sha256", sha256)
+
+    shorthashes = []
+    assert info.calculate_shorthash(wait=False, callback=shorthashes.append) == digest(b"data")[0:10]
+    assert shorthashes == [digest(b"data")[0:10]]
+    assert info.sha256 == digest(b"data")
+    assert info.shorthash in info.ids
+
+
+def test_checkpoint_hash_in_background(env, monkeypatch):
+    from modules import cache, sd_models
+
+    monkeypatch.setattr(cache, "cached_data_for_file", lambda subsection, title, filename, func: func())
+    filename = env.make_file("a.ckpt", b"data")
+    info = sd_models.CheckpointInfo(filename)
+
+    env.blocked.add("a.ckpt")
+    called = threading.Event()
+    shorthashes = []
+
+    def callback(shorthash):
+        shorthashes.append(shorthash)
+        called.set()
+
+    assert info.calculate_shorthash(wait=False, callback=callback) is None
+
+    env.unblock.set()
+    assert called.wait(10)
+    assert shorthashes == [digest(b"data")[0:10]]
+    assert info.sha256 == digest(b"data")
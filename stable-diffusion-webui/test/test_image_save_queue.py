@@ -0,0 +1,52 @@
+import threading
+import time
+
+from modules import image_save_queue
+
+
+def test_callbacks_are_called_in_order_of_saving():
+    queue = image_save_queue.ImageSaveQueue()
+    written = []
+    done = []
+
+    for i in range(12):
+        def write(i=i):
+            time.sleep(0.01 * (i % 3 == 0))
+            written.append(i)
+
+        queue.submit(3, f"{i}.png", write, lambda i=i: done.append(i))
+
+    queue.flush()
+    queue.stop()
+
+    assert sorted(written) == list(range(12))
+    assert done == list(range(12))
+
+
+def test_filenames_are_pending_until_written():
+    queue = image_save_queue.ImageSaveQueue()
+    release = threading.Event()
+
+    queue.submit(1, "a.png", release.wait, lambda: None)
+    assert queue.is_pending("a.png")
+    assert not queue.is_pending("b.png")
+
+    release.set()
+    queue.flush()
+    assert not queue.is_pending("a.png")
+    queue.stop()
+
+
+def test_failed_write_does_not_stop_queue(monkeypatch):
+    monkeypatch.setattr(image_save_queue.errors, "display", lambda e, task: None)
+    queue = image_save_queue.ImageSaveQueue()
+    done = []
+
+    def fail():
+        raise OSError("disk full")
+
+    queue.submit(2, "a.png", fail, lambda: done.append("a"))
+    queue.submit(2, "b.png", lambda: None, lambda: done.append("b"))
+    queue.stop()
+
+    assert done == ["b"]
@@ -0,0 +1,202 @@
+import os
+import types
+
+import numpy as np
+import pytest
+from PIL import Image
+
+
+def combine_grid_reference(grid):
+    """Tiles pasted one by one into rows and rows into the image, with PIL alpha masks."""
+
+    def make_mask_image(r):
+        return Image.fromarray((r * 255 / grid.overlap).astype(np.uint8), 'L')
+
+    mask_w = make_mask_image(np.arange(grid.overlap, dtype=np.float32).reshape((1, grid.overlap)).repeat(grid.tile_h, axis=0))
+    mask_h = make_mask_image(np.arange(grid.overlap, dtype=np.float32).reshape((grid.overlap, 1)).repeat(grid.image_w, axis=1))
+
+    combined_image = Image.new("RGB", (grid.image_w, grid.image_h))
+    for y, h, row in grid.tiles:
+        combined_row = Image.new("RGB", (grid.image_w, h))
+        for x, w, tile in row:
+            if x == 0:
+                combined_row.paste(tile, (0, 0))
+                continue
+
+            combined_row.paste(tile.crop((0, 0, grid.overlap, h)), (x, 0), mask=mask_w)
+            combined_row.paste(tile.crop((grid.overlap, 0, w, h)), (x + grid.overlap, 0))
+
+        if y == 0:
+            combined_image.paste(combined_row, (0, 0))
+            continue
+
+        combined_image.paste(combined_row.crop((0, 0, combined_row.width, grid.overlap)), (0, y), mask=mask_h)
+        combined_image.paste(combined_row.crop((0, grid.overlap, combined_row.width, h)), (0, y + grid.overlap))
+
+    return combined_image
+
+
+def random_image(width, height, seed=0):
+    return Image.fromarray(np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+@pytest.mark.usefixtures("initialize")
+@pytest.mark.parametrize("size,tile,overlap", [((300, 200), 64, 16), ((513, 129), 128, 64), ((97, 97), 96, 8), ((200, 100), 64, 40)])
+def test_combine_grid_matches_reference(size, tile, overlap):
+    from modules import images
+
+    grid = images.split_grid(random_image(*size), tile, tile, overlap)
+    for y, _, row in grid.tiles:
+        for item in row:
+            item[2] = random_image(tile, tile, seed=y * 1000 + item[0])
+
+    assert np.array_equal(np.asarray(images.combine_grid(grid)), np.asarray(combine_grid_reference(grid)))
+
+
+@pytest.mark.usefixtures("initialize")
+def test_split_and_combine_grid_is_lossless():
+    from modules import images
+
+    image = random_image(333, 222)
+
+    grid = images.split_grid(image, 96, 64, 24)
+
+    assert np.array_equal(np.asarray(images.combine_grid(grid)), np.asarray(image))
+
+
+@pytest.mark.usefixtures("initialize")
+def test_grid_canvas_matches_annotated_grid(monkeypatch):
+    from modules import images
+
+    monkeypatch.setattr(images, "opts", types.SimpleNamespace(font="", grid_text_active_color="#000000", grid_text_inactive_color="#999999", grid_background_color="#ffffff"))
+
+    def texts():
+        return [[images.GridAnnotation(f"column {i}", is_active=i != 1)] for i in range(3)], [[images.GridAnnotation(f"row {i}")] for i in range(2)]
+
+    cells = [random_image(96, 64, seed=i) for i in range(6)]
+    grid = Image.new("RGB", (96 * 3, 64 * 2))
+    for i, cell in enumerate(cells):
+        grid.paste(cell, (i % 3 * 96, i // 3 * 64))
+
+    hor_texts, ver_texts = texts()
+    expected = images.draw_grid_annotations(grid, 96, 64, hor_texts, ver_texts, margin=5)
+
+    hor_texts, ver_texts = texts()
+    layout = images.GridAnnotationLayout(96, 64, hor_texts, ver_texts, margin=5)
+    canvas = images.GridCanvas(*layout.size, "#ffffff", directory=None)
+    for i, cell in enumerate(cells):
+        canvas.paste(cell, layout.cell_position(i % 3, i // 3))
+    layout.draw_on_canvas(canvas)
+
+    assert np.array_equal(np.asarray(canvas.to_image()), np.asarray(expected))
+    canvas.close()
+
+
+@pytest.mark.usefixtures("initialize")
+def test_grid_canvas_tiles_and_preview(tmp_path):
+    from modules import images
+
+    image = random_image(300, 200)
+    canvas = images.GridCanvas(300, 200, (0, 0, 0))
+    canvas.paste(image, (0, 0))
+
+    filenames = canvas.save_tiles(tmp_path, 128)
+    assert len(filenames) == 6
+
+    restored = Image.new("RGB", (300, 200))
+    for filename in filenames:
+        row, col = map(int, os.path.splitext(os.path.basename(filename))[0].split("-"))
+        restored.paste(Image.open(filename), (col * 128, row * 128))
+    assert np.array_equal(np.asarray(restored), np.asarray(image))
+
+    preview = canvas.preview(100)
+    assert preview.size == (100, 67)
+    assert np.array_equal(np.asarray(preview), np.asarray(image.reduce(3)))
+    canvas.close()
+
+
+def split_grid_numpy(image, grid):
+    """Tiles at the same positions as in grid, cut from one array made from image with NumPy slicing."""
+
+    array = np.asarray(image)
+    return [[Image.fromarray(array[y:y + h, x:x + w]) for x, w, _ in row] for y, h, row in grid.tiles]
+
+
+def combine_grid_numpy(grid):
+    """The same blending as combine_grid_reference, done on a preallocated float32 array, a whole strip at a time."""
+
+    ramp = (np.arange(grid.overlap, dtype=np.float32) * 255 / grid.overlap).astype(np.uint8).astype(np.float32) / 255
+    ramp_w = ramp.reshape((1, grid.overlap, 1))
+    ramp_h = ramp.reshape((grid.overlap, 1, 1))
+
+    result = np.zeros((grid.image_h, grid.image_w, 3), dtype=np.float32)
+    for y, h, row in grid.tiles:
+        combined_row = np.zeros((h, grid.image_w, 3), dtype=np.float32)
+        for x, w, tile in row:
+            array = np.asarray(tile, dtype=np.float32)
+            if x == 0:
+                combined_row[:, :w] = array
+                continue
+
+            strip = combined_row[:, x:x + grid.overlap]
+            strip += (array[:, :grid.overlap] - strip) * ramp_w
+            combined_row[:, x + grid.overlap:x + w] = array[:, grid.overlap:]
+
+        if y == 0:
+            result[:h] = combined_row
+            continue
+
+        strip = result[y:y + grid.overlap]
+        strip += (combined_row[:grid.overlap] - strip) * ramp_h
+        result[y + grid.overlap:y + h] = combined_row[grid.overlap:]
+
+    return Image.fromarray(result.round().astype(np.uint8))
+
+
+@pytest.mark.usefixtures("initialize")
+def test_numpy_versions_used_in_benchmark_match():
+    from modules import images
+
+    image = random_image(300, 200)
+    grid = images.split_grid(image, 64, 64, 16)
+
+    assert all(np.array_equal(np.asarray(a), np.asarray(b[2])) for numpy_row, (_, _, row) in zip(split_grid_numpy(image, grid), grid.tiles) for a, b in zip(numpy_row, row))
+    assert np.array_equal(np.asarray(combine_grid_numpy(grid)), np.asarray(images.combine_grid(grid)))
+
+
+def benchmark(size=4096, repeats=5):
+    """Times split_grid and combine_grid against NumPy versions that work on one preallocated array, for a few tile
+    sizes, and prints the largest difference between results of combine_grid and its NumPy version.
+
+    Run with `python -m test.test_images_grid` from the webui directory."""
+
+    import time
+
+    from modules import images
+
+    def best_of(fn, *args):
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            res = fn(*args)
+            best = min(best, time.perf_counter() - start)
+
+        return best, res
+
+    image = random_image(size, size + 37)
+    for tile, overlap in ((128, 16), (256, 32), (512, 64)):
+        split_seconds, grid = best_of(images.split_grid, image, tile, tile, overlap)
+        split_numpy_seconds, _ = best_of(split_grid_numpy, image, grid)
+        combine_seconds, combined = best_of(images.combine_grid, grid)
+        combine_numpy_seconds, combined_numpy = best_of(combine_grid_numpy, grid)
+
+        difference = np.abs(np.asarray(combined, dtype=np.int16) - np.asarray(combined_numpy, dtype=np.int16)).max()
+        print(f"{image.width}x{image.height}, tile {tile}, overlap {overlap} ({grid.tile_count} tiles):")
+        print(f"  split:   PIL {split_seconds * 1000:7.1f} ms, NumPy {split_numpy_seconds * 1000:7.1f} ms")
+        print(f"  combine: PIL {combine_seconds * 1000:7.1f} ms, NumPy {combine_numpy_seconds * 1000:7.1f} ms, max difference {difference}")
+
+
+if __name__ == "__main__":
+    import webui  # noqa: F401
+
+    benchmark()
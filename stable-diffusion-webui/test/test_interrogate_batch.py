@@ -0,0 +1,64 @@
+import types
+
+import pytest
+from PIL import Image
+
+
+class FakeInterrogator:
+    batches = []
+    started = 0
+    stopped = 0
+
+    def start(self):
+        FakeInterrogator.started += 1
+
+    def preprocess(self, image):
+        return image.width
+
+    def run(self, items):
+        FakeInterrogator.batches.append(len(items))
+        return [f"width {x}" for x in items]
+
+    def stop(self):
+        FakeInterrogator.stopped += 1
+
+
+@pytest.fixture(autouse=True)
+def fake_interrogator(initialize, monkeypatch):
+    from modules import interrogate_batch
+
+    monkeypatch.setitem(interrogate_batch.interrogators, "fake", FakeInterrogator)
+    monkeypatch.setattr(interrogate_batch.shared, "state", types.SimpleNamespace(interrupted=False, nextjob=lambda: None), raising=False)
+    FakeInterrogator.batches = []
+    FakeInterrogator.started = FakeInterrogator.stopped = 0
+
+
+def broken_image():
+    raise ValueError("not an image")
+
+
+def test_results_are_in_order_with_errors_in_place():
+    from modules import interrogate_batch
+
+    sources = [(str(i), lambda i=i: Image.new("RGB", (i + 1, 1))) for i in range(7)]
+    sources.insert(3, ("broken", broken_image))
+
+    results = list(interrogate_batch.interrogate_images(sources, "fake", batch_size=3))
+
+    assert [name for name, _, _ in results] == ["0", "1", "2", "broken", "3", "4", "5", "6"]
+    assert results[0] == ("0", "width 1", None)
+    assert results[3] == ("broken", None, "not an image")
+    assert results[-1] == ("6", "width 7", None)
+    assert FakeInterrogator.batches == [3, 2, 2]
+    assert FakeInterrogator.started == FakeInterrogator.stopped == 1
+
+
+def test_models_are_unloaded_when_consumer_stops_early():
+    from modules import interrogate_batch
+
+    sources = [(str(i), lambda: Image.new("RGB", (1, 1))) for i in range(10)]
+
+    for _ in interrogate_batch.interrogate_images(sources, "fake", batch_size=2):
+        break
+
+    assert FakeInterrogator.stopped == 1
@@ -0,0 +1,64 @@
+import pytest
+import torch
+
+
+class FakeTextEncoder:
+    def __init__(self):
+        self.encoded = 0
+
+    def __call__(self, texts):
+        self.encoded += len(texts)
+        return torch.stack([torch.sin(torch.arange(16) * (1 + sum(map(ord, text)) % 97)) for text in texts])
+
+
+@pytest.mark.usefixtures("initialize")
+def test_features_are_persisted_and_rebuilt_when_items_change(tmp_path):
+    from modules import interrogate_index
+
+    encode = FakeTextEncoder()
+    items = [f"item {i}" for i in range(300)]
+
+    features = interrogate_index.TextFeatureIndex("model", tmp_path).get(items, encode, "cpu", torch.float32)
+    assert features.shape == (300, 16)
+    assert torch.allclose(features.norm(dim=-1), torch.ones(300))
+    assert encode.encoded == 300
+
+    again = interrogate_index.TextFeatureIndex("model", tmp_path).get(items, encode, "cpu", torch.float32)
+    assert encode.encoded == 300
+    assert torch.equal(features, again)
+
+    interrogate_index.TextFeatureIndex("model", tmp_path).get(items + ["new item"], encode, "cpu", torch.float32)
+    assert encode.encoded == 601
+
+
+@pytest.mark.usefixtures("initialize")
+def test_rank_matches_loop_over_image_features():
+    from modules import interrogate_index
+
+    text_features = torch.nn.functional.normalize(torch.randn(50, 16), dim=-1)
+    image_features = torch.nn.functional.normalize(torch.randn(3, 16), dim=-1)
+
+    similarity = torch.zeros((1, 50))
+    for i in range(image_features.shape[0]):
+        similarity += (100.0 * image_features[i].unsqueeze(0) @ text_features.T).softmax(dim=-1)
+    expected_probs, expected_labels = (similarity / image_features.shape[0]).topk(5, dim=-1)
+
+    labels, probs = interrogate_index.rank(image_features, text_features, 5)
+
+    assert labels == expected_labels[0].tolist()
+    assert torch.allclose(torch.tensor(probs), expected_probs[0] * 100, atol=1e-4)
+
+
+@pytest.mark.usefixtures("initialize")
+def test_rank_batch_ranks_every_image_separately():
+    from modules import interrogate_index
+
+    text_features = torch.nn.functional.normalize(torch.randn(50, 16), dim=-1)
+    image_features = torch.nn.functional.normalize(torch.randn(4, 16), dim=-1)
+
+    results = interrogate_index.rank_batch(image_features, text_features, 3)
+
+    for i, (labels, probs) in enumerate(results):
+        expected_labels, expected_probs = interrogate_index.rank(image_features[i:i + 1], text_features, 3)
+        assert labels == expected_labels
+        assert torch.allclose(torch.tensor(probs), torch.tensor(expected_probs), atol=1e-4)
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+import torch
+
+
+@pytest.mark.usefixtures("initialize")
+def test_saved_tensors_are_loaded_from_disk(tmp_path):
+    from modules.textual_inversion import latent_cache
+
+    cache = latent_cache.TrainingCache(str(tmp_path))
+    parameters = torch.randn(1, 8, 8, 8)
+
+    assert cache.load("dist", "ab12") is None
+
+    cache.save("dist", "ab12", parameters)
+    assert torch.equal(cache.load("dist", "ab12"), parameters)
+    assert cache.load("cond", "ab12") is None
+
+    cache.save("cond", "cd34", torch.randn(77, 768).to(torch.bfloat16))
+    assert cache.load("cond", "cd34").shape == (77, 768)
+
+
+@pytest.mark.usefixtures("initialize")
+def test_image_key_depends_on_content_size_and_model(tmp_path):
+    from modules.textual_inversion import latent_cache
+
+    first = tmp_path / "first.png"
+    second = tmp_path / "second.png"
+    first.write_bytes(b"image")
+    second.write_bytes(b"another image")
+
+    key = latent_cache.image_key(str(first), (512, 512), "model")
+
+    assert key == latent_cache.image_key(str(first), (512, 512), "model")
+    assert key != latent_cache.image_key(str(second), (512, 512), "model")
+    assert key != latent_cache.image_key(str(first), (512, 768), "model")
+    assert key != latent_cache.image_key(str(first), (512, 512), "another model")
+
+
+@pytest.mark.usefixtures("initialize")
+def test_bucket_reads_batches_like_stacking(tmp_path):
+    from modules.textual_inversion import latent_cache
+
+    samples = [torch.randn(4, 8, 8) for _ in range(5)]
+    weights = [torch.rand(4, 8, 8) for _ in range(5)]
+    bucket = latent_cache.LatentBucket(samples, weights, str(tmp_path))
+
+    rows = [3, 0, 3]
+    batch, batch_weights = bucket.get(rows)
+
+    assert torch.equal(batch, torch.stack([samples[i] for i in rows]))
+    assert torch.equal(batch_weights, torch.stack([weights[i] for i in rows]))
+
+    sample, weight = bucket.row(2)
+    assert torch.equal(sample, samples[2])
+    assert torch.equal(weight, weights[2])
+
+    assert latent_cache.LatentBucket(samples).get([1])[1] is None
+
+
+@pytest.mark.usefixtures("initialize")
+def test_prune_removes_least_recently_used_files(tmp_path):
+    from modules.textual_inversion import latent_cache
+
+    cache = latent_cache.TrainingCache(str(tmp_path))
+    for i, key in enumerate(["aa01", "bb02", "cc03"]):
+        cache.save("dist", key, torch.zeros(1024))
+        os.utime(cache.path("dist", key), (1000 + i, 1000 + i))
+
+    assert cache.load("dist", "aa01") is not None  # loading makes it the most recently used
+
+    size = os.path.getsize(cache.path("dist", "aa01"))
+    cache.prune(size * 2)
+
+    assert os.path.exists(cache.path("dist", "aa01"))
+    assert not os.path.exists(cache.path("dist", "bb02"))
+    assert os.path.exists(cache.path("dist", "cc03"))
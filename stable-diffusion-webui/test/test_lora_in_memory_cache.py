@@ -0,0 +1,42 @@
+import os
+import types
+
+import pytest
+
+lora_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "extensions-builtin", "Lora")
+
+
+@pytest.fixture
+def networks(initialize, monkeypatch):
+    monkeypatch.syspath_prepend(lora_path)
+
+    import networks
+
+    monkeypatch.setattr(networks, "networks_in_memory", {})
+
+    return networks
+
+
+def cache_networks(networks, sizes):
+    for i, size in enumerate(sizes):
+        networks.networks_in_memory[f"net{i}"] = types.SimpleNamespace(size=size)
+
+
+@pytest.mark.parametrize("count_limit, size_limit_mb, kept", [
+    (0, 0, []),
+    (2, 0, ["net2", "net3"]),
+    (0, 3, ["net1", "net2", "net3"]),
+    (0, 1, ["net3"]),
+    (2, 3, ["net2", "net3"]),
+])
+def test_purge_networks_from_memory(networks, monkeypatch, count_limit, size_limit_mb, kept):
+    from modules import shared
+
+    monkeypatch.setitem(shared.opts.data, "lora_in_memory_limit", count_limit)
+    monkeypatch.setitem(shared.opts.data, "lora_in_memory_limit_mb", size_limit_mb)
+
+    cache_networks(networks, [1024 * 1024] * 4)
+    networks.purge_networks_from_memory()
+
+    # least recently used networks are at the start and are removed first
+    assert list(networks.networks_in_memory) == kept
@@ -0,0 +1,145 @@
+import os
+import time
+import types
+
+import pytest
+import torch
+
+lora_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "extensions-builtin", "Lora")
+
+
+class FakeModule:
+    """A network module that adds a fixed delta times the network's multiplier, like regular Lora."""
+
+    updown_depends_on_weight = False
+    dora_scale = None
+
+    def __init__(self, net, delta):
+        self.network = net
+        self.delta = delta
+
+    def calc_updown(self, weight):
+        return self.delta.to(weight.device) * self.network.te_multiplier, None
+
+
+def make_network(name, layer_names, shape, seed):
+    generator = torch.Generator().manual_seed(seed)
+    net = types.SimpleNamespace(name=name, mtime=0, te_multiplier=1.0, unet_multiplier=1.0, dyn_dim=None, modules={})
+    for layer_name in layer_names:
+        net.modules[layer_name] = FakeModule(net, torch.randn(shape, generator=generator) * 0.01)
+
+    return net
+
+
+def make_layers(count, features, seed=0):
+    torch.manual_seed(seed)
+
+    layers = []
+    for i in range(count):
+        layer = torch.nn.Linear(features, features).requires_grad_(False)
+        layer.network_layer_name = f"layer_{i}"
+        layers.append(layer)
+
+    return layers
+
+
+def apply(networks, layers, loaded):
+    networks.loaded_networks[:] = loaded
+    for layer in layers:
+        networks.network_apply_weights(layer)
+
+
+@pytest.fixture
+def networks(initialize, monkeypatch):
+    monkeypatch.syspath_prepend(lora_path)
+
+    import networks
+    from modules import shared
+
+    monkeypatch.setattr(networks, "loaded_networks", [])
+    monkeypatch.setattr(networks, "network_deltas", networks.NetworkDeltaCache())
+    monkeypatch.setitem(shared.opts.data, "lora_incremental_check", False)
+    monkeypatch.setitem(shared.opts.data, "lora_delta_cache_mb", 0)
+
+    return networks
+
+
+def test_incremental_matches_full_apply(networks, monkeypatch):
+    from modules import shared
+
+    incremental = make_layers(2, 16)
+    full = make_layers(2, 16)
+    original = [layer.weight.detach().clone() for layer in incremental]
+
+    a = make_network("a", ["layer_0", "layer_1"], (16, 16), 1)
+    b = make_network("b", ["layer_0"], (16, 16), 2)
+
+    updates = []
+    steps = [([a], 1.0), ([a, b], 1.0), ([a, b], 0.5), ([b], 0.5), ([a, b], 1.0), ([], 1.0)]
+    for loaded, multiplier in steps:
+        a.te_multiplier = multiplier
+
+        monkeypatch.setitem(shared.opts.data, "lora_incremental_apply", True)
+        apply(networks, incremental, loaded)
+        updates.append(incremental[0].network_incremental_updates)
+
+        monkeypatch.setitem(shared.opts.data, "lora_incremental_apply", False)
+        apply(networks, full, loaded)
+
+        for x, y in zip(incremental, full):
+            assert torch.allclose(x.weight, y.weight, atol=1e-6)
+
+    # adding, reweighting and removing went through the incremental path
+    assert updates == [1, 2, 3, 4, 5, 0]
+
+    # removing every network restores weights from backup instead of leaving rounding errors in them
+    for layer, weight in zip(incremental, original):
+        assert torch.equal(layer.weight, weight)
+
+
+def benchmark(layer_count=48, features=1280, rank=32, network_count=5, changes=5):
+    """Times changing the multiplier of one of several networks, with full and with incremental application.
+
+    Run with `python -m test.test_lora_incremental` from the webui directory."""
+
+    import networks
+    from modules import shared
+
+    def lora_delta(generator):
+        return (torch.randn(features, rank, generator=generator) @ torch.randn(rank, features, generator=generator)) * 0.001
+
+    generator = torch.Generator().manual_seed(0)
+    layer_names = [f"layer_{i}" for i in range(layer_count)]
+    nets = []
+    for i in range(network_count):
+        net = types.SimpleNamespace(name=f"net{i}", mtime=0, te_multiplier=1.0, unet_multiplier=1.0, dyn_dim=None, modules={})
+        net.modules = {name: FakeModule(net, lora_delta(generator)) for name in layer_names}
+        nets.append(net)
+
+    for incremental, cache_mb in ((False, 0), (True, 0), (True, 4096)):
+        shared.opts.data["lora_incremental_apply"] = incremental
+        shared.opts.data["lora_delta_cache_mb"] = cache_mb
+        shared.opts.data["lora_incremental_check"] = False
+        networks.network_deltas.clear()
+
+        layers = make_layers(layer_count, features)
+        apply(networks, layers, nets)
+
+        start = time.perf_counter()
+        for i in range(changes):
+            nets[0].te_multiplier = 0.5 if i % 2 == 0 else 1.0
+            apply(networks, layers, nets)
+        elapsed = (time.perf_counter() - start) / changes
+
+        print(f"incremental={incremental} cache={cache_mb} MB: {elapsed * 1000:.0f} ms per change")
+
+    networks.loaded_networks.clear()
+
+
+if __name__ == "__main__":
+    import sys
+
+    import webui  # noqa: F401
+
+    sys.path.insert(0, lora_path)
+    benchmark()
@@ -0,0 +1,84 @@
+import os
+import types
+
+import pytest
+
+
+@pytest.fixture
+def index_env(initialize, monkeypatch, tmp_path):
+    from modules import model_index
+
+    storage = {}
+    monkeypatch.setattr(model_index.cache, "cache", lambda subsection: storage.setdefault(subsection, {}))
+    monkeypatch.setattr(model_index.shared, "opts", types.SimpleNamespace(list_hidden_files=True), raising=False)
+    monkeypatch.setattr(model_index, "indexes", {})
+
+    root = tmp_path / "models"
+    (root / "sub").mkdir(parents=True)
+    for path in ["a10.safetensors", "a2.safetensors", "notes.txt", "sub/b.ckpt"]:
+        (root / path).write_bytes(b"x")
+
+    return storage, root
+
+
+def test_walk_files_matches_util_order(index_env):
+    from modules import model_index
+
+    _, root = index_env
+
+    files = list(model_index.walk_files(str(root), allowed_extensions=[".safetensors", ".ckpt"]))
+
+    assert [os.path.relpath(x, root) for x in files] == ["a2.safetensors", "a10.safetensors", os.path.join("sub", "b.ckpt")]
+
+
+def test_refresh_detects_added_and_removed_files(index_env):
+    from modules import model_index
+
+    storage, root = index_env
+
+    index = model_index.get_index(str(root))
+    assert index.refresh()
+    assert not index.refresh()
+    assert str(root) in storage["model-index"]
+
+    (root / "sub" / "c.ckpt").write_bytes(b"yy")
+    os.remove(root / "a2.safetensors")
+
+    assert index.refresh()
+    names = {filename for _, filename in index.files()}
+    assert "c.ckpt" in names
+    assert "a2.safetensors" not in names
+    assert model_index.file_stat(str(root / "sub" / "c.ckpt"))[0] == 2
+
+
+def test_index_is_loaded_from_cache(index_env):
+    from modules import model_index
+
+    _, root = index_env
+
+    model_index.get_index(str(root)).refresh()
+    model_index.indexes.clear()
+
+    assert not model_index.get_index(str(root)).refresh()
+
+
+def test_invalidate_picks_up_files_changed_in_place(index_env):
+    from modules import model_index
+
+    _, root = index_env
+
+    index = model_index.get_index(str(root))
+    index.refresh()
+
+    # rewrite a file keeping the directory's mtime, like an in-place overwrite that does not touch the directory
+    directory_stat = os.stat(root)
+    (root / "a2.safetensors").write_bytes(b"xyz")
+    os.utime(root, ns=(directory_stat.st_atime_ns, directory_stat.st_mtime_ns))
+
+    assert not index.refresh()
+    assert index.stat(str(root), "a2.safetensors")[0] == 1
+
+    model_index.invalidate([str(root)])
+
+    assert index.refresh()
+    assert index.stat(str(root), "a2.safetensors")[0] == 3
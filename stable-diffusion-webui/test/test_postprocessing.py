@@ -0,0 +1,46 @@
+import time
+
+from PIL import Image
+
+
+def test_pipelined_postprocessing_keeps_info_and_order(initialize, monkeypatch):
+    from modules import images, postprocessing, scripts, shared
+
+    class Script:
+        def run(self, pp, args):
+            index = pp.image.getpixel((0, 0))[0]
+            pp.info["Index"] = str(index)
+
+            extra = pp.create_copy(pp.image.copy(), nametags=["extra"])
+            extra.info["Extra"] = str(index)
+            pp.extra_images.append(extra)
+
+    saved = []
+
+    def save_image(image, path, basename, info=None, existing_info=None, suffix="", **kwargs):
+        # give the main thread time to process the next image while this one is being saved
+        time.sleep(0.01)
+        saved.append((info, existing_info["postprocessing"], existing_info["parameters"], suffix))
+        return f"{basename}{suffix}.png", None
+
+    monkeypatch.setattr(scripts, "scripts_postproc", Script())
+    monkeypatch.setattr(images, "save_image", save_image)
+    monkeypatch.setitem(shared.opts.data, "postprocessing_prefetch_images", 2)
+    monkeypatch.setitem(shared.opts.data, "enable_pnginfo", True)
+
+    inputs = []
+    for i in range(5):
+        image = Image.new("RGB", (8, 8), (i, 0, 0))
+        image.info["parameters"] = f"source {i}"
+        inputs.append(image)
+
+    outputs, _, _ = postprocessing.run_postprocessing(1, None, inputs, "", "", True)
+
+    expected = []
+    for i in range(5):
+        expected.append((f"Index: {i}", f"Index: {i}", f"source {i}", ""))
+        expected.append((f"Index: {i}, Extra: {i}", f"Index: {i}, Extra: {i}", f"source {i}", "-extra"))
+
+    assert saved == expected
+    assert [image.getpixel((0, 0))[0] for image in outputs] == [i for i in range(5) for _ in range(2)]
+    assert [image.info["postprocessing"] for image in outputs] == [x[0] for x in expected]
@@ -0,0 +1,158 @@
+import torch
+
+from modules import prompt_parser
+
+
+def make_schedules(batch_size, steps, token_counts):
+    torch.manual_seed(0)
+
+    schedules = []
+    for i in range(batch_size):
+        ends = list(range(i % 3 + 1, steps, 3)) + [steps]
+        schedule = [prompt_parser.ScheduledPromptConditioning(end, torch.randn(token_counts[(i + j) % len(token_counts)], 8)) for j, end in enumerate(ends)]
+        schedules.append(schedule)
+
+    return schedules
+
+
+def test_conditioning_table_matches_reconstruct_multicond_batch():
+    schedules = make_schedules(4, 20, [77, 154])
+    c = prompt_parser.MulticondLearnedConditioning(shape=(2,), batch=[
+        [prompt_parser.ComposableScheduledPromptConditioning(schedules[0]), prompt_parser.ComposableScheduledPromptConditioning(schedules[1], 0.5)],
+        [prompt_parser.ComposableScheduledPromptConditioning(schedules[2]), prompt_parser.ComposableScheduledPromptConditioning(schedules[3], 0.2)],
+    ])
+
+    table = prompt_parser.MulticondConditioningTable(c)
+    for step in range(0, 22):
+        expected_conds_list, expected = prompt_parser.reconstruct_multicond_batch(c, step)
+        conds_list, result = table.get(step)
+
+        assert conds_list == expected_conds_list
+        assert torch.equal(result, expected)
+
+
+def test_conditioning_table_matches_reconstruct_cond_batch():
+    schedules = make_schedules(3, 20, [77])
+
+    table = prompt_parser.ConditioningTable(schedules)
+    for step in range(0, 22):
+        assert torch.equal(table.get(step), prompt_parser.reconstruct_cond_batch(schedules, step))
+
+
+def test_memoized_parsing_returns_independent_copies():
+    first = prompt_parser.parse_prompt_attention("a (b:1.2) c")
+    first[0][0] = "changed"
+    first += [["extra", 1.0]]
+
+    assert prompt_parser.parse_prompt_attention("a (b:1.2) c") == [["a ", 1.0], ["b", 1.2], [" c", 1.0]]
+
+    schedule = prompt_parser.get_learned_conditioning_prompt_schedules(["a [b:c:5]"], 10)[0]
+    schedule[0][1] = "changed"
+
+    assert prompt_parser.get_learned_conditioning_prompt_schedules(["a [b:c:5]"], 10)[0] == [[5, "a b"], [10, "a c"]]
+
+
+def benchmark_conditioning_table(batch_size=16, steps=150, channels=768, repeats=3):
+    """Times getting cond (77 and 154 tokens) and uncond (77 tokens) batches for every step of a sampling pass, with reconstruct_*_batch and with
+    conditioning tables, for schedules that change on every step, every 10 steps and never.
+
+    Run with `python -m test.test_prompt_parser` from the webui directory."""
+
+    import time
+
+    def make_staggered(interval, token_counts):
+        torch.manual_seed(0)
+
+        schedules = []
+        for i in range(batch_size):
+            ends = list(range(i % interval + 1, steps, interval)) + [steps] if interval else [steps]
+            schedules.append([prompt_parser.ScheduledPromptConditioning(end, torch.randn(token_counts[(i + j) % len(token_counts)], channels)) for j, end in enumerate(ends)])
+
+        return schedules
+
+    def best_of(fn, *args):
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn(*args)
+            best = min(best, time.perf_counter() - start)
+
+        return best
+
+    def reconstruct(c, uncond):
+        for step in range(steps):
+            prompt_parser.reconstruct_multicond_batch(c, step)
+            prompt_parser.reconstruct_cond_batch(uncond, step)
+
+    def tables(c, uncond):
+        cond_table = prompt_parser.MulticondConditioningTable(c)
+        uncond_table = prompt_parser.ConditioningTable(uncond)
+        for step in range(steps):
+            cond_table.get(step)
+            uncond_table.get(step)
+
+    for name, interval in (("schedules change every step", 1), ("staggered changes every 10 steps", 10), ("no prompt editing", 0)):
+        c = prompt_parser.MulticondLearnedConditioning(shape=(batch_size,), batch=[[prompt_parser.ComposableScheduledPromptConditioning(schedule)] for schedule in make_staggered(interval, [77, 154])])
+        uncond = make_staggered(interval, [77])
+
+        print(f"{name:34} reconstruct: {best_of(reconstruct, c, uncond) * 1000:7.1f} ms, tables: {best_of(tables, c, uncond) * 1000:7.1f} ms")
+
+
+def benchmark_parsing(requests=60, batch_size=4):
+    """Times parsing prompts the way a generation does (extra networks, AND, schedules, emphasis) for a series of
+    requests like an X/Y/Z plot makes, with prompt S/R and steps on its axes: with caches cleared before every request,
+    with caches cleared once, and with caches already filled.
+
+    Run with `python -m test.test_prompt_parser` from the webui directory."""
+
+    import itertools
+    import time
+
+    from modules import extra_networks
+
+    prompts = [
+        "a (castle:1.2) on a hill, [day:night:0.4], (masterpiece), <lora:detail:0.6>",
+        "[castle|fortress] by the sea AND stormy sky:0.7, ((dramatic lighting))",
+        "portrait of a knight in front of a castle, [oil painting:watercolor:12], <lora:style:0.8> <hypernet:sketch:1>",
+        "castle interior, [(candles:1.3)::0.5] [[cobwebs]], (dust:0.8) AND gothic:0.5",
+    ]
+    negative = "(worst quality, low quality:1.4), blurry, [text|watermark], extra fingers"
+
+    variants = list(itertools.product(["castle", "tower", "bridge", "cathedral", "lighthouse"], [20, 30, 40, 50]))
+
+    def request(replacement, steps):
+        batch = [prompts[i % len(prompts)].replace("castle", replacement) for i in range(batch_size)]
+        batch, _ = extra_networks.parse_prompts(batch)
+        _, flat, _ = prompt_parser.get_multicond_prompt_list(batch)
+
+        for schedule in prompt_parser.get_learned_conditioning_prompt_schedules(list(flat) + [negative] * batch_size, steps):
+            for _, text in schedule:
+                prompt_parser.parse_prompt_attention(text)
+
+    def clear():
+        prompt_parser.parse_schedule.cache_clear()
+        prompt_parser.get_prompt_schedule.cache_clear()
+        prompt_parser.parse_prompt_attention.cache_clear()
+        extra_networks.parse_prompt_cached.cache_clear()
+
+    def run(clear_every_request):
+        start = time.perf_counter()
+        for replacement, steps in itertools.islice(itertools.cycle(variants), requests):
+            if clear_every_request:
+                clear()
+
+            request(replacement, steps)
+
+        return time.perf_counter() - start
+
+    uncached = run(True)
+    clear()
+    first = run(False)
+    repeated = run(False)
+
+    print(f"{requests} requests of {batch_size} prompts: cleared every request {uncached:.3f} s, first run {first:.3f} s, repeated run {repeated:.3f} s")
+
+
+if __name__ == "__main__":
+    benchmark_conditioning_table()
+    benchmark_parsing()
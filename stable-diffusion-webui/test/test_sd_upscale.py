@@ -0,0 +1,125 @@
+import os
+import types
+
+import numpy as np
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def sd_upscale(initialize, monkeypatch):
+    from modules import devices, paths, script_loading, shared
+
+    module = script_loading.load_module(os.path.join(paths.script_path, "scripts", "sd_upscale.py"))
+
+    monkeypatch.setattr(shared, "sd_upscalers", [types.SimpleNamespace(name="None")])
+    monkeypatch.setitem(shared.opts.data, "img2img_background_color", "#ffffff")
+    monkeypatch.setitem(shared.opts.data, "samples_save", False)
+    monkeypatch.setattr(shared.cmd_opts, "lowvram", False)
+    monkeypatch.setattr(shared.cmd_opts, "medvram", False)
+    monkeypatch.setattr(devices, "torch_gc", lambda: None)
+    monkeypatch.setattr(module, "Processed", lambda p, images, seed, info: types.SimpleNamespace(images=images, seed=seed, info=info))
+
+    calls = []
+
+    def process_images(p):
+        calls.append(types.SimpleNamespace(seed=p.seed, batch_size=p.batch_size, cached_c=p.cached_c, cached_uc=p.cached_uc))
+        return types.SimpleNamespace(images=[generate(tile, p.seed + i) for i, tile in enumerate(p.init_images)], seed=p.seed, info="info")
+
+    monkeypatch.setattr(module.processing, "process_images", process_images)
+    module.calls = calls
+
+    return module
+
+
+def generate(tile, seed):
+    """What the stubbed process_images makes of a tile with a seed."""
+
+    return Image.fromarray(np.asarray(tile) ^ np.uint8(seed % 256))
+
+
+def use_fake_cuda(monkeypatch, tiles_per_batch):
+    import torch
+
+    from modules import devices
+
+    monkeypatch.setattr(devices, "device", types.SimpleNamespace(type="cuda"))
+    monkeypatch.setattr(devices, "batch_size_for_free_memory", lambda device, item_memory, max_batch_size: tiles_per_batch)
+    monkeypatch.setattr(torch.cuda, "reset_peak_memory_stats", lambda device=None: None)
+    monkeypatch.setattr(torch.cuda, "memory_allocated", lambda device=None: 0)
+    monkeypatch.setattr(torch.cuda, "max_memory_allocated", lambda device=None: 1024)
+
+
+def make_p(image, batch_size=1, n_iter=2):
+    return types.SimpleNamespace(seed=100, subseed=200, extra_generation_params={}, init_images=[image], width=64, height=64, batch_size=batch_size, n_iter=n_iter, do_not_save_grid=False, do_not_save_samples=False)
+
+
+def random_image(width, height):
+    return Image.fromarray(np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def expected_image(image, seed):
+    from modules import images
+
+    grid = images.split_grid(image, 64, 64, 16)
+    index = 0
+    for _, _, row in grid.tiles:
+        for tiledata in row:
+            tiledata[2] = generate(tiledata[2], seed + index)
+            index += 1
+
+    return images.combine_grid(grid)
+
+
+@pytest.mark.parametrize("tiles_per_batch", [1, 3, 5])
+def test_auto_batch_size(sd_upscale, monkeypatch, tiles_per_batch):
+    from modules import shared
+
+    use_fake_cuda(monkeypatch, tiles_per_batch)
+
+    image = random_image(200, 150)
+    p = make_p(image)
+    processed = sd_upscale.Script().run(p, None, 16, 0, 1.0, auto_batch_size=True)
+
+    # memory is measured with the first tile of the first upscale; everything after that is in batches
+    tile_count = 12
+    first = [1] + [min(tiles_per_batch, tile_count - done) for done in range(1, tile_count, tiles_per_batch)]
+    second = [min(tiles_per_batch, tile_count - done) for done in range(0, tile_count, tiles_per_batch)]
+    assert [call.batch_size for call in sd_upscale.calls] == first + second
+    assert shared.state.job_count == len(first) + len(second)
+
+    # every tile gets the seed it would get with one tile per batch, and the result is the same as combine_grid
+    tile_seeds = [call.seed + i for call in sd_upscale.calls for i in range(call.batch_size)]
+    assert tile_seeds == [100 + i for i in range(tile_count)] + [101 + i for i in range(tile_count)]
+
+    assert len(processed.images) == 2
+    for n, result in enumerate(processed.images):
+        assert np.array_equal(np.asarray(result), np.asarray(expected_image(image, 100 + n)))
+
+    # conditioning is cached per batch size and shared between batches of the same size
+    for a in sd_upscale.calls:
+        for b in sd_upscale.calls:
+            assert (a.cached_c is b.cached_c) == (a.batch_size == b.batch_size)
+            assert (a.cached_uc is b.cached_uc) == (a.batch_size == b.batch_size)
+
+
+def test_fixed_batch_size(sd_upscale):
+    image = random_image(200, 150)
+    p = make_p(image, batch_size=4, n_iter=1)
+    processed = sd_upscale.Script().run(p, None, 16, 0, 1.0)
+
+    assert [call.batch_size for call in sd_upscale.calls] == [4, 4, 4]
+    assert [call.seed for call in sd_upscale.calls] == [100, 101, 102]
+    assert p.batch_size == 4
+
+    grid_seeds = [call.seed + i for call in sd_upscale.calls for i in range(call.batch_size)]
+
+    from modules import images
+
+    grid = images.split_grid(image, 64, 64, 16)
+    tiles = iter(grid_seeds)
+    for _, _, row in grid.tiles:
+        for tiledata in row:
+            tiledata[2] = generate(tiledata[2], next(tiles))
+
+    assert np.array_equal(np.asarray(processed.images[0]), np.asarray(images.combine_grid(grid)))
@@ -0,0 +1,73 @@
+import torch
+
+from modules import sd_vae_tiled
+
+
+class PointwiseModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.norm = torch.nn.GroupNorm(2, 4)
+        self.conv = torch.nn.Conv2d(4, 3, 1)
+
+    def forward(self, x):
+        x = self.conv(self.norm(x))
+        return torch.nn.functional.interpolate(x, scale_factor=8, mode="nearest")
+
+
+def test_tile_positions_cover_everything():
+    assert sd_vae_tiled.tile_positions(64, 128, 16) == [0]
+    assert sd_vae_tiled.tile_positions(100, 32, 8) == [0, 24, 48, 68]
+
+
+def test_tiled_apply_uses_shared_groupnorm_stats():
+    torch.manual_seed(0)
+    model = PointwiseModel()
+    x = torch.randn(2, 4, 40, 56)
+
+    with torch.no_grad():
+        with sd_vae_tiled.GroupNormStats(model) as stats:
+            stats.start_pass(record=True)
+            model(sd_vae_tiled.downscaled_for_stats(x, 16, 1))
+            stats.start_pass(record=False)
+            expected = model(x)
+
+        result = sd_vae_tiled.tiled_apply(model, x, model, tile_size=16, overlap=4)
+
+    assert "forward" not in model.norm.__dict__
+    assert result.shape == (2, 3, 320, 448)
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+class FakeDistribution:
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.mean, self.logvar = torch.chunk(parameters, 2, dim=1)
+
+
+class FakeVae:
+    """Encodes each 8x8 block of pixels into a distribution whose mean is the block's average; counts samples drawn."""
+
+    def __init__(self):
+        self.first_stage_model = torch.nn.Identity()
+        self.samples = 0
+
+    def encode_first_stage(self, x):
+        mean = torch.nn.functional.avg_pool2d(x, 8)
+        return FakeDistribution(torch.cat([mean, torch.full_like(mean, -2.0)], dim=1))
+
+    def get_first_stage_encoding(self, distribution):
+        self.samples += 1
+        return distribution.mean + torch.exp(0.5 * distribution.logvar) * torch.randn_like(distribution.mean)
+
+
+def test_tiled_encode_samples_once_from_blended_distribution():
+    vae = FakeVae()
+    x = torch.rand(1, 3, 96, 128)
+
+    encoded = sd_vae_tiled.tiled_encode(vae, x, tile_size=32, overlap=8)
+
+    assert encoded.shape == (1, 3, 12, 16)
+    assert vae.samples == 1
+
+    vae.get_first_stage_encoding = lambda distribution: distribution.mean
+    assert torch.allclose(sd_vae_tiled.tiled_encode(vae, x, tile_size=32, overlap=8), vae.encode_first_stage(x).mean, atol=1e-6)
@@ -0,0 +1,83 @@
+import diskcache
+
+from modules import sequence_numbers
+
+
+def first_unused(path, basename):
+    numbers = [int(file.name.split("-")[0].split(".")[0]) for file in path.iterdir() if file.name[0].isdigit()]
+    return max(numbers, default=-1) + 1
+
+
+class CountingScan:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, path, basename):
+        self.calls += 1
+        return first_unused(path, basename)
+
+
+def test_directory_is_listed_once(tmp_path):
+    (tmp_path / "00041-seed.png").touch()
+    scan = CountingScan()
+
+    with diskcache.Cache(tmp_path / "cache") as storage:
+        numbers = sequence_numbers.SequenceNumbers(scan, storage)
+        assert [numbers.allocate(tmp_path, "") for _ in range(5)] == [42, 43, 44, 45, 46]
+
+    assert scan.calls == 1
+
+
+def test_numbers_are_shared_between_instances(tmp_path):
+    with diskcache.Cache(tmp_path / "cache") as storage:
+        first = sequence_numbers.SequenceNumbers(CountingScan(), storage)
+        second = sequence_numbers.SequenceNumbers(CountingScan(), storage)
+
+        assert first.allocate(tmp_path, "") == 0
+        assert second.allocate(tmp_path, "") == 1
+        assert first.allocate(tmp_path, "") == 2
+
+
+def test_invalidate_lists_directory_again(tmp_path):
+    scan = CountingScan()
+
+    with diskcache.Cache(tmp_path / "cache") as storage:
+        numbers = sequence_numbers.SequenceNumbers(scan, storage)
+        assert numbers.allocate(tmp_path, "") == 0
+
+        (tmp_path / "00010.png").touch()
+        numbers.invalidate(tmp_path, "")
+
+        assert numbers.allocate(tmp_path, "") == 11
+        assert scan.calls == 2
+
+
+def test_numbering_starts_over_after_files_are_removed(tmp_path):
+    for i in range(3):
+        (tmp_path / f"{i:05}.png").touch()
+
+    with diskcache.Cache(tmp_path / "cache") as storage:
+        numbers = sequence_numbers.SequenceNumbers(CountingScan(), storage)
+        assert numbers.allocate(tmp_path, "") == 3
+
+        for file in tmp_path.glob("*.png"):
+            file.unlink()
+
+        restarted = sequence_numbers.SequenceNumbers(CountingScan(), storage)
+        assert restarted.allocate(tmp_path, "") == 0
+
+
+def test_numbers_of_existing_files_are_skipped(tmp_path):
+    scan = CountingScan()
+
+    with diskcache.Cache(tmp_path / "cache") as storage:
+        numbers = sequence_numbers.SequenceNumbers(scan, storage)
+        assert numbers.allocate(tmp_path, "") == 0
+
+        # written by something else, with a name the scan does not see
+        (tmp_path / "x00001.png").touch()
+
+        def filename(number):
+            return tmp_path / f"x{number:05}.png"
+
+        assert numbers.allocate(tmp_path, "", filename) == 2
@@ -0,0 +1,55 @@
+import email.utils
+import types
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+
+@pytest.mark.usefixtures("initialize")
+def test_size_bucket():
+    from modules import thumbnails
+
+    assert thumbnails.size_bucket(1) == 128
+    assert thumbnails.size_bucket(256) == 256
+    assert thumbnails.size_bucket(300) == 384
+    assert thumbnails.size_bucket(5000) == thumbnails.size_buckets[-1]
+
+
+@pytest.mark.usefixtures("initialize")
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "P", "L"])
+def test_make_thumbnail_scales_shorter_side(mode):
+    from modules import thumbnails
+
+    image = Image.new(mode, (1200, 800))
+
+    with Image.open(BytesIO(thumbnails.make_thumbnail(image, 256))) as thumbnail:
+        assert thumbnail.format == "WEBP"
+        assert thumbnail.size == (384, 256)
+
+
+@pytest.mark.usefixtures("initialize")
+def test_make_thumbnail_does_not_upscale():
+    from modules import thumbnails
+
+    with Image.open(BytesIO(thumbnails.make_thumbnail(Image.new("RGB", (100, 50)), 256))) as thumbnail:
+        assert thumbnail.size == (100, 50)
+
+
+def request(**headers):
+    return types.SimpleNamespace(headers={k.replace("_", "-"): v for k, v in headers.items()})
+
+
+@pytest.mark.usefixtures("initialize")
+def test_is_not_modified():
+    from modules import thumbnails
+
+    etag = thumbnails.etag("a.png", [1, 2, 3], 256)
+
+    assert etag != thumbnails.etag("a.png", [1, 2, 4], 256)
+    assert thumbnails.is_not_modified(request(if_none_match=etag), etag, 1000)
+    assert thumbnails.is_not_modified(request(if_none_match=f'"x", W/{etag}'), etag)
+    assert not thumbnails.is_not_modified(request(if_none_match='"x"'), etag, 1000)
+    assert thumbnails.is_not_modified(request(if_modified_since=email.utils.formatdate(1000, usegmt=True)), etag, 1000.5)
+    assert not thumbnails.is_not_modified(request(if_modified_since=email.utils.formatdate(999, usegmt=True)), etag, 1000)
+    assert not thumbnails.is_not_modified(request(), etag, 1000)
@@ -0,0 +1,113 @@
+import types
+
+import pytest
+import torch
+
+
+class NearestUpscaler(torch.nn.Module):
+    def __init__(self, scale):
+        super().__init__()
+        self.scale = scale
+        self.weight = torch.nn.Parameter(torch.ones(1))
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(x.shape[0])
+        return torch.nn.functional.interpolate(x, scale_factor=self.scale, mode="nearest") * self.weight
+
+
+@pytest.fixture(autouse=True)
+def settings(initialize, monkeypatch):
+    from modules import upscaler_utils
+
+    monkeypatch.setattr(upscaler_utils.shared, "opts", types.SimpleNamespace(upscaler_tile_batch_size=3, enable_upscale_progressbar=False), raising=False)
+    monkeypatch.setattr(upscaler_utils.shared, "state", types.SimpleNamespace(interrupted=False, skipped=False), raising=False)
+
+
+@pytest.mark.parametrize("size", [(64, 64), (100, 37), (20, 150)])
+def test_tiled_upscale_matches_untiled(size):
+    from modules import upscaler_utils
+
+    model = NearestUpscaler(2)
+    img = torch.rand(1, 3, *size)
+
+    output = upscaler_utils.upscale_tiles(img, model, tile_size=32, tile_overlap=8)
+
+    assert output.shape == (1, 3, size[0] * 2, size[1] * 2)
+    assert torch.allclose(output, model(img), atol=1e-6)
+
+
+def test_tiles_are_batched():
+    from modules import upscaler_utils
+
+    model = NearestUpscaler(4)
+
+    upscaler_utils.upscale_tiles(torch.rand(1, 3, 64, 64), model, tile_size=24, tile_overlap=4)
+
+    assert model.batch_sizes == [1, 3, 3, 2]  # first tile alone, then in batches from settings
+
+
+def test_interrupted(monkeypatch):
+    from modules import upscaler_utils
+
+    monkeypatch.setattr(upscaler_utils.shared.state, "interrupted", True)
+
+    assert upscaler_utils.upscale_tiles(torch.rand(1, 3, 64, 64), NearestUpscaler(2), tile_size=32, tile_overlap=8) is None
+
+
+class CompactUpscaler(torch.nn.Module):
+    """Shaped like the SRVGGNetCompact models that Real-ESRGAN uses: 3x3 convolutions at input resolution and a pixel
+    shuffle at the end."""
+
+    def __init__(self, scale=4, features=64, layers=16):
+        super().__init__()
+
+        body = [torch.nn.Conv2d(3, features, 3, padding=1), torch.nn.PReLU(features)]
+        for _ in range(layers):
+            body += [torch.nn.Conv2d(features, features, 3, padding=1), torch.nn.PReLU(features)]
+        body += [torch.nn.Conv2d(features, 3 * scale * scale, 3, padding=1), torch.nn.PixelShuffle(scale)]
+
+        self.body = torch.nn.Sequential(*body)
+
+    def forward(self, x):
+        return self.body(x)
+
+
+def benchmark(device="cpu", size=512, tile_size=192, tile_overlap=8, batch_sizes=(1, 2, 4, 8), repeats=2):
+    """Times upscaling an image in tiles one at a time and in batches, with a randomly initialized compact upscaler.
+
+    Run with `python -m test.test_upscaler_utils` from the webui directory; pass a device name as an argument to run
+    on something other than CPU."""
+
+    import time
+
+    from modules import shared, upscaler_utils
+
+    torch.manual_seed(0)
+    model = CompactUpscaler().to(device)
+    img = torch.rand(1, 3, size, size)
+
+    shared.opts.data["enable_upscale_progressbar"] = False
+
+    expected = None
+    for batch_size in batch_sizes:
+        shared.opts.data["upscaler_tile_batch_size"] = batch_size
+
+        best = float("inf")
+        with torch.inference_mode():
+            for _ in range(repeats):
+                start = time.perf_counter()
+                output = upscaler_utils.upscale_tiles(img, model, tile_size=tile_size, tile_overlap=tile_overlap)
+                best = min(best, time.perf_counter() - start)
+
+        expected = output if expected is None else expected
+        difference = (output - expected).abs().max().item()
+        print(f"{size}x{size} in tiles of {tile_size}, batch size {batch_size:2}: {best * 1000:8.1f} ms, max difference from batch size {batch_sizes[0]}: {difference:.2e}")
+
+
+if __name__ == "__main__":
+    import sys
+
+    import webui  # noqa: F401
+
+    benchmark(*sys.argv[1:2])
@@ -0,0 +1,107 @@
+import pytest
+import torch
+
+
+class FakeFirstStageModel:
+    def __init__(self, dtype):
+        self.dtype = dtype
+
+    def to(self, dtype):
+        self.dtype = dtype
+        return self
+
+
+class FakeModel:
+    """Decodes a latent into its first three channels upscaled 8x; in float16, latents marked with a large first value
+    decode into NaNs, like some VAEs do in half precision."""
+
+    def __init__(self, dtype=torch.float16):
+        self.first_stage_model = FakeFirstStageModel(dtype)
+        self.batch_sizes = []
+
+    def decode(self, x):
+        self.batch_sizes.append(x.shape[0])
+
+        res = torch.nn.functional.interpolate(x.float()[:, :3], scale_factor=8, mode="nearest")
+        if self.first_stage_model.dtype == torch.float16:
+            res[x[:, 0, 0, 0] > 100] = float("nan")
+
+        return res
+
+
+@pytest.fixture
+def processing(initialize, monkeypatch):
+    from modules import devices, errors, processing, shared
+
+    monkeypatch.setattr(processing, "decode_first_stage", lambda model, x: model.decode(x))
+    monkeypatch.setattr(devices, "dtype_vae", torch.float16)
+    monkeypatch.setattr(shared.cmd_opts, "disable_nan_check", False)
+    monkeypatch.setitem(shared.opts.data, "sd_vae_decode_batch_size", 0)
+    monkeypatch.setitem(shared.opts.data, "auto_vae_precision", True)
+    monkeypatch.setitem(shared.opts.data, "auto_vae_precision_bfloat16", False)
+    monkeypatch.setattr(errors, "print_error_explanation", lambda message: None)
+
+    return processing
+
+
+def test_chunked_decode_matches_decoding_one_by_one(processing, monkeypatch):
+    from modules import shared
+
+    batch = torch.randn(7, 4, 8, 8)
+
+    monkeypatch.setitem(shared.opts.data, "sd_vae_decode_batch_size", 1)
+    expected = processing.decode_latent_batch(FakeModel(), batch)
+
+    monkeypatch.setitem(shared.opts.data, "sd_vae_decode_batch_size", 3)
+    model = FakeModel()
+    samples = processing.decode_latent_batch(model, batch, target_device="cpu", check_for_nans=True)
+
+    assert model.batch_sizes == [3, 3, 1]
+    assert len(samples) == 7
+    assert all(torch.equal(a, b) for a, b in zip(samples, expected))
+
+
+def test_chunk_size_from_free_memory(processing, monkeypatch):
+    import modules.sd_hijack_optimizations
+
+    batch = torch.randn(2, 4, 64, 64)
+    bytes_per_sample = 512 * 512 * 2 * 512  # 512x512 pixels, float16, 512 bytes per pixel
+
+    monkeypatch.setattr(modules.sd_hijack_optimizations, "get_available_vram", lambda: bytes_per_sample * 4)
+    assert processing.get_vae_decode_batch_size(batch) == 3
+
+    monkeypatch.setattr(modules.sd_hijack_optimizations, "get_available_vram", lambda: 1024)
+    assert processing.get_vae_decode_batch_size(batch) == 1
+
+
+def test_nans_in_chunk_are_fixed_by_decoding_in_higher_precision(processing, monkeypatch):
+    from modules import devices, shared
+
+    monkeypatch.setitem(shared.opts.data, "sd_vae_decode_batch_size", 4)
+
+    batch = torch.randn(4, 4, 8, 8)
+    batch[2, 0, 0, 0] = 1000
+
+    model = FakeModel()
+    samples = processing.decode_latent_batch(model, batch, check_for_nans=True)
+
+    assert not any(torch.isnan(sample).any() for sample in samples)
+    assert all(torch.equal(sample, FakeModel(torch.float32).decode(batch[i:i + 1])[0]) for i, sample in enumerate(samples))
+    assert devices.dtype_vae == torch.float32
+    assert model.first_stage_model.dtype == torch.float32
+
+    # the chunk first, then every sample on its own, with the one with NaNs decoded twice
+    assert model.batch_sizes == [4, 1, 1, 1, 1, 1]
+
+
+def test_nans_raise_without_autofix(processing, monkeypatch):
+    from modules import devices, shared
+
+    monkeypatch.setitem(shared.opts.data, "sd_vae_decode_batch_size", 2)
+    monkeypatch.setitem(shared.opts.data, "auto_vae_precision", False)
+
+    batch = torch.randn(2, 4, 8, 8)
+    batch[1, 0, 0, 0] = 1000
+
+    with pytest.raises(devices.NansException):
+        processing.decode_latent_batch(FakeModel(), batch, check_for_nans=True)
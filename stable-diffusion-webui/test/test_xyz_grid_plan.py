@@ -0,0 +1,101 @@
+import os
+import time
+import types
+
+from PIL import Image
+
+from modules import xyz_grid_plan
+
+
+def axis(label, cost=0.0):
+    return types.SimpleNamespace(label=label, cost=cost)
+
+
+def test_default_order_matches_nested_loops():
+    plan = xyz_grid_plan.make_plan((2, 3, 2), [0, 0, 0])
+
+    expected = [(ix, iy, iz) for iz in range(2) for iy in range(3) for ix in range(2)]
+    assert [cell for batch in plan.batches for cell in batch] == expected
+
+
+def test_expensive_axes_change_least():
+    costs = [xyz_grid_plan.axis_cost(axis("Checkpoint name", 1.0), []), xyz_grid_plan.axis_cost(axis("VAE", 0.7), []), 0]
+    plan = xyz_grid_plan.make_plan((3, 2, 4), costs, batchable=(False, False, True), batch_size=4)
+
+    assert plan.axes_order == (0, 1, 2)
+    assert plan.changes[0] == 2
+    assert plan.changes[1] == 3
+    assert len(plan.batches) == 6
+    assert all(len({(ix, iy) for ix, iy, _ in batch}) == 1 for batch in plan.batches)
+    assert sorted(cell for batch in plan.batches for cell in batch) == sorted((ix, iy, iz) for ix in range(3) for iy in range(2) for iz in range(4))
+
+
+def test_prompts_with_loras_cost_more():
+    assert xyz_grid_plan.axis_cost(axis("Prompt S/R"), ["cat", "dog"]) == xyz_grid_plan.conditioning_cost
+    assert xyz_grid_plan.axis_cost(axis("Prompt S/R"), ["<lora:a:1>", "<lora:b:1>"]) > xyz_grid_plan.conditioning_cost
+    assert xyz_grid_plan.axis_cost(axis("Seed"), [1, 2]) == 0
+
+
+def test_prompts_with_different_loras_are_not_batched():
+    batchable_axes = ("Seed", "Prompt S/R")
+    prompts = ("a photo of a cat <lora:style:0.5>", "")
+
+    assert xyz_grid_plan.axis_batchable(axis("Prompt S/R"), ["cat", "dog"], prompts, batchable_axes)
+    assert xyz_grid_plan.axis_batchable(axis("Seed"), [1, 2], prompts, batchable_axes)
+    assert not xyz_grid_plan.axis_batchable(axis("Steps"), [10, 20], prompts, batchable_axes)
+
+    values = ["<lora:first:1>", "<lora:second:1>"]
+    assert not xyz_grid_plan.axis_batchable(axis("Prompt S/R"), values, ("<lora:first:1> a cat", ""), batchable_axes)
+    assert not xyz_grid_plan.axis_batchable(axis("Prompt S/R"), ["0.5", "0.8"], prompts, batchable_axes)
+
+    batchable = (xyz_grid_plan.axis_batchable(axis("Prompt S/R"), values, ("<lora:first:1> a cat", ""), batchable_axes), False, False)
+    plan = xyz_grid_plan.make_plan((2, 1, 1), [0, 0, 0], batchable=batchable, batch_size=4)
+    assert all(len(batch) == 1 for batch in plan.batches)
+
+
+def test_progress_is_saved_and_removed(tmp_path):
+    progress = xyz_grid_plan.PlotProgress(tmp_path / "progress", "key")
+    assert not progress.resumed
+
+    progress.set("seeds", [1, 2])
+    progress.save_cell(3, Image.new("RGB", (8, 8), (255, 0, 0)), "prompt", 5, "infotext")
+
+    resumed = xyz_grid_plan.PlotProgress(tmp_path / "progress", "key")
+    assert resumed.resumed
+    assert resumed.get("seeds") == [1, 2]
+
+    image, prompt, seed, infotext = resumed.load_cell(3)
+    assert image.getpixel((0, 0)) == (255, 0, 0)
+    assert (prompt, seed, infotext) == ("prompt", 5, "infotext")
+    assert resumed.load_cell(4) is None
+
+    resumed.remove()
+    assert not (tmp_path / "progress").exists()
+
+
+def test_removing_progress_keeps_other_recent_plots(tmp_path):
+    old = xyz_grid_plan.PlotProgress(tmp_path / "progress", "old")
+    old.save_cell(0, Image.new("RGB", (8, 8)), "prompt", 5, "infotext")
+    old_time = time.time() - xyz_grid_plan.progress_max_age - 60
+    os.utime(old.path, (old_time, old_time))
+
+    interrupted = xyz_grid_plan.PlotProgress(tmp_path / "progress", "interrupted")
+    interrupted.save_cell(0, Image.new("RGB", (8, 8)), "prompt", 5, "infotext")
+
+    finished = xyz_grid_plan.PlotProgress(tmp_path / "progress", "finished")
+    finished.save_cell(0, Image.new("RGB", (8, 8)), "prompt", 5, "infotext")
+    finished.remove()
+
+    assert sorted(os.listdir(tmp_path / "progress")) == ["interrupted"]
+    assert xyz_grid_plan.PlotProgress(tmp_path / "progress", "interrupted").resumed
+
+
+def test_plot_key_depends_on_parameters():
+    p = types.SimpleNamespace(prompt="cat", steps=20, seed=123, styles=[], override_settings={})
+    key = xyz_grid_plan.plot_key(p, [-1, -1], [("Steps", [10, 20])])
+
+    p.seed = 456
+    assert xyz_grid_plan.plot_key(p, [-1, -1], [("Steps", [10, 20])]) == key
+
+    p.prompt = "dog"
+    assert xyz_grid_plan.plot_key(p, [-1, -1], [("Steps", [10, 20])]) != key
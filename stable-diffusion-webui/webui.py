@@ -51,7 +51,7 @@ def webui():
     launch_api = cmd_opts.api
     initialize.initialize()
 
-    from modules import shared, ui_tempdir, script_callbacks, ui, progress, ui_extra_networks
+    from modules import shared, ui_tempdir, script_callbacks, ui, progress, ui_extra_networks, image_save_queue
 
     while 1:
         if shared.opts.clean_temp_dir_at_start:
@@ -133,6 +133,8 @@ def webui():
             print('Caught KeyboardInterrupt, stopping...')
             server_command = "stop"
 
+        image_save_queue.queue.stop()
+
         if server_command == "stop":
             print("Stopping server...")
             # If we catch a keyboard interrupt, we want to stop the server and exit.